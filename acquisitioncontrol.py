@@ -4,73 +4,165 @@
 """Contains the definition of the AcquisitionControl and the ThreadedHttpServer class."""
 
 import json
-import os
-import queue
+import re
 import sys
 import threading
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from pathlib import Path
+from collections import OrderedDict, deque
+from enum import Enum
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
 
 import numpy as np
-import requests
 from PySide6.QtCore import QObject, Signal, Slot
 from PySide6.QtWidgets import QApplication, QLabel, QPushButton, QVBoxLayout, QWidget
 from scanhub import AcquisitionCommand, AcquisitionEvent  # type: ignore
 
+from kspacestream import KSpaceStreamer
+from uploader import Uploader, UploadState
+
+SCAN_PATH = re.compile(r"^/api/scans/(?P<record_id>[^/]+)(?P<cancel>/cancel)?$")
+
+
+class ScanState(str, Enum):
+    """State of a scan requested by ScanHub."""
+
+    queued = "queued"
+    acquiring = "acquiring"
+    uploading = "uploading"
+    done = "done"
+    failed = "failed"
+    cancelled = "cancelled"
+
+
+# A scan in these states is not queued again
+ACTIVE_STATES = (ScanState.queued, ScanState.acquiring, ScanState.uploading)
+
 
 class RequestHandler(BaseHTTPRequestHandler):
-    """A class which handles the HTTP requests."""
+    """A class which handles the HTTP requests.
+
+    Endpoints:
+        POST /api/start-scan: queue a scan, 429 if the job queue is full,
+        409 if a scan with the record_id is queued or running
+        GET /api/scans/{record_id}: state of a scan
+        POST /api/scans/{record_id}/cancel (or DELETE /api/scans/{record_id}):
+        cancel a queued or running scan, 409 if it has finished
+    """
+
+    server: "ControlServer"
+
+    def send_json(self, status: int, response: dict, headers: dict[str, str] | None = None):
+        """Send a JSON response."""
+        body = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        """Handle the GET requests."""
+        match = SCAN_PATH.match(self.path)
+        if match and not match["cancel"]:
+            state = self.server.acquisition_control.scan_status(match["record_id"])
+            if state is None:
+                self.send_json(404, {"message": "Unknown scan"})
+            else:
+                self.send_json(200, {"record_id": match["record_id"], "status": state.value})
+        else:
+            # Send 404 error for unknown endpoints
+            self.send_json(404, {"message": "Not found"})
 
     def do_POST(self):
         """Handle the POST requests."""
+        match = SCAN_PATH.match(self.path)
         if self.path == "/api/start-scan":
-            content_length = int(self.headers["Content-Length"])
-            post_data = self.rfile.read(content_length)
-            payload = json.loads(post_data)
-
-            # Access the payload data
-            record_id = payload["record_id"]
-            sequence = payload["sequence"]
-
-            acquisition_event = AcquisitionEvent(
-                device_id="Simulator",
-                record_id=record_id,
-                command_id=AcquisitionCommand.start,
-                input_sequence=sequence,
-            )
-
-            # Call the start-scan method of the AcquisitionControl instance
-            self.server.acquisition_control.start_simulation(acquisition_event)
-
-            # Send response back to the client
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            response = {"message": "Simulation started"}
-            self.wfile.write(json.dumps(response).encode())
+            try:
+                content_length = int(self.headers["Content-Length"])
+                post_data = self.rfile.read(content_length)
+                payload = json.loads(post_data)
+                if not isinstance(payload["record_id"], str):
+                    raise TypeError("record_id must be a string")
+
+                # The event validates the payload, its errors are ValueErrors
+                acquisition_event = AcquisitionEvent(
+                    device_id="Simulator",
+                    record_id=payload["record_id"],
+                    command_id=AcquisitionCommand.start,
+                    input_sequence=payload["sequence"],
+                )
+            except (TypeError, ValueError, KeyError):
+                self.send_json(400, {"message": "Invalid scan request"})
+                return
+            record_id = acquisition_event.record_id
+
+            # Queue the scan, it starts when the previous scans have finished
+            try:
+                queued = self.server.acquisition_control.start_simulation(acquisition_event)
+            except ValueError:
+                state = self.server.acquisition_control.scan_status(record_id)
+                status = state.value if state else None
+                self.send_json(409, {"message": "Scan is queued or running", "record_id": record_id, "status": status})
+                return
+            if not queued:
+                self.send_json(429, {"message": "Too many queued scans"}, {"Retry-After": "10"})
+                return
+            state = self.server.acquisition_control.scan_status(record_id)
+            status = state.value if state else None
+            self.send_json(200, {"message": "Simulation queued", "record_id": record_id, "status": status})
+        elif match and match["cancel"]:
+            self.cancel(match["record_id"])
         else:
             # Send 404 error for unknown endpoints
-            self.send_response(404)
-            self.end_headers()
+            self.send_json(404, {"message": "Not found"})
+
+    def do_DELETE(self):
+        """Handle the DELETE requests."""
+        match = SCAN_PATH.match(self.path)
+        if match and not match["cancel"]:
+            self.cancel(match["record_id"])
+        else:
+            self.send_json(404, {"message": "Not found"})
+
+    def cancel(self, record_id: str):
+        """Cancel a scan and send its state."""
+        state = self.server.acquisition_control.cancel_scan(record_id)
+        if state is None:
+            self.send_json(404, {"message": "Unknown scan"})
+        elif state != ScanState.cancelled:
+            self.send_json(409, {"message": "Scan has finished", "record_id": record_id, "status": state.value})
+        else:
+            self.send_json(200, {"record_id": record_id, "status": state.value})
+
+
+class ControlServer(ThreadingHTTPServer):
+    """HTTP server handling every request on its own thread."""
+
+    # Listen backlog, bursts of connections are refused with the default of 5
+    request_queue_size = 128
+
+    def __init__(self, server_address: tuple[str, int], acquisition_control: "AcquisitionControl"):
+        """Bind the server to its address."""
+        super().__init__(server_address, RequestHandler)
+        self.acquisition_control = acquisition_control
 
 
 class ThreadedHttpServer:
-    """A class which creates a threaded HTTP server."""
+    """A class which runs the control server on a background thread."""
 
     def __init__(self, host, port, acquisition_control):
         """Initialize the ThreadedHttpServer class."""
         self.host = host
         self.port = port
         self.acquisition_control = acquisition_control
+        self.httpd: ControlServer | None = None
 
     def start(self):
         """Start the HTTP server."""
-        server_address = (self.host, self.port)
-        self.httpd = HTTPServer(server_address, RequestHandler)
-        RequestHandler.server = self.httpd  # Pass the server instance to the request handler
-        # Pass the AcquisitionControl instance to the request handler
-        RequestHandler.server.acquisition_control = self.acquisition_control
-        server_thread = threading.Thread(target=self.httpd.serve_forever)
+        self.httpd = ControlServer((self.host, self.port), self.acquisition_control)
+        server_thread = threading.Thread(target=self.httpd.serve_forever, name="ControlServer", daemon=True)
         server_thread.start()
 
     def stop(self):
@@ -78,12 +170,15 @@ class ThreadedHttpServer:
         if self.httpd:
             self.httpd.shutdown()
             self.httpd.server_close()
+            self.httpd = None
 
 
 class AcquisitionControl(QObject):
     """A class which contains methods to communicate with the ScanHub.
 
-    This class will establish a connection to ScanHub and receive/send commands
+    This class will establish a connection to ScanHub and receive/send commands.
+    Scans requested by ScanHub are queued and acquired one after another,
+    the queue holds at most max_jobs scans.
     """
 
     signalStatus = Signal(str)
@@ -94,17 +189,51 @@ class AcquisitionControl(QObject):
     signalStopMeasurement = Signal()
     signalPauseMeasurement = Signal()
 
-    _acquisition_queue: queue.Queue[AcquisitionEvent] = queue.Queue()
-
-    def __init__(self, account_name, account_key, scanhub_id, parent=None):
+    # Finished scans whose state can still be requested
+    _history = 1000
+
+    def __init__(
+        self,
+        account_name,
+        account_key,
+        scanhub_id,
+        parent=None,
+        streaming: bool = False,
+        address: tuple[str, int] = ("localhost", 5000),
+        max_jobs: int = 16,
+    ):
+        """Initialise the connection to ScanHub and start the HTTP server.
+
+        Parameters
+        ----------
+            streaming : bool
+                stream the readout lines during the acquisition instead of
+                uploading the kspace when it is finished
+            address : tuple
+                host and port of the HTTP server
+            max_jobs : int
+                maximum number of queued scans
+        """
         super(self.__class__, self).__init__(parent)
 
         # Create the threaded http server
-        self._threaded_http_server = ThreadedHttpServer("localhost", 5000, self)
+        self._threaded_http_server = ThreadedHttpServer(address[0], address[1], self)
 
         # Set the ScanHub ID
         self._scanhub_id = scanhub_id
 
+        # Queued scans, the scan being acquired and the state of all scans
+        self.max_jobs = max_jobs
+        self._acquisition_queue: deque[AcquisitionEvent] = deque()
+        self._current: AcquisitionEvent | None = None
+        self._scans: OrderedDict[str, ScanState] = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Uploads the acquired data in the background
+        self._uploader = Uploader()
+        self.streaming = streaming
+        self._streamer = KSpaceStreamer()
+
         # Make any cross object connections.
         self._connectSignals()
 
@@ -115,13 +244,86 @@ class AcquisitionControl(QObject):
         """Destructor of the class."""
         self.forceWorkerQuit()
 
-    def start_simulation(self, acquisition_event: AcquisitionEvent):
-        """Start the simulation."""
-        print("Starting simulation...")
-        print(acquisition_event)
-
-        self.signalStatus.emit("Starting simulation...")
-        self._acquisition_queue.put(acquisition_event)
+    def start_simulation(self, acquisition_event: AcquisitionEvent) -> bool:
+        """Queue a scan, it is started when the previous scans have been acquired.
+
+        Parameters
+        ----------
+            acquisition_event : AcquisitionEvent
+                the scan requested by ScanHub
+
+        Returns
+        -------
+            bool: False if the queue is full
+
+        Raises
+        ------
+            ValueError: if a scan with the same record_id is queued or running
+        """
+        print(f"Queueing simulation: {acquisition_event}")
+        with self._lock:
+            if self._scans.get(acquisition_event.record_id) in ACTIVE_STATES:
+                raise ValueError(f"Scan is queued or running: {acquisition_event.record_id}")
+            if len(self._acquisition_queue) >= self.max_jobs:
+                return False
+            self._acquisition_queue.append(acquisition_event)
+            self._set_state(acquisition_event.record_id, ScanState.queued)
+        self._start_next()
+        return True
+
+    def scan_status(self, record_id: str) -> ScanState | None:
+        """Return the state of a scan, None if it is unknown."""
+        with self._lock:
+            return self._scans.get(record_id)
+
+    def cancel_scan(self, record_id: str) -> ScanState | None:
+        """Cancel a queued scan or stop the running one.
+
+        Parameters
+        ----------
+            record_id : str
+                id of the scan
+
+        Returns
+        -------
+            ScanState: the state after the call (cancelled unless the scan had
+            finished acquiring), None if the scan is unknown
+        """
+        with self._lock:
+            state = self._scans.get(record_id)
+            running = self._current is not None and self._current.record_id == record_id
+            if state == ScanState.queued:
+                self._acquisition_queue = deque(e for e in self._acquisition_queue if e.record_id != record_id)
+            elif running:
+                self._current = None
+            else:
+                return state
+            self._set_state(record_id, ScanState.cancelled)
+
+        self.signalStatus.emit(f"Scan {record_id} cancelled")
+        if running:
+            self._streamer.stop(record_id)
+            self.signalStopMeasurement.emit()
+            self._start_next()
+        return ScanState.cancelled
+
+    def _set_state(self, record_id: str, state: ScanState):
+        # Called with the lock held
+        self._scans[record_id] = state
+        self._scans.move_to_end(record_id)
+        while len(self._scans) > self._history + self.max_jobs + 1:
+            self._scans.popitem(last=False)
+
+    def _start_next(self):
+        """Start the next queued scan if no scan is being acquired."""
+        with self._lock:
+            if self._current is not None or not self._acquisition_queue:
+                return
+            self._current = self._acquisition_queue.popleft()
+            self._set_state(self._current.record_id, ScanState.acquiring)
+            record_id = self._current.record_id
+
+        self.signalStatus.emit(f"Starting simulation of record {record_id}...")
         self.signalStartMeasurement.emit()
 
     def _connectSignals(self):
@@ -132,6 +334,8 @@ class AcquisitionControl(QObject):
         """Force the worker to quit."""
         # Stop the HTTP server when needed
         self._threaded_http_server.stop()
+        self._uploader.shutdown()
+        self._streamer.close()
 
     # @Slot()
     # def processCommand(self, acquisition_event: AcquisitionEvent) -> bool:
@@ -154,37 +358,101 @@ class AcquisitionControl(QObject):
     #         case _:
     #             return False
 
-    def upload_data_to_blob(self, array: np.ndarray, container_name):
-        """Upload the data to the blob storage."""
-        try:
-            tmp_directory_path = os.fspath(Path(__file__).resolve().parent / "tmp")
-
-            # If folder doesn't exist, then create it.
-            if not os.path.isdir(tmp_directory_path):
-                os.makedirs(tmp_directory_path)
-                print(f"created directory : {tmp_directory_path}")
-
-            tmp_file_path = os.fspath(Path(__file__).resolve().parent / "tmp/data.npy")
-
-            print(f"save data to {tmp_file_path}")
-            np.save(tmp_file_path, array)
-
-            acquisition_event = self._acquisition_queue.get()
+    def start_stream(
+        self,
+        kspace: Callable[[], np.ndarray],
+        mode: int,
+        duration: float,
+        progress: float = 0,
+        started: float | None = None,
+    ) -> bool:
+        """Stream the readout lines of the scan being acquired in real time.
+
+        Parameters
+        ----------
+            kspace : callable
+                returns the fully acquired kspace, called on a background thread
+            mode : int
+                filling mode, the acquisition order of the lines
+            duration : float
+                playback time of the remaining lines in seconds
+            progress : float
+                acquisition progress in percent when the playback starts
+            started : float
+                time.perf_counter() when the playback started, defaults to now
+
+        Returns
+        -------
+            bool: True if the stream was started
+        """
+        with self._lock:
+            acquisition_event = self._current
+        if acquisition_event is None:
+            print("No acquisition started by ScanHub, the data is not streamed")
+            return False
 
+        self.signalStatus.emit(f"Streaming record {acquisition_event.record_id}...")
+        self._streamer.start(
+            acquisition_event.record_id, kspace, mode, duration, progress, self._stream_finished, started
+        )
+        return True
+
+    def stop_stream(self):
+        """Stop streaming the scan being acquired, e.g. when the playback is paused."""
+        with self._lock:
+            if self._current is not None:
+                self._streamer.stop(self._current.record_id)
+
+    def _stream_finished(self, record_id: str, success: bool):
+        # Called on the sender thread, the signal is delivered to the GUI thread
+        with self._lock:
+            if self._scans.get(record_id) in (ScanState.acquiring, ScanState.uploading):
+                self._set_state(record_id, ScanState.done if success else ScanState.failed)
+        self.signalStatus.emit(f"Stream of record {record_id} {'done' if success else 'failed'}")
+
+    def upload_data_to_blob(self, array: np.ndarray, container_name) -> bool:
+        """Upload the data of the finished scan in the background and start the next scan.
+
+        Acquisitions started from the UI are not uploaded. The result is
+        reported by signalStatus and scan_status.
+
+        Parameters
+        ----------
+            array : np.ndarray
+                acquired kspace, must not be modified afterwards
+            container_name : str
+                unused, the workflow manager stores the data
+
+        Returns
+        -------
+            bool: True if the upload was queued
+        """
+        with self._lock:
+            acquisition_event, self._current = self._current, None
+            if acquisition_event is not None:
+                record_id = acquisition_event.record_id
+                # A finished stream has set the final state already
+                if self._scans.get(record_id) == ScanState.acquiring:
+                    self._set_state(record_id, ScanState.uploading)
+
+        if acquisition_event is None:
+            print("No acquisition started by ScanHub, the data is not uploaded")
+            uploaded = False
+        elif self.streaming:
+            uploaded = False  # Sent by start_stream during the acquisition
+        else:
             print(f"finished acquisition_event : {acquisition_event}")
-
-            file = {"file": open(tmp_file_path, "rb")}
-            url = f"http://localhost:8080/api/v1/workflow/upload/{acquisition_event.record_id}"
-
-            print(f"uploading to {url}")
-
-            r = requests.post(url, files=file)
-            print(r.json())
-            return True
-
-        except Exception as e:
-            print(e)
-            return False
+            self.signalStatus.emit(f"Uploading record {record_id}...")
+            self._uploader.submit(record_id, array, self._upload_finished)
+            uploaded = True
+        self._start_next()
+        return uploaded
+
+    def _upload_finished(self, record_id: str, state: UploadState):
+        # Called on an upload thread, the signal is delivered to the GUI thread
+        with self._lock:
+            self._set_state(record_id, ScanState.done if state == UploadState.done else ScanState.failed)
+        self.signalStatus.emit(f"Upload of record {record_id} {state.value}")
 
 
 # DEBUG CODE STARTING HERE
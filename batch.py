@@ -0,0 +1,232 @@
+# Copyright (C) 2023, BRAIN-LINK UG (haftungsbeschränkt). All Rights Reserved.
+# SPDX-License-Identifier: GPL-3.0-only OR LicenseRef-ScanHub-Commercial
+
+"""Contains the headless batch simulation entry point.
+
+Simulates acquisitions of many inputs without the user interface, e.g. to
+generate training data:
+
+    python batch.py data/*.dcm scans/ -o out --params params.json --sweep sweep.json
+
+The parameter file holds a JSON object of KSpaceParameters fields (or a list
+of them), the sweep file maps fields to lists of values and every
+combination is applied on top of every parameter set.
+"""
+
+import argparse
+import glob
+import itertools
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from fftengine import set_fft_engine
+from imageprefetcher import load_manipulators
+from kspacepipeline import KSpaceParameters, KSpacePipeline
+
+log = logging.getLogger(__name__)
+
+# Files taken from input directories
+INPUT_EXTENSIONS = {".dcm", ".dicom", ".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp", ".npy", ".npz"}
+
+
+def find_inputs(patterns: list[str]) -> list[str]:
+    """Expand files, directories (searched recursively) and glob patterns.
+
+    Parameters
+    ----------
+        patterns : list
+            files, directories or glob patterns
+
+    Returns
+    -------
+        list: sorted file paths without duplicates
+    """
+    paths: set[str] = set()
+    for pattern in patterns:
+        matches = glob.glob(pattern, recursive=True) or [pattern]
+        for match in matches:
+            if os.path.isdir(match):
+                for root, _, files in os.walk(match):
+                    paths.update(
+                        os.path.join(root, f) for f in files if os.path.splitext(f)[1].lower() in INPUT_EXTENSIONS
+                    )
+            elif os.path.isfile(match):
+                paths.add(match)
+            else:
+                log.warning(f"No input found: {pattern}")
+    return sorted(paths)
+
+
+def parameter_sets(params: dict | list | None = None, sweep: dict[str, list] | None = None) -> list[dict[str, Any]]:
+    """Combine base parameters and a parameter grid.
+
+    Parameters
+    ----------
+        params : dict or list
+            KSpaceParameters fields, or a list of such dicts
+        sweep : dict
+            fields and the values to sweep, every combination is applied to
+            every base parameter set
+
+    Returns
+    -------
+        list: the parameter sets as dicts, validated by KSpaceParameters.from_dict
+    """
+    bases = params if isinstance(params, list) else [params or {}]
+    names = list(sweep or {})
+    grid = list(itertools.product(*(sweep[name] for name in names))) if sweep else [()]
+    sets = [{**base, **dict(zip(names, values))} for base in bases for values in grid]
+    for values in sets:
+        KSpaceParameters.from_dict(values)
+    return sets
+
+
+def init_worker(backend: str):
+    """Use one FFT thread per worker process, the processes run in parallel.
+
+    The kspace cache is off unless SCANHUB_KSPACE_CACHE is set, every input
+    is simulated once and its kspace would only fill the cache directory.
+    """
+    os.environ.setdefault("SCANHUB_KSPACE_CACHE", "off")
+    set_fft_engine(backend, threads=1)
+
+
+def simulate_file(
+    path: str, index: int, sets: list[dict[str, Any]], output: str, precision: str = "single"
+) -> list[dict[str, Any]]:
+    """Simulate the acquisitions of one input with every parameter set.
+
+    The input is opened and transformed once, the pipeline reuses the
+    outputs of the stages whose parameters did not change between sets.
+
+    Parameters
+    ----------
+        path : str
+            input file
+        index : int
+            index of the input, part of the output file names
+        sets : list
+            parameter sets as dicts
+        output : str
+            output directory
+        precision : str
+            "single" or "double"
+
+    Returns
+    -------
+        list: manifest entries of the written files
+    """
+    im = load_manipulators(path, precision)
+    pipeline = KSpacePipeline()
+    stem = f"{index:05d}_{Path(path).stem}"
+    entries = []
+    for set_index, values in enumerate(sets):
+        pipeline.apply(im, KSpaceParameters.from_dict(values), displays=False)
+        name = f"{stem}_p{set_index:04d}"
+        np.save(os.path.join(output, f"{name}_kspace.npy"), im.kspacedata)
+        np.save(os.path.join(output, f"{name}_image.npy"), im.img)
+        entries.append(
+            {"input": path, "parameters": set_index, "kspace": f"{name}_kspace.npy", "image": f"{name}_image.npy"}
+        )
+    return entries
+
+
+def run_batch(
+    inputs: list[str],
+    sets: list[dict[str, Any]],
+    output: str,
+    workers: int | None = None,
+    precision: str = "single",
+    backend: str = "auto",
+) -> dict[str, Any]:
+    """Simulate all inputs in a process pool and write the manifest.
+
+    Parameters
+    ----------
+        inputs : list
+            input files
+        sets : list
+            parameter sets as dicts
+        output : str
+            output directory, created if necessary
+        workers : int
+            number of processes, defaults to the number of CPUs
+        precision : str
+            "single" or "double"
+        backend : str
+            FFT backend of the workers
+
+    Returns
+    -------
+        dict: the manifest (parameter sets, written files and failed inputs)
+    """
+    os.makedirs(output, exist_ok=True)
+    manifest: dict[str, Any] = {"parameters": sets, "outputs": [], "errors": []}
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(backend,)) as executor:
+        futures = {
+            executor.submit(simulate_file, path, index, sets, output, precision): path
+            for index, path in enumerate(inputs)
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            path = futures[future]
+            try:
+                manifest["outputs"] += future.result()
+                log.info(f"[{done}/{len(inputs)}] {path}")
+            except Exception as e:
+                log.error(f"[{done}/{len(inputs)}] {path} failed: {e}")
+                manifest["errors"].append({"input": path, "error": str(e)})
+    manifest["outputs"].sort(key=lambda entry: entry["kspace"])
+    with open(os.path.join(output, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Run the batch simulation with command line arguments.
+
+    Returns
+    -------
+        int: exit code, 1 if an input failed
+    """
+    parser = argparse.ArgumentParser(description="Simulate MRI acquisitions of images and raw data without the GUI.")
+    parser.add_argument("inputs", nargs="+", help="input files, directories or glob patterns (DICOM, images, .npy)")
+    parser.add_argument("-o", "--output", required=True, help="output directory")
+    parser.add_argument("-p", "--params", help="JSON file of kspace parameters (an object or a list of objects)")
+    parser.add_argument("-s", "--sweep", help="JSON file mapping kspace parameters to lists of values")
+    parser.add_argument("-j", "--workers", type=int, help="number of processes (default: number of CPUs)")
+    parser.add_argument("--precision", choices=("single", "double"), default="single")
+    parser.add_argument("--fft-backend", default=os.environ.get("SCANHUB_FFT_BACKEND", "auto"))
+    parser.add_argument("-v", "--verbose", action="store_true", help="log debug messages")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format="%(levelname)s: %(message)s")
+    params = sweep = None
+    try:
+        if args.params:
+            with open(args.params) as f:
+                params = json.load(f)
+        if args.sweep:
+            with open(args.sweep) as f:
+                sweep = json.load(f)
+        sets = parameter_sets(params, sweep)
+    except (OSError, ValueError, TypeError) as e:
+        parser.error(str(e))
+    inputs = find_inputs(args.inputs)
+    if not inputs:
+        parser.error("no input files found")
+
+    log.info(f"Simulating {len(inputs)} inputs with {len(sets)} parameter sets")
+    manifest = run_batch(inputs, sets, args.output, args.workers, args.precision, args.fft_backend)
+    log.info(f"Wrote {len(manifest['outputs'])} simulations, {len(manifest['errors'])} inputs failed")
+    return 1 if manifest["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
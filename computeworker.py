@@ -0,0 +1,124 @@
+# Copyright (C) 2023, BRAIN-LINK UG (haftungsbeschränkt). All Rights Reserved.
+# SPDX-License-Identifier: GPL-3.0-only OR LicenseRef-ScanHub-Commercial
+
+"""Contains the definition of the ComputeWorker class."""
+
+import logging
+import threading
+from typing import NamedTuple
+
+import numpy as np
+from PySide6.QtCore import QObject, Signal
+
+from imagemanipulators import ImageManipulators
+from kspacepipeline import KSpaceParameters, KSpacePipeline
+from thumbnailcache import ThumbnailCache
+
+log = logging.getLogger(__name__)
+
+
+class DisplayFrame(NamedTuple):
+    """Display data computed by the ComputeWorker.
+
+    The arrays are copies of the textures of ImageManipulators, so the GUI
+    can show them while the worker modifies the instance again. Window and
+    kspace scaling are applied by the shaders of the displays.
+    """
+
+    im: ImageManipulators  # instance the frame was computed from
+    image: np.ndarray  # uint16 image texture
+    kspace: np.ndarray  # uint16 log scaled kspace texture
+    kspace_range: np.ndarray  # (min, max) kspace magnitude per slice
+    thumbnails: np.ndarray | None  # uint8 channel previews of a stack
+
+
+class ComputeWorker(QObject):
+    """Runs the kspace pipeline on a background thread.
+
+    Requests are coalesced: submit() replaces a request that has not been
+    started yet, so only the newest parameters are computed and stale ones
+    are dropped. Results are posted to the GUI thread with resultReady.
+    """
+
+    resultReady = Signal(object)
+
+    def __init__(self, pipeline: KSpacePipeline, thumbnails: ThumbnailCache | None = None, parent=None):
+        """Start the worker thread.
+
+        Parameters
+        ----------
+            pipeline : KSpacePipeline
+                pipeline that applies the parameters
+            thumbnails : ThumbnailCache
+                renders the channel previews of stacks (no previews if None)
+            parent : QObject
+                Qt parent object
+        """
+        super(ComputeWorker, self).__init__(parent)
+        self._pipeline = pipeline
+        self._thumbnails = thumbnails
+        self._condition = threading.Condition()
+        self._pending: tuple[ImageManipulators, KSpaceParameters] | None = None
+        self._busy = False
+        self._running = True
+        # Held while a job modifies its ImageManipulators instance
+        self.lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="ComputeWorker", daemon=True)
+        self._thread.start()
+
+    def submit(self, im: ImageManipulators, params: KSpaceParameters):
+        """Request the computation of new display data.
+
+        Parameters
+        ----------
+            im : ImageManipulators
+                image and kspace pair to be modified
+            params : KSpaceParameters
+                modifier and display settings
+        """
+        with self._condition:
+            if self._pending is not None:
+                log.debug("Dropping stale compute request")
+            self._pending = (im, params)
+            self._condition.notify_all()
+
+    def flush(self):
+        """Block until all submitted requests have been computed."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._pending is None and not self._busy)
+
+    def stop(self):
+        """Drop pending requests and stop the worker thread."""
+        with self._condition:
+            self._running = False
+            self._pending = None
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending is not None or not self._running)
+                if not self._running:
+                    return
+                im, params = self._pending  # type: ignore
+                self._pending = None
+                self._busy = True
+
+            try:
+                with self.lock:
+                    self._pipeline.apply(im, params, displays=False)
+                    im.prepare_textures()
+                    previews = None
+                    if self._thumbnails is not None and im.image_texture.ndim > 2:
+                        previews = self._thumbnails.render(im.image_texture)
+                    frame = DisplayFrame(
+                        im, im.image_texture.copy(), im.kspace_texture.copy(), im.kspace_range.copy(), previews
+                    )
+                self.resultReady.emit(frame)
+            except Exception:
+                log.error("Kspace computation failed", exc_info=True)
+            finally:
+                with self._condition:
+                    self._busy = False
+                    self._condition.notify_all()
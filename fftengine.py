@@ -0,0 +1,397 @@
+# Copyright (C) 2023, BRAIN-LINK UG (haftungsbeschränkt). All Rights Reserved.
+# SPDX-License-Identifier: GPL-3.0-only OR LicenseRef-ScanHub-Commercial
+
+"""Contains the definition of the FFTEngine class."""
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# Optional FFT libraries. np.fft is always available as the last resort
+try:
+    import pyfftw  # type: ignore
+except (ModuleNotFoundError, ImportError):
+    pyfftw = None
+
+try:
+    import mkl_fft  # type: ignore
+except (ModuleNotFoundError, ImportError):
+    mkl_fft = None
+
+try:
+    import scipy.fft as scipy_fft  # type: ignore
+except (ModuleNotFoundError, ImportError):
+    scipy_fft = None
+
+# Order of preference when the backend is selected automatically
+BACKENDS = ("pyfftw", "mkl_fft", "scipy", "numpy")
+
+
+class FFTEngine:
+    """Centred 2D FFTs over the last two axes with a selectable backend.
+
+    The transforms are equivalent to fftshift(fft2(ifftshift(x))) without the
+    two shift copies. For even dimensions a shift by half the array size is a
+    multiplication with a (-1)^(row + column) checkerboard in the other domain,
+    so the data is modulated on its way into a reused scratch buffer and the
+    result is modulated on its way into the output array. Odd dimensions fall
+    back to explicit shifts.
+
+    The number of threads is passed to scipy.fft (workers) and pyFFTW, mkl_fft
+    follows the MKL_NUM_THREADS setting of the process. Scratch buffers and
+    pyFFTW plans are kept per calling thread, so transforms of different
+    threads (e.g. the compute worker and the prefetcher) run concurrently.
+    """
+
+    _max_cached = 8  # checkerboards per engine, scratch buffers and pyFFTW plans per thread
+
+    def __init__(self, backend: str = "auto", threads: int | None = None, planner_effort: str = "FFTW_ESTIMATE"):
+        """Select the FFT backend.
+
+        Parameters
+        ----------
+            backend : str
+                "auto", "pyfftw", "mkl_fft", "scipy" or "numpy"
+            threads : int
+                number of FFT threads, defaults to the number of CPUs
+            planner_effort : str
+                pyFFTW planner flag, e.g. "FFTW_ESTIMATE" or "FFTW_MEASURE". MEASURE
+                finds faster plans but takes up to seconds for every new shape
+        """
+        self._backend = self._select_backend(backend)
+        self._threads = threads or os.cpu_count() or 1
+        self._planner_effort = planner_effort
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._checkerboards: OrderedDict[Any, tuple[np.ndarray, np.ndarray]] = OrderedDict()
+        self._generation = 0  # Incremented when the pyFFTW plans of all threads become invalid
+        log.info(f"FFT engine initialised: {self}")
+
+    def __repr__(self) -> str:
+        """Return the backend and thread count, e.g. for the log file."""
+        return f"FFTEngine(backend={self._backend!r}, threads={self._threads})"
+
+    @property
+    def backend(self) -> str:
+        """Name of the active FFT backend."""
+        return self._backend
+
+    @property
+    def threads(self) -> int:
+        """Number of threads used by the backend."""
+        return self._threads
+
+    @threads.setter
+    def threads(self, threads: int | None):
+        with self._lock:
+            self._threads = threads or os.cpu_count() or 1
+            self._generation += 1  # pyFFTW plans are bound to a thread count
+
+    @staticmethod
+    def available_backends() -> list[str]:
+        """List the installed backends in order of preference.
+
+        Returns
+        -------
+            list: backend names
+        """
+        modules = {"pyfftw": pyfftw, "mkl_fft": mkl_fft, "scipy": scipy_fft, "numpy": np.fft}
+        return [name for name in BACKENDS if modules[name] is not None]
+
+    def _select_backend(self, backend: str) -> str:
+        available = self.available_backends()
+        if backend == "auto":
+            return available[0]
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown FFT backend: {backend}")
+        if backend not in available:
+            raise ValueError(f"FFT backend is not installed: {backend}")
+        return backend
+
+    def fft2c(self, data: np.ndarray, out: np.ndarray):
+        """Centred forward FFT (image to kspace).
+
+        Real input with even dimensions is transformed with rfft2 and the
+        second half of kspace is rebuilt from conjugate symmetry.
+
+        Parameters
+        ----------
+            data : np.ndarray
+                real or complex input, transformed over the last two axes
+            out : np.ndarray
+                complex array to store the result (same shape as data)
+        """
+        if np.iscomplexobj(data):
+            self._centred(data, out, inverse=False, magnitude=False)
+        else:
+            self._centred_real_forward(data, out)
+
+    def ifft2c(self, data: np.ndarray, out: np.ndarray):
+        """Centred inverse FFT (kspace to complex image).
+
+        Parameters
+        ----------
+            data : np.ndarray
+                complex kspace, transformed over the last two axes
+            out : np.ndarray
+                complex array to store the result (same shape as data)
+        """
+        self._centred(data, out, inverse=True, magnitude=False)
+
+    def ifft2c_abs(self, data: np.ndarray, out: np.ndarray, hermitian: bool = False):
+        """Centred inverse FFT followed by the magnitude (kspace to image).
+
+        The output modulation only flips signs, so it is skipped entirely.
+        Conjugate symmetric kspace (the transform of a real image) only needs
+        its first half, which irfft2 turns into the real image directly.
+
+        Parameters
+        ----------
+            data : np.ndarray
+                complex kspace, transformed over the last two axes
+            out : np.ndarray
+                real array to store the magnitude (same shape as data)
+            hermitian : bool
+                True if data is known to be conjugate symmetric
+        """
+        if hermitian:
+            self._centred_real_inverse(data, out)
+        else:
+            self._centred(data, out, inverse=True, magnitude=True)
+
+    def ifft1c(self, data: np.ndarray) -> np.ndarray:
+        """Centred inverse FFT over the last axis only (e.g. of a few kspace lines).
+
+        The arrays are small, so the shifts are explicit and neither plans nor
+        scratch buffers are kept.
+
+        Parameters
+        ----------
+            data : np.ndarray
+                complex input, transformed over the last axis
+
+        Returns
+        -------
+            np.ndarray: the transformed data
+        """
+        ctype = np.result_type(data.dtype, np.complex64)
+        buf = np.fft.ifftshift(data, axes=-1)
+        if self._backend == "scipy":
+            res = scipy_fft.ifft(buf, axis=-1, workers=self._threads, overwrite_x=True)
+        elif self._backend == "mkl_fft":
+            res = mkl_fft.ifft(buf, axis=-1, overwrite_x=True)
+        else:
+            res = np.fft.ifft(buf, axis=-1)
+        return np.fft.fftshift(res, axes=-1).astype(ctype, copy=False)
+
+    def _centred(self, data: np.ndarray, out: np.ndarray, inverse: bool, magnitude: bool):
+        ctype = np.result_type(data.dtype, np.complex64)
+        checkerboards = self._checkerboard(data.shape[-2:], ctype)
+        kind = "inverse" if inverse else "forward"
+        with self._scratch(data.shape, ctype, kind) as buf:
+            if checkerboards is None:
+                buf[...] = np.fft.ifftshift(data, axes=(-2, -1))
+            else:
+                np.multiply(data, checkerboards[0], out=buf)
+
+            res = self._execute(buf, kind)
+
+            if checkerboards is None:
+                res = np.fft.fftshift(res, axes=(-2, -1))
+                if magnitude:
+                    np.absolute(res, out=out)
+                else:
+                    out[...] = res
+            elif magnitude:
+                np.absolute(res, out=out)
+            else:
+                np.multiply(res, checkerboards[1], out=out)
+
+    def _centred_real_forward(self, data: np.ndarray, out: np.ndarray):
+        ctype = np.result_type(data.dtype, np.complex64)
+        checkerboards = self._checkerboard(data.shape[-2:], ctype)
+        if checkerboards is None:
+            self._centred(data, out, inverse=False, magnitude=False)
+            return
+
+        chk, chk_out = checkerboards
+        rows, cols = data.shape[-2:]
+        half = cols // 2 + 1
+        with self._scratch(data.shape, chk.dtype, "real_forward") as buf:
+            np.multiply(data, chk, out=buf)
+            res = self._execute(buf, "real_forward")
+
+            # F[i, j] = conj(F[-i, -j]) fills the columns that rfft2 omits
+            np.multiply(res, chk_out[:, :half], out=out[..., :half])
+            mirror = res[..., (-np.arange(rows)) % rows, half - 2 : 0 : -1]
+            np.conjugate(mirror, out=out[..., half:])
+            out[..., half:] *= chk_out[:, half:]
+
+    def _centred_real_inverse(self, data: np.ndarray, out: np.ndarray):
+        ctype = np.result_type(data.dtype, np.complex64)
+        checkerboards = self._checkerboard(data.shape[-2:], ctype)
+        if checkerboards is None:
+            self._centred(data, out, inverse=True, magnitude=True)
+            return
+
+        chk = checkerboards[0]
+        half = data.shape[-1] // 2 + 1
+        with self._scratch(data.shape[:-1] + (half,), ctype, "real_inverse") as buf:
+            np.multiply(data[..., :half], chk[:, :half], out=buf)
+            np.absolute(self._execute(buf, "real_inverse"), out=out)
+
+    def _checkerboard(self, shape: tuple[int, ...], ctype: np.dtype) -> tuple[np.ndarray, np.ndarray] | None:
+        """Return the input and output modulation arrays, None for odd shapes."""
+        rows, cols = shape
+        if rows % 2 or cols % 2:
+            return None
+        key = (rows, cols, ctype)
+        with self._lock:
+            if key in self._checkerboards:
+                self._checkerboards.move_to_end(key)
+                return self._checkerboards[key]
+
+        dtype = np.empty(0, ctype).real.dtype
+        chk = np.ones((rows, cols), dtype=dtype)
+        chk[1::2, ::2] = -1
+        chk[::2, 1::2] = -1
+        # The shifts leave a global sign of (-1)^(rows/2 + cols/2) behind
+        chk_out = -chk if (rows // 2 + cols // 2) % 2 else chk
+
+        with self._lock:
+            self._checkerboards[key] = (chk, chk_out)
+            while len(self._checkerboards) > self._max_cached:
+                self._checkerboards.popitem(last=False)
+        return chk, chk_out
+
+    @contextmanager
+    def _scratch(self, shape: tuple[int, ...], dtype: np.dtype, kind: str) -> Iterator[np.ndarray]:
+        """Provide the input buffer that the backend transforms.
+
+        pyFFTW plans own aligned input and output arrays, the plans of the
+        calling thread provide them. The other backends use buffers per thread.
+        """
+        if self._backend == "pyfftw":
+            yield self._plan(shape, dtype, kind).input_array
+            return
+
+        buffers = getattr(self._local, "buffers", None)
+        if buffers is None:
+            buffers = self._local.buffers = {}
+        key = (shape, dtype)
+        if key not in buffers:
+            if len(buffers) >= self._max_cached:
+                buffers.clear()
+            buffers[key] = np.empty(shape, dtype=dtype)
+        yield buffers[key]
+
+    def _plan(self, shape: tuple[int, ...], dtype: np.dtype, kind: str) -> Any:
+        """Return a cached pyFFTW plan of the calling thread for the input shape."""
+        plans = getattr(self._local, "plans", None)
+        if plans is None or self._local.generation != self._generation:
+            plans = self._local.plans = OrderedDict()
+            self._local.generation = self._generation
+        key = (shape, np.dtype(dtype), kind)
+        if key in plans:
+            plans.move_to_end(key)
+            return plans[key]
+
+        log.debug(f"Planning pyFFTW transform: {key}")
+        if kind == "real_forward":
+            out_shape = shape[:-1] + (shape[-1] // 2 + 1,)
+            out_dtype = np.result_type(dtype, np.complex64)
+        elif kind == "real_inverse":
+            out_shape = shape[:-1] + (2 * (shape[-1] - 1),)
+            out_dtype = np.empty(0, dtype).real.dtype
+        else:
+            out_shape, out_dtype = shape, dtype
+
+        plan = pyfftw.FFTW(
+            pyfftw.empty_aligned(shape, dtype=dtype),
+            pyfftw.empty_aligned(out_shape, dtype=out_dtype),
+            axes=(-2, -1),
+            direction="FFTW_BACKWARD" if kind in ("inverse", "real_inverse") else "FFTW_FORWARD",
+            flags=(self._planner_effort,),
+            threads=self._threads,
+        )
+        plans[key] = plan
+        while len(plans) > self._max_cached:
+            plans.popitem(last=False)
+        return plan
+
+    def _execute(self, buf: np.ndarray, kind: str) -> np.ndarray:
+        """Run the unshifted transform of buf, which may be overwritten."""
+        if self._backend == "pyfftw":
+            return self._local.plans[(buf.shape, buf.dtype, kind)]()
+
+        if kind == "real_inverse":
+            shape = buf.shape[-2:-1] + (2 * (buf.shape[-1] - 1),)
+            if self._backend == "scipy":
+                return scipy_fft.irfft2(buf, s=shape, workers=self._threads, overwrite_x=True)
+            return np.fft.irfft2(buf, s=shape)  # mkl_fft has no stable real transform API
+        if kind == "real_forward":
+            if self._backend == "scipy":
+                return scipy_fft.rfft2(buf, workers=self._threads, overwrite_x=True)
+            return np.fft.rfft2(buf)
+
+        inverse = kind == "inverse"
+        if self._backend == "scipy":
+            func = scipy_fft.ifft2 if inverse else scipy_fft.fft2
+            return func(buf, workers=self._threads, overwrite_x=True)
+        if self._backend == "mkl_fft":
+            func = mkl_fft.ifft2 if inverse else mkl_fft.fft2
+            return func(buf, overwrite_x=True)
+        return np.fft.ifft2(buf) if inverse else np.fft.fft2(buf)
+
+
+_engine: FFTEngine | None = None
+_engine_lock = threading.Lock()
+
+
+def get_fft_engine() -> FFTEngine:
+    """Return the FFT engine shared by the application.
+
+    The engine is created on first use. SCANHUB_FFT_BACKEND selects the
+    backend and SCANHUB_FFT_THREADS the number of threads.
+
+    Returns
+    -------
+        FFTEngine: the shared engine
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            threads = os.environ.get("SCANHUB_FFT_THREADS")
+            _engine = FFTEngine(
+                backend=os.environ.get("SCANHUB_FFT_BACKEND", "auto"),
+                threads=int(threads) if threads else None,
+            )
+        return _engine
+
+
+def set_fft_engine(backend: str = "auto", threads: int | None = None) -> FFTEngine:
+    """Replace the FFT engine shared by the application.
+
+    Parameters
+    ----------
+        backend : str
+            "auto", "pyfftw", "mkl_fft", "scipy" or "numpy"
+        threads : int
+            number of FFT threads, defaults to the number of CPUs
+
+    Returns
+    -------
+        FFTEngine: the new engine
+    """
+    global _engine
+    engine = FFTEngine(backend=backend, threads=threads)
+    with _engine_lock:
+        _engine = engine
+    return engine
@@ -0,0 +1,198 @@
+# Copyright (C) 2023, BRAIN-LINK UG (haftungsbeschränkt). All Rights Reserved.
+# SPDX-License-Identifier: GPL-3.0-only OR LicenseRef-ScanHub-Commercial
+
+"""Contains the file format detection and the loaders of images and raw data.
+
+Raw data is memory mapped, but the working arrays of ImageManipulators hold
+all channels: every modifier runs over the whole stack and all channels are
+reconstructed for the thumbnails, so channels are not materialised lazily.
+"""
+
+import logging
+import os
+from typing import Callable
+
+import numpy as np
+import pydicom
+from PIL import Image, UnidentifiedImageError
+
+log = logging.getLogger(__name__)
+
+# (offset, magic bytes, format) checked in order against the start of a file
+SIGNATURES = [
+    (128, b"DICM", "dicom"),  # After the 128 byte DICOM preamble
+    (0, b"\x93NUMPY", "npy"),
+    (0, b"PK\x03\x04", "npz"),  # .npz files are zip archives
+    (0, b"\x89PNG\r\n\x1a\n", "image"),
+    (0, b"II*\x00", "image"),  # Little endian TIFF
+    (0, b"MM\x00*", "image"),  # Big endian TIFF
+    (0, b"\xff\xd8\xff", "image"),  # JPEG
+    (0, b"BM", "image"),
+]
+# Formats of files without a known signature, e.g. DICOM without preamble,
+# other files are tried with every loader (see load_unknown)
+EXTENSIONS = {".dcm": "dicom", ".dicom": "dicom", ".npy": "npy", ".npz": "npz"}
+
+
+def sniff(path: str) -> str:
+    """Detect the format of a file from its first bytes or its extension.
+
+    Parameters
+    ----------
+        path : str
+            file location
+
+    Returns
+    -------
+        str: "dicom", "npy", "npz", "image" or "unknown"
+    """
+    with open(path, "rb") as f:
+        header = f.read(132)
+    for offset, magic, kind in SIGNATURES:
+        if header[offset : offset + len(magic)] == magic:
+            return kind
+    return EXTENSIONS.get(os.path.splitext(path)[1].lower(), "unknown")
+
+
+def load_image(path: str, dtype: np.dtype) -> np.ndarray:
+    """Load an image with PIL, converted to grayscale.
+
+    Parameters
+    ----------
+        path : str
+            file location
+        dtype : np.dtype
+            dtype of the returned array
+
+    Returns
+    -------
+        np.ndarray: 2D pixel data
+    """
+    try:
+        with Image.open(path) as f:
+            return np.array(f.convert("F"), dtype=dtype)  # 'F' mode: 32-bit floating point pixels
+    except UnidentifiedImageError as e:
+        raise ValueError(f"Unknown file format: {path}") from e
+
+
+def load_dicom(path: str, dtype: np.dtype) -> np.ndarray:
+    """Load the pixel data of a DICOM file.
+
+    Parameters
+    ----------
+        path : str
+            file location
+        dtype : np.dtype
+            dtype of the returned array
+
+    Returns
+    -------
+        np.ndarray: 2D pixel data
+    """
+    with pydicom.dcmread(path, force=True) as dcm_file:
+        return np.array(dcm_file.pixel_array, dtype=dtype)
+
+
+def load_npy(path: str, dtype: np.dtype) -> np.ndarray:
+    """Memory map raw data stored with np.save.
+
+    The data is not read until it is used. ImageManipulators keeps the
+    mapping as its original kspace when the dtype matches its precision,
+    only the working copy is read into memory. The dtype is kept as stored.
+
+    Parameters
+    ----------
+        path : str
+            file location
+        dtype : np.dtype
+            unused, raw data keeps its dtype
+
+    Returns
+    -------
+        np.ndarray: read-only memory mapped array
+    """
+    return np.load(path, mmap_mode="r")
+
+
+def load_npz(path: str, dtype: np.dtype) -> np.ndarray:
+    """Load the first array of an archive stored with np.savez.
+
+    Only the archive's directory is read when it is opened, the other
+    arrays are never loaded. The dtype is kept as stored.
+
+    Parameters
+    ----------
+        path : str
+            file location
+        dtype : np.dtype
+            unused, raw data keeps its dtype
+
+    Returns
+    -------
+        np.ndarray: the first array
+    """
+    with np.load(path) as archive:
+        if not archive.files:
+            raise ValueError(f"Empty archive: {path}")
+        return archive[archive.files[0]]
+
+
+def load_unknown(path: str, dtype: np.dtype) -> np.ndarray:
+    """Load a file without a known signature or extension.
+
+    PIL, pydicom (e.g. DICOM without preamble) and np.load are tried in
+    this order.
+
+    Parameters
+    ----------
+        path : str
+            file location
+        dtype : np.dtype
+            dtype of images, raw data keeps its dtype
+
+    Returns
+    -------
+        np.ndarray: the pixel data or raw kspace
+    """
+    try:
+        return load_image(path, dtype)
+    except ValueError:
+        log.info("Filetype is not recognised by PIL. Trying pydicom.")
+    try:
+        return load_dicom(path, dtype)
+    except Exception:  # pydicom raises anything for files that are no DICOM
+        log.info("Cannot open with pydicom. Trying to open as raw data.")
+    try:
+        return load_npy(path, dtype)
+    except (OSError, ValueError) as e:
+        raise ValueError(f"Unknown file format: {path}") from e
+
+
+LOADERS: dict[str, Callable[[str, np.dtype], np.ndarray]] = {
+    "dicom": load_dicom,
+    "npy": load_npy,
+    "npz": load_npz,
+    "image": load_image,
+    "unknown": load_unknown,
+}
+
+
+def load(path: str, dtype: np.dtype = np.float32) -> np.ndarray:  # type: ignore
+    """Load image or raw data with the loader of the file's format.
+
+    Parameters
+    ----------
+        path : str
+            file location
+        dtype : np.dtype
+            dtype of images, raw data keeps its dtype
+
+    Returns
+    -------
+        np.ndarray: the pixel data or raw kspace
+    """
+    kind = sniff(path)
+    log.info(f"Opening file: {path} ({kind})")
+    data = LOADERS[kind](path, dtype)
+    log.info(f"Data loaded. Data size: {data.shape}")
+    return data
@@ -0,0 +1,214 @@
+# Copyright (C) 2023, BRAIN-LINK UG (haftungsbeschränkt). All Rights Reserved.
+# SPDX-License-Identifier: GPL-3.0-only OR LicenseRef-ScanHub-Commercial
+
+"""Contains the non-Cartesian trajectories and the GriddingOperator class."""
+
+from typing import NamedTuple
+
+import numpy as np
+
+from maskcache import MaskCache
+
+OVERSAMPLING = 2  # Grid oversampling factor
+KERNEL_WIDTH = 4  # Kaiser-Bessel kernel width in oversampled grid points
+# Beatty et al. 2005
+KERNEL_BETA = np.pi * np.sqrt((KERNEL_WIDTH / OVERSAMPLING * (OVERSAMPLING - 0.5)) ** 2 - 0.8)
+DCF_ITERATIONS = 12
+READOUT_SPACING = 0.5  # Grid points between samples (two times oversampled readout)
+SPIRAL_TURN_SPACING = 0.8  # Grid points between spiral turns (a bit denser than Nyquist)
+GOLDEN_ANGLE = np.pi * (np.sqrt(5) - 1) / 2  # 111.25°, for spokes through the centre
+
+# The operators take hundreds of MB from 1024² on and would flush the masks of
+# mask_cache, so they get their own cache. It keeps the most recent operator
+# whatever its size, otherwise a large one is rebuilt on every call.
+operator_cache = MaskCache(max_entries=2, max_bytes=512 * 2**20)
+
+
+def spiral_trajectory(shape: tuple[int, ...]) -> np.ndarray:
+    """Archimedean spiral from the kspace centre outwards.
+
+    The turns are SPIRAL_TURN_SPACING grid points apart and the samples are
+    spaced READOUT_SPACING grid points along the spiral.
+
+    Parameters
+    ----------
+        shape : tuple
+            kspace shape (rows, columns)
+
+    Returns
+    -------
+        np.ndarray: (samples, 2) array of (row, column) positions relative to
+        the kspace centre, in grid points
+    """
+    rows, cols = shape
+    kmax = max(rows, cols) / 2
+    a = SPIRAL_TURN_SPACING / (2 * np.pi)  # Radius increment per radian
+    length = kmax**2 / (2 * a)  # Arc length a * theta**2 / 2 up to the radius kmax
+    arc = (np.arange(int(np.ceil(length / READOUT_SPACING))) + 0.5) * READOUT_SPACING
+    theta = np.sqrt(2 * arc / a)
+    radius = a * theta
+    return np.stack((radius * np.sin(theta) * rows / (2 * kmax), radius * np.cos(theta) * cols / (2 * kmax)), axis=1)
+
+
+def radial_trajectory(shape: tuple[int, ...]) -> np.ndarray:
+    """Radial spokes through the kspace centre in golden angle order.
+
+    Every prefix of the spokes covers kspace almost uniformly, and π/2 times
+    the matrix size spokes fulfil the Nyquist criterion at the edge. The
+    samples are READOUT_SPACING grid points apart along a spoke.
+
+    Parameters
+    ----------
+        shape : tuple
+            kspace shape (rows, columns)
+
+    Returns
+    -------
+        np.ndarray: (samples, 2) array of (row, column) positions relative to
+        the kspace centre, in grid points, spoke by spoke
+    """
+    rows, cols = shape
+    size = max(rows, cols)
+    angles = np.arange(int(np.ceil(np.pi / 2 * size))) * GOLDEN_ANGLE
+    readout = int(size / READOUT_SPACING)
+    t = (np.arange(readout) - readout // 2) / readout
+    ky = np.outer(np.sin(angles), t) * rows
+    kx = np.outer(np.cos(angles), t) * cols
+    return np.stack((ky.ravel(), kx.ravel()), axis=1)
+
+
+TRAJECTORIES = {"spiral": spiral_trajectory, "radial": radial_trajectory}
+
+
+def kaiser_bessel(u: np.ndarray) -> np.ndarray:
+    """Kaiser-Bessel kernel at distance u (in grid points) from a sample."""
+    x = np.clip(1 - (2 * u / KERNEL_WIDTH) ** 2, 0, None)
+    return np.where(np.abs(u) < KERNEL_WIDTH / 2, np.i0(KERNEL_BETA * np.sqrt(x)), 0)
+
+
+def apodization(n: int) -> np.ndarray:
+    """Fourier transform of the Kaiser-Bessel kernel over an image axis of n pixels.
+
+    The image is the centre of the oversampled field of view, the transform
+    is normalised to one at the image centre.
+    """
+    x = (np.arange(n) - n // 2) / (OVERSAMPLING * n)
+    z = np.sqrt((np.pi * KERNEL_WIDTH * x) ** 2 - KERNEL_BETA**2 + 0j)
+    c = (np.sin(z) / z).real
+    return c / c[n // 2]
+
+
+class GriddingOperator(NamedTuple):
+    """Interpolation between a non-Cartesian trajectory and the oversampled kspace grid.
+
+    The sparse interpolation matrix G has a fixed number of entries per
+    sample (KERNEL_WIDTH² grid points), so it is stored as a column index and
+    a weight array with one row per sample, and a prefix of the trajectory is
+    a prefix of the rows. Sampling is G k, gridding is G^T (dcf * s).
+
+    Both operate on the kspace of the image zero padded to OVERSAMPLING times
+    its size. Convolving kspace with the kernel multiplies the image with the
+    kernel's transform, so the image is divided by `apodization` before
+    sampling and again after gridding.
+    """
+
+    indices: np.ndarray  # (samples, KERNEL_WIDTH²) flat oversampled grid indices
+    weights: np.ndarray  # (samples, KERNEL_WIDTH²) interpolation weights
+    dcf: np.ndarray  # (samples,) density compensation
+    apodization: np.ndarray  # (rows, columns) kernel transform over the image
+
+    @property
+    def samples(self) -> int:
+        """Number of samples of the trajectory."""
+        return len(self.dcf)
+
+    def sample(self, kspace: np.ndarray, n: int) -> np.ndarray:
+        """Interpolate the first n trajectory samples from Cartesian kspace.
+
+        Parameters
+        ----------
+            kspace : np.ndarray
+                C-contiguous complex oversampled kspace, over the last two axes
+            n : int
+                number of samples
+
+        Returns
+        -------
+            np.ndarray: (..., n) complex samples
+        """
+        grid = kspace.reshape(kspace.shape[:-2] + (-1,))
+        return np.einsum("...ij,ij->...i", grid[..., self.indices[:n]], self.weights[:n])
+
+    def grid(self, samples: np.ndarray, start: int, stop: int, out: np.ndarray):
+        """Density compensate samples and add them to the grid.
+
+        Parameters
+        ----------
+            samples : np.ndarray
+                (..., n) complex samples of the trajectory points
+            start : int
+                first sample to add
+            stop : int
+                end of the samples to add, the samples stop:start are
+                subtracted instead if stop < start
+            out : np.ndarray
+                C-contiguous complex oversampled kspace to add the result to
+        """
+        sign = 1 if stop >= start else -1
+        start, stop = min(start, stop), max(start, stop)
+        size = out.shape[-2] * out.shape[-1]
+        indices = self.indices[start:stop].ravel()
+        contributions = (samples[..., start:stop] * (sign * self.dcf[start:stop]))[..., None] * self.weights[start:stop]
+        flat = out.reshape(out.shape[:-2] + (-1,))
+        for index in np.ndindex(out.shape[:-2]):
+            values = contributions[index].ravel()
+            flat[index].real += np.bincount(indices, values.real, size)
+            flat[index].imag += np.bincount(indices, values.imag, size)
+
+
+def gridding_operator(shape: tuple[int, ...], trajectory: str) -> GriddingOperator:
+    """Return the cached gridding operator of a trajectory.
+
+    Parameters
+    ----------
+        shape : tuple
+            image shape (rows, columns) before oversampling
+        trajectory : str
+            "spiral" or "radial"
+
+    Returns
+    -------
+        GriddingOperator: the (read-only) operator
+    """
+
+    def factory():
+        rows, cols = OVERSAMPLING * shape[0], OVERSAMPLING * shape[1]
+        coords = OVERSAMPLING * TRAJECTORIES[trajectory](shape) + (rows // 2, cols // 2)
+
+        # Grid points within half a kernel width of every sample, per axis
+        offsets = np.arange(KERNEL_WIDTH) - (KERNEL_WIDTH // 2 - 1)
+        axis_indices, axis_weights = [], []
+        for axis, n in enumerate((rows, cols)):
+            points = np.floor(coords[:, axis])[:, None] + offsets
+            axis_weights.append(kaiser_bessel(points - coords[:, axis, None]))
+            axis_indices.append(points.astype(np.intp) % n)
+
+        indices = (axis_indices[0][:, :, None] * cols + axis_indices[1][:, None, :]).reshape(len(coords), -1)
+        weights = (axis_weights[0][:, :, None] * axis_weights[1][:, None, :]).reshape(len(coords), -1)
+        weights /= weights.sum(axis=1).mean()
+
+        # Pipe and Menon 1999: iterate until the gridded density is one at every sample
+        dcf = np.ones(len(coords))
+        for _ in range(DCF_ITERATIONS):
+            density = np.bincount(indices.ravel(), (dcf[:, None] * weights).ravel(), rows * cols)
+            dcf /= (density[indices] * weights).sum(axis=1)
+
+        apod = np.outer(apodization(shape[0]), apodization(shape[1]))
+        return GriddingOperator(
+            indices.astype(np.int32),
+            weights.astype(np.float32),
+            dcf.astype(np.float32),
+            apod.astype(np.float32),
+        )
+
+    return operator_cache.get((tuple(shape), "gridding", trajectory), factory)
@@ -3,22 +3,43 @@
 
 """Contains the definition of the ImageManipulators class."""
 
+from typing import Any, Callable, NamedTuple
+
 import numpy as np
-from numpy.typing import _ShapeLike  # type: ignore
-from typing import Any
+import numpy.typing as npt
+
+from fftengine import get_fft_engine
+from gridding import OVERSAMPLING, gridding_operator
+from kspacecache import get_kspace_cache
+from maskcache import mask_cache
+from noiseengine import get_noise_engine
+from sharedarrays import ArrayDescriptor, SharedArrays
+
+# Real and complex dtypes of the working arrays
+PRECISIONS = {"single": (np.float32, np.complex64), "double": (np.float64, np.complex128)}
+TEXTURE_MAX = 65535  # The display textures are 16 bit grayscale images
+# Decades of kspace magnitude below the maximum that the logarithmic kspace
+# texture covers, must match DECADES in views/shaders/gammaadjust.frag
+KSPACE_TEXTURE_DECADES = 16
 
-# Attempting to use mkl_fft (faster FFT library for Intel CPUs). Fallback is np
-try:
-    import mkl_fft as m  # type: ignore
 
-    fft2 = m.fft2
-    ifft2 = m.ifft2
-except (ModuleNotFoundError, ImportError):
-    fft2 = np.fft.fft2
-    ifft2 = np.fft.ifft2
-finally:
-    fftshift = np.fft.fftshift
-    ifftshift = np.fft.ifftshift
+class Stage(NamedTuple):
+    """A kspace modifier step of the ImageManipulators pipeline.
+
+    The stage calls func(kspace, *params), which modifies kspace in place.
+    The name and parameters identify the output of the stage, so they must
+    not be mutated after the stage has been created.
+    """
+
+    name: str
+    func: Callable[..., None]
+    params: tuple = ()
+    hermitian: bool = True  # Keeps conjugate symmetric kspace symmetric
+
+    @property
+    def key(self) -> tuple:
+        """Fingerprint of the stage."""
+        return (self.name, self.params)
 
 
 class ImageManipulators:
@@ -27,50 +48,175 @@ class ImageManipulators:
     This class will load the specified image or raw data and performs any
     actions that modify the image or kspace data. A new instance should be
     initialized for new images.
+
+    The data can also be a stack of 2D slices, e.g. the channels of a
+    multi-coil acquisition with shape (channels, rows, columns). All modifiers
+    and FFTs then work on the last two axes of the whole stack at once.
+
+    All working arrays use the dtypes of one precision (see PRECISIONS). The
+    input is converted once when it is loaded and no step upcasts it.
+
+    With a SharedArrays allocator the arrays listed in SHARED_ARRAYS are
+    allocated in shared memory, other processes attach to them with the
+    descriptors of shared_descriptors. Resizing (undersampling with
+    compression, trajectories) moves the arrays to new blocks.
     """
 
-    def __init__(self, pixel_data: np.ndarray, is_image: bool = True):
+    SHARED_ARRAYS = (
+        "img",
+        "kspacedata",
+        "orig_kspacedata",
+        "kspace_abs",
+        "image_display_data",
+        "kspace_display_data",
+        "image_texture",
+        "kspace_texture",
+        "kspace_range",
+    )
+
+    # Non-Cartesian filling modes and their trajectories (see gridding.py)
+    trajectories = {3: "spiral", 5: "radial"}
+
+    def __init__(
+        self,
+        pixel_data: np.ndarray,
+        is_image: bool = True,
+        precision: str = "single",
+        shared: SharedArrays | None = None,
+    ):
         """Open the image and initializing variables based on image size.
 
         Parameters
         ----------
             pixel_data : np.ndarray
-                2D pixel data of image or kspace
+                2D pixel data of image or kspace, or a stack of them
             is_image : bool
                 True if the data is an Image, false if raw data
+            precision : str
+                "single" (float32/complex64) or "double" (float64/complex128)
+            shared : SharedArrays
+                allocates the SHARED_ARRAYS in shared memory, None for private arrays
         """
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision: {precision}")
+        self.precision = precision
+        self._shared = shared
+        real, complex_ = PRECISIONS[precision]
         if is_image:
-            self.img = pixel_data.copy()
-            self.kspacedata = np.zeros_like(self.img, dtype=np.complex64)
+            self.img = self._array(pixel_data, real)
+            self.kspacedata = self._zeros(self.img.shape, complex_)
+            self.orig_kspacedata = self._zeros(self.kspacedata.shape, complex_)
         else:
-            self.kspacedata = pixel_data.copy()
-            self.img = np.zeros_like(self.kspacedata, dtype=np.float32)
-
-        self.image_display_data = np.require(self.img, np.uint8, "C")
-        self.kspace_display_data = np.zeros_like(self.image_display_data)
-        self.orig_kspacedata = np.zeros_like(self.kspacedata)
-        self.kspace_abs = np.zeros_like(self.kspacedata, dtype=np.float32)
-        self.noise_map = np.zeros_like(self.kspace_abs)
-        self.signal_to_noise = 30
+            # Memory mapped raw data stays mapped, only the working copy is read into memory
+            self.orig_kspacedata = self._readonly(pixel_data, complex_)
+            self.kspacedata = self._array(self.orig_kspacedata, complex_)
+            self.img = self._zeros(self.kspacedata.shape, real)
+
+        self.image_display_data = self._zeros(self.img.shape, np.uint8)
+        self.kspace_display_data = self._zeros(self.img.shape, np.uint8)
+        self.kspace_abs = self._zeros(self.img.shape, real)
+        self._display_scratch = np.zeros_like(self.img)
+        # 16 bit textures of the user interface, windowed by its shaders
+        self.image_texture = self._zeros(self.img.shape, np.uint16)
+        self.kspace_texture = self._zeros(self.img.shape, np.uint16)
+        self.kspace_range = self._zeros(self.img.shape[:-2] + (2,), np.float64)  # (min, max) magnitude per slice
+        self._mean_signal: np.ndarray | None = None  # of the original kspace, per slice
+        self._noise_scratch: np.ndarray | None = None  # scaled noise of apply_noise
         self.spikes: list[tuple[int, int]] = []
         self.patches: list[tuple[int, int, int]] = []
-
-        if is_image:
-            self.np_fft(self.img, self.kspacedata)
+        # The kspace of a real image is conjugate symmetric (Hermitian)
+        self.hermitian = is_image
+        # Stage keys and outputs of the last apply_stages call
+        self._stage_cache: list[list[Any]] = []
+        # Complex image of the last filling step and what it was computed from
+        self._filling_key: tuple | None = None
+        self._filling_samples = 0
+        self._filling_image: np.ndarray | None = None
+        # Trajectory samples and oversampled grid of the last trajectory_filling call
+        self._gridding_key: tuple | None = None
+        self._gridding_samples: np.ndarray | None = None
+        self._gridding_grid: np.ndarray | None = None
+        self._gridding_acquired = 0
+
+        # The kspace of an image is memory mapped from the disk cache if it
+        # has been transformed before
+        cache = get_kspace_cache() if is_image else None
+        key = cache.key(self.img, complex_) if cache else ""
+        cached = cache.load(key) if cache else None
+        if cached is not None and cached.shape == self.kspacedata.shape and cached.dtype == complex_:
+            self.kspacedata[:] = cached
+            if shared is None:
+                self.orig_kspacedata = cached  # Read-only
+            else:
+                self.orig_kspacedata[:] = cached
+                self.orig_kspacedata.setflags(write=False)
         else:
-            self.np_ifft(self.kspacedata, self.img)
-
-        self.orig_kspacedata[:] = self.kspacedata  # Store data write-protected
-        self.orig_kspacedata.setflags(write=False)
+            if is_image:
+                self.np_fft(self.img, self.kspacedata)
+                self.orig_kspacedata[:] = self.kspacedata  # Store data write-protected
+                self.orig_kspacedata.setflags(write=False)
+            else:
+                self.np_ifft(self.kspacedata, self.img)
+            if cache:
+                cache.store(key, self.orig_kspacedata)
 
         self.prepare_displays()
 
+    def _zeros(self, shape: tuple[int, ...], dtype: npt.DTypeLike) -> np.ndarray:
+        """Allocate a working array, in shared memory if the instance has an allocator."""
+        if self._shared is None:
+            return np.zeros(shape, dtype=dtype)
+        return self._shared.zeros(shape, dtype)
+
+    def _array(self, data: np.ndarray, dtype: npt.DTypeLike) -> np.ndarray:
+        """Copy data into a working array, in shared memory if the instance has an allocator."""
+        if self._shared is None:
+            return np.array(data, dtype=dtype, order="C")
+        return self._shared.array(data, dtype)
+
+    def _readonly(self, data: np.ndarray, dtype: npt.DTypeLike) -> np.ndarray:
+        """Return data as a read-only array of dtype.
+
+        Read-only C-contiguous data of the dtype, e.g. raw data memory mapped
+        by fileloaders.load_npy, is used without copying it, so its pages
+        are only read when they are used and the OS can drop them again.
+        Other data (and all data of a shared instance) is copied by _array.
+        """
+        if self._shared is None and not data.flags.writeable and data.flags.c_contiguous and data.dtype == dtype:
+            return np.asarray(data)
+        array = self._array(data, dtype)
+        array.setflags(write=False)
+        return array
+
+    def shared_descriptors(self) -> dict[str, ArrayDescriptor]:
+        """Return the descriptors of the shared working arrays.
+
+        Other processes get the arrays without copying them with
+        sharedarrays.attach. The descriptors change when the arrays are
+        resized.
+
+        Returns
+        -------
+            dict: descriptor of every array in SHARED_ARRAYS by attribute name
+        """
+        if self._shared is None:
+            raise ValueError("The working arrays are not shared")
+        return {name: self._shared.descriptor(getattr(self, name)) for name in self.SHARED_ARRAYS}
+
+    @property
+    def nbytes(self) -> int:
+        """Memory of the working arrays and the cached stage outputs in bytes."""
+        arrays = [value for value in vars(self).values() if isinstance(value, np.ndarray)]
+        arrays += [entry[1] for entry in self._stage_cache if entry[1] is not None and entry[1] is not self.kspacedata]
+        return sum(array.nbytes for array in arrays)
+
     @staticmethod
-    def np_ifft(kspace: np.ndarray, out: np.ndarray):
+    def np_ifft(kspace: np.ndarray, out: np.ndarray, hermitian: bool = False):
         """Perform inverse FFT function (kspace to [magnitude] image).
 
-        Performs iFFT on the input data and updates the display variables for
-        the image domain (magnitude) image and the kspace as well.
+        Performs a centred iFFT on the input data with the shared FFT engine
+        and stores the magnitude of the result. If the kspace is conjugate
+        symmetric, only half of it is transformed (irfft2).
 
         Parameters
         ----------
@@ -78,15 +224,18 @@ class ImageManipulators:
                 Complex kspace ndarray
             out : np.ndarray
                 Array to store values
+            hermitian : bool
+                True if the kspace is conjugate symmetric
         """
-        np.absolute(fftshift(ifft2(ifftshift(kspace))), out=out)
+        get_fft_engine().ifft2c_abs(kspace, out, hermitian)
 
     @staticmethod
     def np_fft(img: np.ndarray, out: np.ndarray):
         """Perform FFT function (image to kspace).
 
-        Performs FFT function, FFT shift and stores the unmodified kspace data
-        in a variable and also saves one copy for display and edit purposes.
+        Performs a centred FFT with the shared FFT engine (see fftengine.py)
+        and stores the result in out. Real images are transformed with rfft2
+        and the other half of kspace is filled using conjugate symmetry.
 
         Parameters
         ----------
@@ -95,33 +244,41 @@ class ImageManipulators:
             out : np.ndarray
                 Array to store output (must be same shape as img)
         """
-        out[:] = fftshift(fft2(ifftshift(img)))
+        get_fft_engine().fft2c(img, out)
 
     @staticmethod
-    def normalise(f: np.ndarray):
+    def normalise(f: np.ndarray, out: np.ndarray):
         """Normalise array by "streching" all values to be between 0-255.
 
+        Every slice of a stack is normalised on its own. Constant slices
+        become 0.
+
         Parameters
         ----------
             f : np.ndarray
-                input array
+                input array, used as scratch space (its values are overwritten)
+            out : np.ndarray
+                uint8 array to store the result
         """
-        fmin = float(np.min(f))
-        fmax = float(np.max(f))
-        if fmax != fmin:
-            coeff = fmax - fmin
-            f[:] = np.floor((f[:] - fmin) / coeff * 255.0)
+        fmin = np.min(f, axis=(-2, -1), keepdims=True)
+        fmax = np.max(f, axis=(-2, -1), keepdims=True)
+        coeff = fmax - fmin
+        scale = np.divide(255.0, coeff, out=np.zeros_like(coeff), where=coeff != 0)
+        np.subtract(f, fmin, out=f)
+        np.multiply(f, scale, out=f)
+        np.copyto(out, f, casting="unsafe")  # Truncation is the floor of the positive values
 
     @staticmethod
-    def apply_window(f: np.ndarray, window_val: dict[Any, Any] | None = None):
-        """Apply window values to the array.
+    def apply_window(f: np.ndarray, window_val: dict[Any, Any] | None, out: np.ndarray, scratch: np.ndarray):
+        """Apply window values to the array and store the display values in out.
 
         Excludes certain values based on window width and center before
         applying normalisation on array f.
         Window values are interpreted as percentages of the maximum
         intensity of the actual image.
         For example if window_val is 1, 0.5 and image has maximum intensity
-        of 196 then window width is 196, window center is 98.
+        of 196 then window width is 196, window center is 98. Every slice of
+        a stack is windowed based on its own maximum.
         Code applied from contrib-pydicom see license below:
             Copyright (c) 2009 Darcy Mason, Adit Panchal
             This file is part of pydicom, relased under an MIT license.
@@ -132,21 +289,30 @@ class ImageManipulators:
 
         Parameters
         ----------
-            f (np.ndarray): the array to be windowed
+            f (np.ndarray): the array to be windowed (not modified)
             window_val (dict): window width and window center dict
+            out (np.ndarray): uint8 array to store the result
+            scratch (np.ndarray): float array of the same shape as f
         """
-        fmax = np.max(f)
-        fmin = np.min(f)
-        if fmax != fmin:
-            ww = (window_val["ww"] * fmax) if window_val else fmax
-            wc = (window_val["wc"] * fmax) if window_val else (ww / 2)
-            w_low = wc - ww / 2
-            w_high = wc + ww / 2
-            f[:] = np.piecewise(
-                f,
-                [f <= w_low, f > w_high],
-                [0, 255, lambda x: ((x - wc) / ww + 0.5) * 255],
-            )
+        fmax = np.max(f, axis=(-2, -1), keepdims=True)
+        fmin = np.min(f, axis=(-2, -1), keepdims=True)
+        ww = (window_val["ww"] * fmax) if window_val else fmax
+        wc = (window_val["wc"] * fmax) if window_val else (ww / 2)
+
+        # ((f - wc) / ww + 0.5) * 255 as a single multiply-add, values below
+        # the window become 0 and values above it 255
+        valid = (ww != 0) & (fmax != fmin)
+        scale = np.divide(255.0, ww, out=np.zeros_like(ww), where=valid)
+        offset = np.where(valid, 127.5 - wc * scale, 0)
+        np.multiply(f, scale, out=scratch)
+        np.add(scratch, offset.astype(scratch.dtype), out=scratch)
+        np.clip(scratch, 0, 255, out=scratch)
+        np.copyto(out, scratch, casting="unsafe")
+
+        # A zero window width is a threshold at the window centre
+        for index in zip(*np.nonzero((ww == 0) & (fmax != fmin))):
+            slice_index = index[:-2]
+            out[slice_index] = np.where(f[slice_index] > wc[index], 255, 0)
 
     def prepare_displays(self, kscale: int = -3, lut: dict[Any, Any] | None = None):
         """Prepare kspace and image for display in the user interface.
@@ -159,6 +325,10 @@ class ImageManipulators:
         (excluding certain values based on user preference before normalisation
         e.g. intensity lower than 20 and higher than 200).
 
+        Both are computed with ufuncs into preallocated buffers and written
+        straight into the uint8 display arrays. The image itself keeps the
+        magnitude.
+
         Parameters
         ----------
             kscale : int
@@ -167,21 +337,63 @@ class ImageManipulators:
                 window width and window center dict
         """
         # 1. Apply window to image
-        self.apply_window(self.img, lut)
+        self.apply_window(self.img, lut, self.image_display_data, self._display_scratch)
 
         # 2. Prepare kspace display - get magnitude then scale and normalise
         # K-space scaling: https://homepages.inf.ed.ac.uk/rbf/HIPR2/pixlog.htm
         np.absolute(self.kspacedata, out=self.kspace_abs)
-        if np.any(self.kspace_abs):
-            scaling_c = np.power(10.0, kscale)
-            np.log1p(self.kspace_abs * scaling_c, out=self.kspace_abs)
-            self.normalise(self.kspace_abs)
+        scaling_c = 10.0**kscale  # A Python float keeps the array's precision
+        np.multiply(self.kspace_abs, scaling_c, out=self.kspace_abs)
+        np.log1p(self.kspace_abs, out=self.kspace_abs)
+        self.normalise(self.kspace_abs, self.kspace_display_data)
+
+    def prepare_textures(self):
+        """Prepare kspace and image as 16 bit textures for the user interface.
+
+        The window, gamma and kspace log scaling of the displays are applied
+        by fragment shaders (views/shaders), so the textures only change when
+        the data does. The image is divided by its maximum per slice and
+        quantised to TEXTURE_MAX, constant images become 0. The kspace
+        magnitude is divided by its maximum per slice and stored on a log10
+        scale covering KSPACE_TEXTURE_DECADES, so the weak outer kspace keeps
+        its precision. The kspace extrema are stored in kspace_range, the
+        kspace shader needs them to normalise the log scaled magnitude.
+        """
+        fmax = np.max(self.img, axis=(-2, -1), keepdims=True)
+        fmin = np.min(self.img, axis=(-2, -1), keepdims=True)
+        scale = np.divide(TEXTURE_MAX, fmax, out=np.zeros_like(fmax), where=fmax != fmin)
+        np.multiply(self.img, scale, out=self._display_scratch)
+        self.quantise(self._display_scratch, self.image_texture)
+
+        np.absolute(self.kspacedata, out=self.kspace_abs)
+        self.kspace_range[..., 0] = np.min(self.kspace_abs, axis=(-2, -1))
+        self.kspace_range[..., 1] = np.max(self.kspace_abs, axis=(-2, -1))
+        kmax = self.kspace_range[..., 1, None, None]
+        kmax = np.where(kmax > 0, kmax, 1).astype(self.kspace_abs.dtype)  # Zero kspace stays 0
+        # log10(|k| / kmax) from -KSPACE_TEXTURE_DECADES to 0, zero magnitudes are -inf
+        with np.errstate(divide="ignore"):
+            np.log10(self.kspace_abs, out=self.kspace_abs)
+            np.subtract(self.kspace_abs, np.log10(kmax), out=self.kspace_abs)
+        np.multiply(self.kspace_abs, TEXTURE_MAX / KSPACE_TEXTURE_DECADES, out=self.kspace_abs)
+        np.add(self.kspace_abs, TEXTURE_MAX, out=self.kspace_abs)
+        self.quantise(self.kspace_abs, self.kspace_texture)
 
-        # 3. Obtain uint8 type arrays for QML display
-        self.image_display_data[:] = np.require(self.img, np.uint8)
-        self.kspace_display_data[:] = np.require(self.kspace_abs, np.uint8)
+    @staticmethod
+    def quantise(f: np.ndarray, out: np.ndarray):
+        """Round values to the nearest integer of the range of TEXTURE_MAX.
+
+        Parameters
+        ----------
+            f : np.ndarray
+                float array, used as scratch space (its values are overwritten)
+            out : np.ndarray
+                uint16 array of the same shape
+        """
+        np.clip(f, 0, TEXTURE_MAX, out=f)
+        np.rint(f, out=f)
+        np.copyto(out, f, casting="unsafe")
 
-    def resize_arrays(self, size: _ShapeLike):
+    def resize_arrays(self, size: int | tuple[int, ...]):
         """Resize arrays for image size changes (e.g. remove kspace lines etc.).
 
         Called by undersampling kspace and the image_change method. If the FOV
@@ -194,12 +406,164 @@ class ImageManipulators:
             size : Any
                 size of the new array
         """
+        if self._shared is not None:
+            # Shared blocks have a fixed size, the arrays are moved to new ones
+            shape = tuple(int(n) for n in np.atleast_1d(size))
+            for name in self.SHARED_ARRAYS:
+                old = getattr(self, name)
+                if name in ("orig_kspacedata", "kspace_range") or old.shape == shape:
+                    continue
+                new = self._shared.zeros(shape, old.dtype)
+                count = min(old.size, new.size)
+                new.reshape(-1)[:count] = old.reshape(-1)[:count]  # Same layout as ndarray.resize
+                setattr(self, name, new)
+                self._shared.release(old)
+            self._display_scratch.resize(size)
+            return
         self.img.resize(size)
         self.image_display_data.resize(size)
         self.kspace_display_data.resize(size)
         self.kspace_abs.resize(size)
+        self._display_scratch.resize(size)
+        self.image_texture.resize(size)
+        self.kspace_texture.resize(size)
         self.kspacedata.resize(size, refcheck=False)
 
+    def apply_stages(self, stages: list[Stage]) -> bool:
+        """Apply modifier stages to the original kspace and store the result in kspacedata.
+
+        The output of every stage is cached together with its key. Processing
+        restarts from the first stage whose key differs from the previous
+        call, e.g. a change of the filling slider does not regenerate noise or
+        reapply spikes. The output of the last stage is not copied, it is the
+        kspacedata array itself.
+
+        Parameters
+        ----------
+            stages : list
+                active modifier stages in the order of application
+
+        Returns
+        -------
+            bool: True if the resulting kspace is conjugate symmetric
+        """
+        cache = self._stage_cache
+        start = 0
+        while start < min(len(stages), len(cache)) and stages[start].key == cache[start][0]:
+            start += 1
+
+        if start == 0:
+            if cache:  # Otherwise kspacedata is still the original kspace
+                self.resize_arrays(self.orig_kspacedata.shape)
+                self.kspacedata[:] = self.orig_kspacedata
+        elif cache[start - 1][1] is None:
+            # kspacedata holds this output and is about to be modified
+            if start < len(stages):
+                cache[start - 1][1] = self.kspacedata.copy()
+        else:
+            self.resize_arrays(cache[start - 1][1].shape)
+            self.kspacedata[:] = cache[start - 1][1]
+        del cache[start:]
+
+        try:
+            for i, stage in enumerate(stages[start:], start):
+                stage.func(self.kspacedata, *stage.params)
+                cache.append([stage.key, self.kspacedata.copy() if i < len(stages) - 1 else None])
+        except Exception:
+            # Start over from the original kspace on the next call
+            cache.clear()
+            self.resize_arrays(self.orig_kspacedata.shape)
+            self.kspacedata[:] = self.orig_kspacedata
+            raise
+
+        return self.hermitian and all(stage.hermitian for stage in stages)
+
+    def filling_reconstruction(self, stages: list[Stage]) -> bool:
+        """Reconstruct img during a filling playback from the newly acquired lines.
+
+        The FFT is linear, so the complex image of the previous filling step
+        is kept and only the lines acquired since then are added: a 1D iFFT of
+        those lines along the readout direction and a product with the cached
+        columns of the centred inverse DFT along the phase direction. A full
+        iFFT is done instead when the upstream stages or the filling mode
+        changed, the filling went backwards, or too many lines were added for
+        the update to be cheaper.
+
+        Must be called after apply_stages with the same stages.
+
+        Parameters
+        ----------
+            stages : list
+                active modifier stages, the filling stage must be the last one
+
+        Returns
+        -------
+            bool: False if there is no filling stage and img was not updated
+        """
+        if not stages or stages[-1].name != "filling" or stages[-1].params[1] not in (0, 1, 2, 4):
+            self._filling_key = self._filling_image = None
+            return False
+
+        engine = get_fft_engine()
+        value, mode = stages[-1].params
+        rows, cols = self.kspacedata.shape[-2:]
+        samples = int(rows * cols * value / 100)
+        key = (tuple(stage.key for stage in stages[:-1]), mode, self.kspacedata.shape)
+
+        # Acquisition steps (lines in filling order) touched since the last call
+        first, last = self._filling_samples // cols, -(-samples // cols)
+        image = self._filling_image
+        incremental = (
+            key == self._filling_key and samples >= self._filling_samples and last - first <= np.log2(rows * cols) / 2
+        )
+
+        if image is None or not incremental:
+            if image is None or image.shape != self.kspacedata.shape:
+                image = self._filling_image = np.empty_like(self.kspacedata)
+            engine.ifft2c(self.kspacedata, image)
+        elif last > first:
+            # These modes acquire one whole line per step, forwards or backwards
+            starts = mask_cache.filling_order((rows, cols), mode)[first * cols : last * cols : cols]
+            lines = starts // cols
+            new = self.kspacedata[..., lines, :]  # Samples after the cutoff are already zero
+            done = self._filling_samples - first * cols  # Added before, in the first line
+            if done:
+                if starts[0] % cols:  # Read backwards
+                    new[..., 0, cols - done :] = 0
+                else:
+                    new[..., 0, :done] = 0
+            idft = mask_cache.centred_idft(rows, self.kspacedata.dtype)
+            image += np.matmul(idft[:, lines], engine.ifft1c(new))
+
+        self._filling_key = key
+        self._filling_samples = samples
+        np.absolute(image, out=self.img)
+        return True
+
+    def apply_noise(self, kspace: np.ndarray, signal_to_noise: float, seed: int):
+        """Add the noise of an acquisition to the original kspace.
+
+        The noise of a seed is generated once by the shared noise engine and
+        the mean signal once per loaded kspace, so an SNR change only
+        rescales the noise. Must be the first stage.
+
+        Parameters
+        ----------
+            kspace : np.ndarray
+                Complex kspace ndarray
+            signal_to_noise : float
+                SNR in decibels (-30dB - +30dB)
+            seed : int
+                seed of the acquisition's noise
+        """
+        if self._mean_signal is None:
+            self._mean_signal = np.mean(np.abs(self.orig_kspacedata), axis=(-2, -1), keepdims=True)
+        noise = get_noise_engine().unit_noise(kspace.shape, kspace.dtype, seed)
+        scratch = self._noise_scratch
+        if scratch is None or scratch.shape != kspace.shape or scratch.dtype != kspace.dtype:
+            scratch = self._noise_scratch = np.empty_like(kspace)
+        self.add_noise(kspace, signal_to_noise, noise, self._mean_signal, scratch)
+
     @staticmethod
     def reduced_scan_percentage(kspace: np.ndarray, percentage: float):
         """Delete a percentage of lines from the kspace in phase direction.
@@ -218,10 +582,10 @@ class ImageManipulators:
         """
         if int(percentage) < 100:
             percentage_delete = 1 - percentage / 100
-            lines_to_delete = round(percentage_delete * kspace.shape[0] / 2)
+            lines_to_delete = round(percentage_delete * kspace.shape[-2] / 2)
             if lines_to_delete:
-                kspace[0:lines_to_delete] = 0
-                kspace[-lines_to_delete:] = 0
+                kspace[..., 0:lines_to_delete, :] = 0
+                kspace[..., -lines_to_delete:, :] = 0
 
     @staticmethod
     def high_pass_filter(kspace: np.ndarray, radius: float):
@@ -240,18 +604,11 @@ class ImageManipulators:
                 Relative size of the kspace mask circle (percent)
         """
         if radius > 0:
-            # Ensure kspace is 2D
-            assert kspace.ndim == 2, "kspace must be 2D!"
-
             # Explicitly specify dimensions for hypot
-            dim_x, dim_y = kspace.shape
+            dim_x, dim_y = kspace.shape[-2:]
             r = np.hypot(dim_x, dim_y) / 2 * radius / 100
 
-            rows, cols = np.array(kspace.shape, dtype=int)
-            a, b = np.floor(np.array((rows, cols)) / 2).astype(int)
-            y, x = np.ogrid[-a : rows - a, -b : cols - b]
-            mask = x * x + y * y <= r * r
-            kspace[mask] = 0
+            kspace[..., mask_cache.radius_squared(kspace.shape[-2:]) <= r * r] = 0
 
     @staticmethod
     def low_pass_filter(kspace: np.ndarray, radius: float):
@@ -270,31 +627,26 @@ class ImageManipulators:
                 Relative size of the kspace mask circle (percent)
         """
         if radius < 100:
-            # Ensure kspace is 2D
-            assert kspace.ndim == 2, "kspace must be 2D!"
-
             # Explicitly specify dimensions for hypot
-            dim_x, dim_y = kspace.shape
+            dim_x, dim_y = kspace.shape[-2:]
             r = np.hypot(dim_x, dim_y) / 2 * radius / 100
 
-            rows, cols = np.array(kspace.shape, dtype=int)
-            a, b = np.floor(np.array((rows, cols)) / 2).astype(int)
-            y, x = np.ogrid[-a : rows - a, -b : cols - b]
-            mask = x * x + y * y <= r * r
-            kspace[~mask] = 0
+            kspace[..., mask_cache.radius_squared(kspace.shape[-2:]) > r * r] = 0
 
     @staticmethod
     def add_noise(
         kspace: np.ndarray,
         signal_to_noise: float,
-        current_noise: np.ndarray,
-        generate_new_noise=False,
+        noise: np.ndarray,
+        mean_signal: np.ndarray | None = None,
+        scratch: np.ndarray | None = None,
     ):
-        """Add random Guassian white noise to k-space.
+        """Add complex Gaussian white noise to k-space.
 
         Adds noise to the image to simulate an image with the given
         signal-to-noise ratio, so that SNR [dB] = 20log10(S/N)
         where S is the mean signal and N is the standard deviation of the noise.
+        The mean signal is taken per slice of a stack.
 
         Parameters
         ----------
@@ -302,17 +654,22 @@ class ImageManipulators:
                 Complex kspace ndarray
             signal_to_noise : float
                 SNR in decibels (-30dB - +30dB)
-            current_noise : np.ndarray
-                the existing noise map
-            generate_new_noise : bool
-                flag to generate new noise map
+            noise : np.ndarray
+                complex noise with a standard deviation of 1 (see NoiseEngine)
+            mean_signal : np.ndarray
+                mean magnitude of the kspace per slice, computed if None
+            scratch : np.ndarray
+                array of the shape and dtype of kspace for the scaled noise,
+                allocated if None
         """
         if signal_to_noise < 30:
-            if generate_new_noise:
-                mean_signal = np.mean(np.abs(kspace))
-                std_noise = mean_signal / np.power(10, (signal_to_noise / 20))
-                current_noise[:] = std_noise * np.random.randn(*kspace.shape)
-            kspace += current_noise
+            if mean_signal is None:
+                mean_signal = np.mean(np.abs(kspace), axis=(-2, -1), keepdims=True)
+            std_noise = mean_signal / np.power(10, (signal_to_noise / 20))
+            if scratch is None:
+                scratch = np.empty_like(kspace)
+            np.multiply(noise, std_noise.astype(kspace.real.dtype), out=scratch)
+            kspace += scratch
 
     @staticmethod
     def partial_fourier(kspace: np.ndarray, percentage: float, zf: bool):
@@ -332,10 +689,10 @@ class ImageManipulators:
         """
         if int(percentage) != 100:
             percentage = 1 - percentage / 100
-            rows_to_skip = round(percentage * (kspace.shape[0] / 2 - 1))
+            rows_to_skip = round(percentage * (kspace.shape[-2] / 2 - 1))
             if rows_to_skip and zf:
                 # Partial Fourier (lines not acquired are filled with zeros)
-                kspace[-rows_to_skip:] = 0
+                kspace[..., -rows_to_skip:, :] = 0
             elif rows_to_skip:
                 # If the kspace has an even resolution then the
                 # mirrored part will be shifted (k-space center signal
@@ -345,8 +702,8 @@ class ImageManipulators:
 
                 # Following two lines are a connoisseur's (== obscure) way of
                 # returning 1 if the number is even and 0 otherwise. Enjoy!
-                shift_hor = not kspace.shape[1] & 0x1  # Bitwise AND
-                shift_ver = 0 if kspace.shape[0] % 2 else 1  # Ternary operator
+                shift_hor = not kspace.shape[-1] & 0x1  # Bitwise AND
+                shift_ver = 0 if kspace.shape[-2] % 2 else 1  # Ternary operator
                 s = (shift_ver, shift_hor)
 
                 # 1. Obtain a view of the array backwards (rotated 180 degrees)
@@ -354,10 +711,11 @@ class ImageManipulators:
                 #       columns or rows is even) roll lines to realign the
                 #       highest amplitude parts
                 # 3. Do the same vertically
-                kspace[-rows_to_skip:] = np.roll(kspace[::-1, ::-1], s, axis=(0, 1))[-rows_to_skip:]
+                flipped = np.roll(kspace[..., ::-1, ::-1], s, axis=(-2, -1))
+                kspace[..., -rows_to_skip:, :] = flipped[..., -rows_to_skip:, :]
 
                 # Conjugate replaced lines
-                np.conj(kspace[-rows_to_skip:], kspace[-rows_to_skip:])
+                np.conj(kspace[..., -rows_to_skip:, :], kspace[..., -rows_to_skip:, :])
 
     @staticmethod
     def hamming(kspace: np.ndarray):
@@ -374,9 +732,7 @@ class ImageManipulators:
             kspace : np.ndarray
                 Complex k-space numpy.ndarray
         """
-        x, y = kspace.shape
-        window = np.outer(np.hamming(x), np.hamming(y))
-        kspace *= window
+        kspace *= mask_cache.hamming(kspace.shape[-2:], kspace.real.dtype)
 
     def undersample(self, kspace: np.ndarray, factor: int, compress: bool):
         """Skipping every nth kspace line.
@@ -393,19 +749,14 @@ class ImageManipulators:
             compress : bool
                 compress kspace by removing empty lines (rectangular FOV)
         """
-        # TODO memory optimise this (kspace sized memory created 3 times)
         if factor > 1:
-            mask = np.ones(kspace.shape, dtype=bool)
-            midline = kspace.shape[0] // 2
-            mask[midline::factor] = 0
-            mask[midline::-factor] = 0
+            acquired, skipped = mask_cache.undersample_rows(kspace.shape[-2], factor)
             if compress:
-                q = kspace[~mask]
-                q = q.reshape(q.size // kspace.shape[1], kspace.shape[1])
+                q = kspace[..., acquired, :]
                 self.resize_arrays(q.shape)
-                kspace[:] = q[:]
+                self.kspacedata[:] = q  # kspace is kspacedata, which is replaced when it is shared
             else:
-                kspace[mask] = 0
+                kspace[..., skipped, :] = 0
 
     @staticmethod
     def decrease_dc(kspace: np.ndarray, percentage: int):
@@ -418,16 +769,16 @@ class ImageManipulators:
             percentage : int
                 reduce the DC value by this value
         """
-        x = kspace.shape[0] // 2
-        y = kspace.shape[1] // 2
-        kspace[x, y] *= (100 - percentage) / 100
+        x = kspace.shape[-2] // 2
+        y = kspace.shape[-1] // 2
+        kspace[..., x, y] *= (100 - percentage) / 100
 
     @staticmethod
     def apply_spikes(kspace: np.ndarray, spikes: list):
         """Overlays spikes to kspace.
 
         Apply spikes (max value pixels) to the kspace data at the specified
-        coordinates.
+        coordinates. Spikes are applied to every slice of a stack.
 
         Parameters
         ----------
@@ -436,9 +787,9 @@ class ImageManipulators:
             spikes : list
                 coordinates for the spikes (row, column)
         """
-        spike_intensity = np.max(kspace) * 2
-        for spike in spikes:
-            kspace[spike] = spike_intensity
+        spike_intensity = np.max(kspace, axis=(-2, -1)) * 2
+        for row, column in spikes:
+            kspace[..., row, column] = spike_intensity
 
     @staticmethod
     def apply_patches(kspace, patches: list):
@@ -456,79 +807,106 @@ class ImageManipulators:
         """
         for patch in patches:
             x, y, size = patch[0], patch[1], patch[2]
-            kspace[max(x - size, 0) : x + size + 1, max(y - size, 0) : y + size + 1] = 0
+            kspace[..., max(x - size, 0) : x + size + 1, max(y - size, 0) : y + size + 1] = 0
 
     @staticmethod
-    def filling(kspace: np.ndarray, value: float, mode: int):
-        """Receives kspace filling UI changes and redirects to filling methods.
-
-        When the kspace filling simulation slider changes or simulation plays,
-        this method receives the acquision phase (value: float, 0-100%)
+    def samples(kspace: np.ndarray) -> np.ndarray:
+        """Return a view of kspace with the samples of every slice on the last axis.
 
         Parameters
         ----------
             kspace : np.ndarray
-                Complex kspace ndarray
-            value : float
-                acquisition phase in percent
-            mode : int
-                kspace filling mode
+                C-contiguous kspace ndarray
+
+        Returns
+        -------
+            np.ndarray: view with shape (..., rows * columns)
         """
-        if mode == 0:  # Linear filling
-            ImageManipulators.filling_linear(kspace, value)
-        elif mode == 1:  # Centric filling
-            ImageManipulators.filling_centric(kspace, value)
-        elif mode == 2:  # Single shot EPI blipped
-            ImageManipulators.filling_ss_epi_blipped(kspace, value)
-        elif mode == 3:  # Archimedean spiral
-            # filling_spiral(kspace, value)
-            pass
+        samples = kspace.view()
+        samples.shape = kspace.shape[:-2] + (-1,)  # Raises instead of copying
+        return samples
 
-    @staticmethod
-    def filling_linear(kspace: np.ndarray, value: float):
-        """Linear kspace filling.
+    def gridding_precompensation(self, kspace: np.ndarray, trajectory: str):
+        """Prepare kspace for sampling a non-Cartesian trajectory.
 
-        Starts with the top left corner and sequentially fills kspace from
-        top to bottom
+        Divides the image by the transform of the gridding kernel and zero
+        pads it to the oversampled field of view. The kspace arrays are
+        resized to the oversampled grid until trajectory_filling shrinks them.
 
         Parameters
         ----------
             kspace : np.ndarray
                 Complex kspace ndarray
-            value : float
-                acquisition phase in percent
+            trajectory : str
+                "spiral" or "radial"
         """
-        kspace.flat[int(kspace.size * value // 100) : :] = 0
-
-    @staticmethod
-    def filling_centric(kspace: np.ndarray, value: float):
-        """Centric filling method.
-
-        Fills the center line first from left to right and then alternating one
-        line above and one below.
+        engine = get_fft_engine()
+        rows, cols = kspace.shape[-2:]
+        image = np.empty_like(kspace)
+        engine.ifft2c(kspace, image)
+        image /= gridding_operator((rows, cols), trajectory).apodization
+
+        padded = np.zeros(kspace.shape[:-2] + (OVERSAMPLING * rows, OVERSAMPLING * cols), dtype=kspace.dtype)
+        r0, c0 = padded.shape[-2] // 2 - rows // 2, padded.shape[-1] // 2 - cols // 2
+        padded[..., r0 : r0 + rows, c0 : c0 + cols] = image
+        self.resize_arrays(padded.shape)
+        engine.fft2c(padded, self.kspacedata)  # kspace is kspacedata, which is replaced when it is shared
+
+    def trajectory_filling(self, kspace: np.ndarray, value: float, mode: int):
+        """Acquire a non-Cartesian trajectory up to the acquisition phase.
+
+        The trajectory samples are interpolated from the precompensated
+        oversampled kspace, density compensated and gridded back. The
+        resulting image is cropped, deapodized and transformed to kspace of
+        the original size.
+
+        The samples and the grid are kept while the earlier stages do not
+        change (this is called by apply_stages, whose cache identifies them),
+        so a playback step only grids the samples acquired since the last
+        step.
 
         Parameters
         ----------
             kspace : np.ndarray
-                Complex kspace ndarray
+                oversampled kspace from gridding_precompensation
             value : float
                 acquisition phase in percent
+            mode : int
+                kspace filling mode, a key of trajectories
         """
-        ksp_centric = np.zeros_like(kspace)
-
-        # reorder
-        ksp_centric[0::2] = kspace[kspace.shape[0] // 2 : :]
-        ksp_centric[1::2] = kspace[kspace.shape[0] // 2 - 1 :: -1]
-
-        ksp_centric.flat[int(kspace.size * value / 100) : :] = 0
-
-        # original order
-        kspace[(kspace.shape[0]) // 2 - 1 :: -1] = ksp_centric[1::2]
-        kspace[(kspace.shape[0]) // 2 : :] = ksp_centric[0::2]
+        engine = get_fft_engine()
+        rows, cols = kspace.shape[-2] // OVERSAMPLING, kspace.shape[-1] // OVERSAMPLING
+        operator = gridding_operator((rows, cols), self.trajectories[mode])
+        acquired = int(operator.samples * value / 100)
+
+        key = (tuple(entry[0] for entry in self._stage_cache), mode, kspace.shape)
+        samples, grid = self._gridding_samples, self._gridding_grid
+        if key != self._gridding_key or samples is None or grid is None:
+            self._gridding_key = key
+            samples = self._gridding_samples = operator.sample(kspace, operator.samples)
+            grid = self._gridding_grid = np.zeros_like(kspace)
+            self._gridding_acquired = 0
+        if abs(acquired - self._gridding_acquired) > acquired:
+            # Gridding from scratch is cheaper
+            grid[...] = 0
+            self._gridding_acquired = 0
+        operator.grid(samples, self._gridding_acquired, acquired, out=grid)
+        self._gridding_acquired = acquired
+
+        engine.ifft2c(grid, kspace)
+        r0, c0 = kspace.shape[-2] // 2 - rows // 2, kspace.shape[-1] // 2 - cols // 2
+        image = kspace[..., r0 : r0 + rows, c0 : c0 + cols] / operator.apodization
+        self.resize_arrays(image.shape)
+        engine.fft2c(image, self.kspacedata)  # kspace is kspacedata, which is replaced when it is shared
 
     @staticmethod
-    def filling_ss_epi_blipped(kspace: np.ndarray, value: float):
-        """Single-shot blipped EPI (zig-zag pattern).
+    def filling(kspace: np.ndarray, value: float, mode: int):
+        """Receives kspace filling UI changes and removes the samples not acquired yet.
+
+        When the kspace filling simulation slider changes or simulation plays,
+        this method receives the acquision phase (value: float, 0-100%). The
+        acquisition order of every mode is a cached table of sample indices
+        (see MaskCache.filling_order), so filling is a single masked write.
 
         Parameters
         ----------
@@ -536,13 +914,16 @@ class ImageManipulators:
                 Complex kspace ndarray
             value : float
                 acquisition phase in percent
+            mode : int
+                kspace filling mode: 0 linear, 1 centric (centre line first,
+                then alternating one line above and one below), 2 single shot
+                blipped EPI (zig-zag), 4 interleaved segmented EPI. The
+                spiral and radial modes (trajectories) use trajectory_filling.
         """
         # https://www.imaios.com/en/e-Courses/e-MRI/MRI-Sequences/echo-planar-imaging
-        ksp_epi = np.zeros_like(kspace)
-        ksp_epi[::2] = kspace[::2]
-        ksp_epi[1::2] = kspace[1::2, ::-1]  # Every second line backwards
-
-        ksp_epi.flat[int(kspace.size * value / 100) : :] = 0
-
-        kspace[::2] = ksp_epi[::2]
-        kspace[1::2] = ksp_epi[1::2, ::-1]
+        samples = ImageManipulators.samples(kspace)
+        acquired = int(samples.shape[-1] * value / 100)
+        if mode == 0:  # Linear filling is in memory order
+            samples[..., acquired:] = 0
+        else:
+            samples[..., mask_cache.filling_order(kspace.shape[-2:], mode)[acquired:]] = 0
@@ -0,0 +1,166 @@
+# Copyright (C) 2023, BRAIN-LINK UG (haftungsbeschränkt). All Rights Reserved.
+# SPDX-License-Identifier: GPL-3.0-only OR LicenseRef-ScanHub-Commercial
+
+"""Contains the definition of the ImagePrefetcher class."""
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+
+import fileloaders
+from imagemanipulators import ImageManipulators
+
+log = logging.getLogger(__name__)
+
+
+def load_manipulators(path: str, precision: str = "single") -> ImageManipulators:
+    """Open a file and transform it into an ImageManipulators instance.
+
+    2D data is an image, 3D data is a stack of raw kspace channels.
+
+    Parameters
+    ----------
+        path : str
+            file location
+        precision : str
+            "single" or "double"
+
+    Returns
+    -------
+        ImageManipulators: the image and kspace pair
+    """
+    data = fileloaders.load(path)
+    return ImageManipulators(data, data.ndim <= 2, precision)
+
+
+class ImagePrefetcher:
+    """Least recently used cache of opened images with background prefetching.
+
+    The files next to the current one in the image list are opened and
+    transformed on background threads, so stepping through a series only
+    has to look them up. The cache is bounded by the memory of the
+    ImageManipulators instances (including their cached stage outputs).
+    Prefetches of files that are no longer neighbours are cancelled.
+    """
+
+    def __init__(self, precision: str = "single", max_bytes: int = 1024 * 2**20, workers: int = 2):
+        """Initialise an empty cache.
+
+        Parameters
+        ----------
+            precision : str
+                precision of the ImageManipulators instances
+            max_bytes : int
+                maximum total size of the cached instances in bytes
+            workers : int
+                number of background threads
+        """
+        self.precision = precision
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, ImageManipulators] = OrderedDict()
+        self._pending: dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ImagePrefetcher")
+
+    def get(self, path: str) -> ImageManipulators:
+        """Return the ImageManipulators instance of a file.
+
+        Cached instances are returned as they are, a running prefetch is
+        waited for and other files are opened on the calling thread.
+
+        Parameters
+        ----------
+            path : str
+                file location
+
+        Returns
+        -------
+            ImageManipulators: the image and kspace pair
+        """
+        with self._lock:
+            if path in self._entries:
+                self._entries.move_to_end(path)
+                return self._entries[path]
+            pending = self._pending.get(path)
+
+        im = None
+        if pending is not None:
+            try:
+                im = pending.result()
+            except CancelledError:
+                pass
+        if im is None:
+            im = load_manipulators(path, self.precision)
+        with self._lock:
+            self._insert(path, im)
+        return im
+
+    def prefetch(self, paths: list[str]):
+        """Open files in the background and cancel the prefetches of other files.
+
+        Files larger than max_bytes are skipped, their instances could not be
+        cached and reading them would only compete with the current file.
+
+        Parameters
+        ----------
+            paths : list
+                files to be opened, most important first
+        """
+        with self._lock:
+            for path, future in list(self._pending.items()):
+                if path not in paths and future.cancel():
+                    self._pending.pop(path, None)
+                    log.debug(f"Cancelled prefetch: {path}")
+            for path in paths:
+                if path in self._entries or path in self._pending or not self._fits(path):
+                    continue
+                self._pending[path] = self._executor.submit(self._prefetch, path)
+
+    def clear(self):
+        """Remove all cached instances and cancel the prefetches."""
+        with self._lock:
+            for future in self._pending.values():
+                future.cancel()
+            self._pending.clear()
+            self._entries.clear()
+
+    def shutdown(self):
+        """Cancel the prefetches and stop the background threads."""
+        self.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _fits(self, path: str) -> bool:
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return False  # The error is reported when the file is opened for display
+        if size > self.max_bytes:
+            log.debug(f"Not prefetched, larger than the cache: {path} ({size / 2**20:.0f} MB)")
+            return False
+        return True
+
+    def _prefetch(self, path: str) -> ImageManipulators | None:
+        try:
+            im = load_manipulators(path, self.precision)
+        except Exception:
+            # The error is reported when the file is opened for display
+            log.debug(f"Prefetch failed: {path}", exc_info=True)
+            im = None
+        with self._lock:
+            self._pending.pop(path, None)
+            if im is not None:
+                self._insert(path, im)
+        return im
+
+    def _insert(self, path: str, im: ImageManipulators):
+        # Called with the lock held
+        self._entries[path] = im
+        self._entries.move_to_end(path)
+        # Sizes change while an instance is used, so they are summed here
+        sizes = {key: entry.nbytes for key, entry in self._entries.items()}
+        total = sum(sizes.values())
+        while len(self._entries) > 1 and total > self.max_bytes:
+            key, _ = self._entries.popitem(last=False)
+            total -= sizes[key]
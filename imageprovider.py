@@ -3,77 +3,158 @@
 
 """Contains the ImageProvider class definition."""
 
+import threading
+from collections import OrderedDict
+
+import numpy as np
 from PySide6 import QtQuick
-from PySide6.QtGui import QColor, QImage, QPixmap
+from PySide6.QtGui import QColor, QImage
+
+from thumbnailcache import ThumbnailCache, downsample
 
-from imagemanipulators import ImageManipulators
+MAX_FRAMES = 4  # Frames that can still be requested after newer ones arrived
 
 
 class ImageProvider(QtQuick.QQuickImageProvider):
     """Contains the interface between numpy and Qt.
 
-    Qt calls py_SimulationApp.update_displays on UI change
-    that method requests new images to display
-    pyqt channels it back to Qt GUI
+    Qt calls py_SimulationApp.update_displays on UI change, the ComputeWorker
+    computes the new display data in the background and SimulationApp passes
+    the finished frame to the provider before reloading the QML images.
+
+    The main displays get the 16 bit textures quantised by the
+    ComputeWorker, their window and kspace scaling are applied by the
+    shaders in view.qml. Thumbnails are the 8 bit previews of a
+    ThumbnailCache.
+
+    Every frame gets the next frame id, the image ids are built by source()
+    and name the frame and channel they show. Only the last MAX_FRAMES
+    frames are kept, a request for an older frame gets the newest one. The
+    QImages wrap the numpy buffers without copying them (PySide keeps the
+    buffer alive as long as Qt uses the image), the QML images should not
+    be cached by Qt.
     """
 
-    def __init__(self, im: ImageManipulators):
-        QtQuick.QQuickImageProvider.__init__(self, QtQuick.QQuickImageProvider.Pixmap)  # type: ignore
-        self._im = im
+    def __init__(self, image: np.ndarray, kspace: np.ndarray, thumbnails: ThumbnailCache, max_frames: int = MAX_FRAMES):
+        """Initialise the provider with the first frame.
+
+        Parameters
+        ----------
+            image : np.ndarray
+                uint16 image texture (a single slice or a stack of channels)
+            kspace : np.ndarray
+                uint16 kspace texture of the same shape
+            thumbnails : ThumbnailCache
+                previews of the channels
+            max_frames : int
+                number of frames kept for requests
+        """
+        QtQuick.QQuickImageProvider.__init__(self, QtQuick.QQuickImageProvider.Image)  # type: ignore
+        self.thumbnails = thumbnails
+        self.max_frames = max_frames
+        self._frames: OrderedDict[int, tuple[np.ndarray, np.ndarray]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.frame_id = -1
+        self.set_frame(image, kspace)
+
+    def set_frame(self, image: np.ndarray, kspace: np.ndarray) -> int:
+        """Add a frame of display data to be shown.
+
+        The arrays must not be modified afterwards.
+
+        Parameters
+        ----------
+            image : np.ndarray
+                uint16 image texture (a single slice or a stack of channels)
+            kspace : np.ndarray
+                uint16 kspace texture of the same shape
+
+        Returns
+        -------
+            int: id of the frame, increases with every frame
+        """
+        with self._lock:
+            self.frame_id += 1
+            self._frames[self.frame_id] = (image, kspace)
+            while len(self._frames) > self.max_frames:
+                self._frames.popitem(last=False)
+            return self.frame_id
+
+    @staticmethod
+    def source(name: str, frame_id: int, channel: int = 0) -> str:
+        """Return the source of a QML image.
+
+        Parameters
+        ----------
+            name : str
+                "image", "kspace" or "thumb"
+            frame_id : int
+                id of the frame (the preview version for thumbnails)
+            channel : int
+                index of the channel in a stack
 
-    def requestPixmap(self, id_str: str, size, requested_size) -> QPixmap:
+        Returns
+        -------
+            str: the image URL
+        """
+        return f"image://imgs/{name}_{frame_id}_{channel}"
+
+    @staticmethod
+    def _slice(data: np.ndarray, channel: int) -> np.ndarray:
+        """Return the 2D display data of a channel."""
+        return data[channel] if data.ndim > 2 else data
+
+    @staticmethod
+    def _texture(data: np.ndarray) -> QImage:
+        """Return a 2D uint16 array as a 16 bit grayscale texture."""
+        gray = np.ascontiguousarray(data)
+        height, width = data.shape
+        return QImage(gray.data, width, height, gray.strides[0], QImage.Format_Grayscale16)  # type: ignore
+
+    @staticmethod
+    def _grayscale(data: np.ndarray) -> QImage:
+        """Return a 2D uint8 array as an 8 bit grayscale image."""
+        gray = np.ascontiguousarray(data)
+        height, width = data.shape
+        return QImage(gray.data, width, height, gray.strides[0], QImage.Format_Grayscale8)  # type: ignore
+
+    def requestImage(self, id_str: str, size, requested_size) -> QImage:
         """Qt calls this function when an image changes.
 
         Parameters
         ----------
             id_str : str
-                identifies the requested image
+                identifies the requested image, see source()
             size : QSize
-                This is used to set the width and height of the relevant Image.
+                This is set to the width and height of the full size image.
             requested_size : QSize
-                image size requested by QML (usually ignored)
+                image size requested by QML (sourceSize), the image is
+                downsampled to fit into it
 
         Returns
         -------
-            QPixmap: an image in the format required by Qt
+            QImage: an image in the format required by Qt
         """
         try:
-            if id_str.startswith("image"):
-                q_im = QImage(  # type: ignore
-                    self._im.image_display_data,  # data
-                    self._im.image_display_data.shape[1],  # width
-                    self._im.image_display_data.shape[0],  # height
-                    self._im.image_display_data.strides[0],  # bytes/line
-                    QImage.Format_Grayscale8,  # type: ignore
-                )  # format
-
-            elif id_str.startswith("kspace"):
-                q_im = QImage(  # type: ignore
-                    self._im.kspace_display_data,  # data
-                    self._im.kspace_display_data.shape[1],  # width
-                    self._im.kspace_display_data.shape[0],  # height
-                    self._im.kspace_display_data.strides[0],  # bytes/line
-                    QImage.Format_Grayscale8,  # type: ignore
-                )  # format
-
-            elif id_str.startswith("thumb"):
-                thumb_id = int(id_str[6 : 6 + id_str[6:].find("_")])
-                im_c = py_SimulationApp.img_instances[thumb_id]  # type: ignore
-                q_im = QImage(  # type: ignore
-                    im_c.image_display_data,  # data
-                    im_c.image_display_data.shape[1],  # width
-                    im_c.image_display_data.shape[0],  # height
-                    im_c.image_display_data.strides[0],  # bytes/line
-                    QImage.Format_Grayscale8,  # type: ignore
-                )  # format
-
+            name, frame_id, channel = id_str.split("_")
+            if name == "thumb":
+                data = self.thumbnails.preview(int(channel))
+            elif name in ("image", "kspace"):
+                with self._lock:
+                    image, kspace = self._frames.get(int(frame_id), self._frames[self.frame_id])
+                data = self._slice(image if name == "image" else kspace, int(channel))
             else:
                 raise NameError
 
-        except NameError:
+            size.setWidth(data.shape[1])
+            size.setHeight(data.shape[0])
+            data = downsample(data, requested_size.width(), requested_size.height())
+            q_im = self._grayscale(data) if name == "thumb" else self._texture(data)
+
+        except (NameError, IndexError, ValueError):
             print(NameError)
             # On error, we return a red image of requested size
-            q_im = QPixmap(requested_size)
+            q_im = QImage(requested_size, QImage.Format_RGB32)  # type: ignore
             q_im.fill(QColor("red"))
 
-        return QPixmap(q_im)  # , QPixmap(q_im).size()
+        return q_im
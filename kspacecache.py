@@ -0,0 +1,172 @@
+# Copyright (C) 2023, BRAIN-LINK UG (haftungsbeschränkt). All Rights Reserved.
+# SPDX-License-Identifier: GPL-3.0-only OR LicenseRef-ScanHub-Commercial
+
+"""Contains the definition of the KSpaceCache class."""
+
+import contextlib
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+import numpy as np
+import numpy.typing as npt
+
+log = logging.getLogger(__name__)
+
+# Part of every key, increase it when the kspace of an image changes (e.g. the FFT convention)
+CACHE_VERSION = 1
+
+
+class KSpaceCache:
+    """Content addressed disk cache of the kspace of images.
+
+    The kspace is stored as .npy file named by a hash of the image data,
+    its shape and dtype, the kspace dtype and CACHE_VERSION, and it is
+    memory mapped when it is loaded. The least recently used files are
+    removed when the cache grows beyond its size (the modification time
+    is the time of the last use).
+
+    Several processes can share a directory: files are written to a
+    temporary name and renamed, so they appear complete or not at all, and
+    files that disappear or cannot be removed are skipped.
+    """
+
+    def __init__(self, directory: str | os.PathLike, max_bytes: int = 1024 * 2**20):
+        """Initialise the cache, the directory is created if necessary.
+
+        Parameters
+        ----------
+            directory : str
+                cache directory
+            max_bytes : int
+                maximum total size of the cached files in bytes
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    def __repr__(self) -> str:
+        """Return the directory and size, e.g. for the log file."""
+        return f"KSpaceCache(directory={str(self.directory)!r}, max_bytes={self.max_bytes})"
+
+    @staticmethod
+    def key(image: np.ndarray, dtype: npt.DTypeLike) -> str:
+        """Return the key of the kspace of an image.
+
+        Parameters
+        ----------
+            image : np.ndarray
+                C-contiguous image data
+            dtype : np.dtype
+                complex dtype of the kspace
+
+        Returns
+        -------
+            str: hex digest
+        """
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(repr((CACHE_VERSION, image.shape, image.dtype.str, np.dtype(dtype).str)).encode())
+        digest.update(image.data.cast("B"))
+        return digest.hexdigest()
+
+    def load(self, key: str) -> np.ndarray | None:
+        """Memory map a cached kspace.
+
+        Parameters
+        ----------
+            key : str
+                key of the kspace
+
+        Returns
+        -------
+            np.ndarray: read-only kspace, None if it is not cached
+        """
+        path = self.directory / f"{key}.npy"
+        try:
+            kspace = np.load(path, mmap_mode="r")
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        log.debug(f"Kspace cache hit: {key}")
+        return kspace
+
+    def store(self, key: str, kspace: np.ndarray):
+        """Add a kspace to the cache and remove the least recently used files.
+
+        Parameters
+        ----------
+            key : str
+                key of the kspace
+            kspace : np.ndarray
+                kspace to be stored
+        """
+        temporary = None
+        try:
+            with tempfile.NamedTemporaryFile(dir=self.directory, suffix=".tmp", delete=False) as f:
+                temporary = f.name
+                np.save(f, kspace)
+            os.replace(temporary, self.directory / f"{key}.npy")
+            temporary = None
+        except OSError:
+            log.warning("Cannot write to the kspace cache", exc_info=True)
+            return
+        finally:
+            if temporary is not None:
+                # np.save or os.replace failed, e.g. the disk is full
+                with contextlib.suppress(OSError):
+                    os.unlink(temporary)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used files until the cache fits into max_bytes."""
+        files = []
+        for path in self.directory.glob("*.npy"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue  # Removed by another process
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+                total -= size
+            except OSError:
+                pass  # Removed or still mapped by another process (Windows)
+
+
+_cache: KSpaceCache | None = None
+_cache_lock = threading.Lock()
+_cache_initialised = False
+
+
+def get_kspace_cache() -> KSpaceCache | None:
+    """Return the kspace cache shared by the application.
+
+    The cache is created on first use in SCANHUB_KSPACE_CACHE (a directory,
+    defaults to ~/.cache/scanhub-mri-device-simulator/kspace, "off" disables
+    the cache), SCANHUB_KSPACE_CACHE_MB sets its size.
+
+    Returns
+    -------
+        KSpaceCache: the shared cache, None if it is disabled or unavailable
+    """
+    global _cache, _cache_initialised
+    with _cache_lock:
+        if not _cache_initialised:
+            _cache_initialised = True
+            default = Path.home() / ".cache" / "scanhub-mri-device-simulator" / "kspace"
+            directory = os.environ.get("SCANHUB_KSPACE_CACHE", str(default))
+            if directory.lower() not in ("", "off"):
+                size = int(os.environ.get("SCANHUB_KSPACE_CACHE_MB", "1024"))
+                try:
+                    _cache = KSpaceCache(directory, size * 2**20)
+                    log.info(f"Kspace cache: {_cache}")
+                except OSError:
+                    log.warning("Kspace cache disabled", exc_info=True)
+        return _cache
@@ -0,0 +1,230 @@
+# Copyright (C) 2023, BRAIN-LINK UG (haftungsbeschränkt). All Rights Reserved.
+# SPDX-License-Identifier: GPL-3.0-only OR LicenseRef-ScanHub-Commercial
+
+"""Contains the definition of the KSpaceParameters and KSpacePipeline classes."""
+
+from dataclasses import asdict, dataclass, fields
+from typing import Any
+
+import numpy as np
+
+from imagemanipulators import ImageManipulators, Stage
+
+
+@dataclass(frozen=True)
+class KSpaceParameters:
+    """Settings of the kspace modifiers and the displays.
+
+    The defaults leave the kspace unchanged. The values use the same units as
+    the controls of the user interface.
+    """
+
+    signal_to_noise: float = 30  # dB, 30 disables noise
+    noise_seed: int = 0  # the same seed gives the same noise
+    spikes: tuple[tuple[int, int], ...] = ()  # (row, column)
+    patches: tuple[tuple[int, int, int], ...] = ()  # (row, column, size)
+    scan_percentage: float = 100
+    partial_fourier: float = 100
+    zero_fill: bool = False
+    high_pass: float = 0  # radius in percent
+    low_pass: float = 100  # radius in percent
+    undersample: int = 1
+    compress: bool = False
+    decrease_dc: int = 0  # percent
+    hamming: bool = False
+    filling: float = 100  # acquisition progress in percent
+    filling_mode: int = 0
+    kspace_const: int = -3
+    window_width: float = 1
+    window_center: float = 0.5
+
+    @classmethod
+    def from_dict(cls, values: dict[str, Any]) -> "KSpaceParameters":
+        """Create parameters from a dict, e.g. a parsed JSON parameter file.
+
+        Parameters
+        ----------
+            values : dict
+                field names and values, missing fields keep their default
+
+        Returns
+        -------
+            KSpaceParameters: the parameters
+        """
+        names = {f.name for f in fields(cls)}
+        unknown = set(values) - names
+        if unknown:
+            raise ValueError(f"Unknown kspace parameters: {sorted(unknown)}")
+        values = dict(values)
+        for name in ("spikes", "patches"):
+            if name in values:
+                values[name] = tuple(tuple(int(v) for v in item) for item in values[name])
+        return cls(**values)
+
+    def to_dict(self) -> dict[str, Any]:
+        """Return the parameters as a JSON serialisable dict."""
+        return asdict(self)
+
+
+class KSpacePipeline:
+    """Runs the kspace modifier chain of ImageManipulators without Qt.
+
+    The same engine is used by the user interface (SimulationApp) and by
+    scripts. Applying new parameters to the same ImageManipulators instance
+    reuses the cached output of all stages whose parameters did not change.
+    """
+
+    @staticmethod
+    def stages(im: ImageManipulators, params: KSpaceParameters) -> list[Stage]:
+        """Build the list of active modifier stages.
+
+        Parameters
+        ----------
+            im : ImageManipulators
+                the image and kspace pair to be modified
+            params : KSpaceParameters
+                modifier settings
+
+        Returns
+        -------
+            list: stages in the order of application
+        """
+        stages = []
+
+        # 01 - Noise
+        if params.signal_to_noise < 30:
+            noise = (params.signal_to_noise, params.noise_seed)
+            stages.append(Stage("noise", im.apply_noise, noise, hermitian=False))
+
+        # 02 - Spikes
+        if params.spikes:
+            stages.append(Stage("spikes", im.apply_spikes, (params.spikes,), hermitian=False))
+
+        # 03 - Patches
+        if params.patches:
+            stages.append(Stage("patches", im.apply_patches, (params.patches,), hermitian=False))
+
+        # 04 - Reduced scan percentage (one line more is removed at the bottom)
+        if int(params.scan_percentage) < 100:
+            stages.append(Stage("rdc", im.reduced_scan_percentage, (params.scan_percentage,), hermitian=False))
+
+        # 05 - Partial fourier
+        if int(params.partial_fourier) != 100:
+            stages.append(
+                Stage(
+                    "partial_fourier",
+                    im.partial_fourier,
+                    (params.partial_fourier, params.zero_fill),
+                    hermitian=not params.zero_fill,
+                )
+            )
+
+        # 06 - High pass filter
+        if params.high_pass > 0:
+            stages.append(Stage("high_pass", im.high_pass_filter, (params.high_pass,)))
+
+        # 07 - Low pass filter
+        if params.low_pass < 100:
+            stages.append(Stage("low_pass", im.low_pass_filter, (params.low_pass,)))
+
+        # 08 - Undersample k-space
+        if int(params.undersample) > 1:
+            stages.append(
+                Stage(
+                    "undersample",
+                    im.undersample,
+                    (int(params.undersample), params.compress),
+                    hermitian=not params.compress,
+                )
+            )
+
+        # 09 - DC signal decrease
+        if int(params.decrease_dc) > 1:
+            stages.append(Stage("decrease_dc", im.decrease_dc, (int(params.decrease_dc),)))
+
+        # 10 - Hamming filter (np.hamming is centred between two samples)
+        if params.hamming:
+            stages.append(Stage("hamming", im.hamming, hermitian=False))
+
+        # 11 - Acquisition simulation progress, spiral and radial trajectories
+        # are gridded onto the Cartesian kspace even when they are complete
+        trajectory = im.trajectories.get(params.filling_mode)
+        if trajectory:
+            stages.append(Stage("precompensation", im.gridding_precompensation, (trajectory,)))
+            filling = (params.filling, params.filling_mode)
+            stages.append(Stage("filling", im.trajectory_filling, filling, hermitian=False))
+        elif params.filling < 100:
+            stages.append(Stage("filling", im.filling, (params.filling, params.filling_mode), hermitian=False))
+
+        return stages
+
+    def apply(self, im: ImageManipulators, params: KSpaceParameters, displays: bool = True):
+        """Apply the modifiers to im.kspacedata and reconstruct im.img.
+
+        Parameters
+        ----------
+            im : ImageManipulators
+                the image and kspace pair to be modified
+            params : KSpaceParameters
+                modifier and display settings
+            displays : bool
+                prepare the display arrays (this windows im.img in place)
+        """
+        stages = self.stages(im, params)
+        hermitian = im.apply_stages(stages)
+        # Filling playback only transforms the lines added since the last step
+        if not im.filling_reconstruction(stages):
+            im.np_ifft(kspace=im.kspacedata, out=im.img, hermitian=hermitian)
+
+        if displays:
+            win_val = {"ww": params.window_width, "wc": params.window_center}
+            im.prepare_displays(int(params.kspace_const), win_val)
+
+    def run(
+        self, data: np.ndarray, params: KSpaceParameters, is_image: bool = True, precision: str = "single"
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Simulate an acquisition of an image or raw kspace.
+
+        Parameters
+        ----------
+            data : np.ndarray
+                2D image or complex kspace (or a stack of them)
+            params : KSpaceParameters
+                modifier settings
+            is_image : bool
+                True if data is an image, False if it is raw kspace
+            precision : str
+                "single" or "double", the dtypes of the results
+
+        Returns
+        -------
+            tuple: (kspace, magnitude image)
+        """
+        im = ImageManipulators(data, is_image, precision)
+        self.apply(im, params, displays=False)
+        return im.kspacedata.copy(), im.img.copy()
+
+    def run_stack(
+        self, stack: np.ndarray, params: KSpaceParameters, is_image: bool = True, precision: str = "single"
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Simulate acquisitions of a stack of images or raw kspace slices.
+
+        The whole stack is processed by one ImageManipulators instance, so
+        every modifier and FFT runs over all slices in a single call.
+
+        Parameters
+        ----------
+            stack : np.ndarray
+                3D array, the first axis indexes the inputs
+            params : KSpaceParameters
+                modifier settings applied to every input
+            is_image : bool
+                True if the stack holds images, False if it holds raw kspace
+            precision : str
+                "single" or "double", the dtypes of the results
+
+        Returns
+        -------
+            tuple: (kspace stack, magnitude image stack)
+        """
+        return self.run(stack, params, is_image, precision)
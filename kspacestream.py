@@ -0,0 +1,241 @@
+# Copyright (C) 2023, BRAIN-LINK UG (haftungsbeschränkt). All Rights Reserved.
+# SPDX-License-Identifier: GPL-3.0-only OR LicenseRef-ScanHub-Commercial
+
+"""Contains the definition of the KSpaceStreamer class."""
+
+import io
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Iterator
+
+import numpy as np
+import requests
+
+from maskcache import mask_cache
+
+log = logging.getLogger(__name__)
+
+STREAM_URL = "http://localhost:8080/api/v1/workflow/stream/{record_id}"
+
+
+def line_order(shape: tuple[int, ...], mode: int) -> np.ndarray:
+    """Return the kspace rows in the order they are acquired by a filling mode.
+
+    Parameters
+    ----------
+        shape : tuple
+            kspace shape, the last two axes are (rows, columns)
+        mode : int
+            filling mode, see MaskCache.filling_order. Spiral and radial
+            trajectories are gridded onto the Cartesian kspace, their rows
+            are sent in linear order.
+
+    Returns
+    -------
+        np.ndarray: row indices in acquisition order
+    """
+    rows, cols = shape[-2:]
+    try:
+        order = mask_cache.filling_order((rows, cols), mode)
+    except ValueError:
+        return np.arange(rows)
+    return order[::cols] // cols  # First sample of every line
+
+
+def record_dtype(kspace: np.ndarray) -> np.dtype:
+    """Return the dtype of a streamed readout: the row index and the row of every channel."""
+    return np.dtype([("line", "<i4"), ("data", kspace.dtype, kspace.shape[:-2] + kspace.shape[-1:])])
+
+
+class KSpaceStreamer:
+    """Streams the readout lines of an acquisition while it is simulated.
+
+    A producer thread releases the kspace rows in acquisition order, one
+    every repetition time (TR), timed against absolute deadlines of
+    time.perf_counter so the rate does not drift. A sender thread posts them
+    as one chunked HTTP request on a persistent connection, the body is an
+    .npy file of records (see record_dtype), so the receiver can parse the
+    fixed size records as they arrive or load the complete body with
+    np.load. A stream that is still sending when the next acquisition
+    starts keeps running, so back to back scans are not cut short.
+
+    The deadlines count from the start of the playback, the lines that are
+    due while the kspace is simulated are sent at once when it is ready.
+    """
+
+    def __init__(self, url: str = STREAM_URL, lines_per_chunk: int = 1, timeout: tuple[float, float] = (5.0, 300.0)):
+        """Initialise the streamer and its session.
+
+        Parameters
+        ----------
+            url : str
+                stream endpoint, {record_id} is replaced by the record id
+            lines_per_chunk : int
+                readout lines sent together (a segment)
+            timeout : tuple
+                connect and read timeout in seconds
+        """
+        self.url = url
+        self.lines_per_chunk = lines_per_chunk
+        self.timeout = timeout
+        self._session = requests.Session()
+        self._stops: dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        """True while an acquisition is streamed."""
+        with self._lock:
+            return bool(self._stops)
+
+    def start(
+        self,
+        record_id: str,
+        kspace: Callable[[], np.ndarray],
+        mode: int,
+        duration: float,
+        progress: float = 0,
+        callback: Callable[[str, bool], None] | None = None,
+        started: float | None = None,
+    ):
+        """Start streaming an acquisition, a running stream of the same record is replaced.
+
+        Parameters
+        ----------
+            record_id : str
+                id of the ScanHub record
+            kspace : callable
+                returns the fully acquired kspace, called on the producer thread
+            mode : int
+                filling mode, the acquisition order of the lines
+            duration : float
+                playback time of the remaining lines in seconds
+            progress : float
+                acquisition progress in percent, the lines acquired before are not sent
+            callback : callable
+                called with the record id and True on success on the sender thread,
+                not called if the stream is stopped or replaced
+            started : float
+                time.perf_counter() when the playback started, defaults to now
+        """
+        if started is None:
+            started = time.perf_counter()
+        stop = threading.Event()
+        with self._lock:
+            if record_id in self._stops:
+                self._stops[record_id].set()
+            self._stops[record_id] = stop
+        chunks: queue.Queue[bytes | None] = queue.Queue()
+        producer = threading.Thread(
+            target=self._produce,
+            args=(kspace, mode, duration, progress, started, chunks, stop),
+            name="KSpaceStreamProducer",
+            daemon=True,
+        )
+        sender = threading.Thread(
+            target=self._send, args=(record_id, chunks, stop, callback), name="KSpaceStreamSender", daemon=True
+        )
+        producer.start()
+        sender.start()
+
+    def stop(self, record_id: str | None = None):
+        """Stop a running stream, the request is ended after the lines sent so far.
+
+        Does not wait for the response of the server, the callback of the
+        stream is not called (e.g. a paused acquisition is streamed again by
+        start when it is resumed).
+
+        Parameters
+        ----------
+            record_id : str
+                record of the stream, None stops all streams
+        """
+        with self._lock:
+            for key in list(self._stops):
+                if record_id is None or key == record_id:
+                    self._stops.pop(key).set()
+
+    def close(self):
+        """Stop the running stream and close the connection."""
+        self.stop()
+        self._session.close()
+
+    def _produce(
+        self,
+        kspace_source: Callable[[], np.ndarray],
+        mode: int,
+        duration: float,
+        progress: float,
+        start: float,
+        chunks: "queue.Queue[bytes | None]",
+        stop: threading.Event,
+    ):
+        try:
+            kspace = kspace_source()
+            order = line_order(kspace.shape, mode)
+            order = order[int(len(order) * progress / 100) :]
+            records = np.empty(len(order), dtype=record_dtype(kspace))
+            records["line"] = order
+            records["data"] = np.moveaxis(kspace[..., order, :], -2, 0)
+
+            header = io.BytesIO()
+            descr = np.lib.format.dtype_to_descr(records.dtype)
+            info = {"descr": descr, "fortran_order": False, "shape": records.shape}
+            np.lib.format.write_array_header_1_0(header, info)
+            chunks.put(header.getvalue())
+
+            tr = duration / max(len(records), 1)
+            log.info(f"Streaming {len(records)} lines, TR {tr * 1e3:.3f} ms")
+            late = 0  # Lines released after their deadline, e.g. while the kspace was simulated
+            for first in range(0, len(records), self.lines_per_chunk):
+                last = min(first + self.lines_per_chunk, len(records))
+                remaining = start + last * tr - time.perf_counter()
+                if remaining > 0:
+                    if stop.wait(remaining):
+                        break
+                elif stop.is_set():
+                    break
+                else:
+                    late += last - first
+                chunks.put(records[first:last].tobytes())
+            log.info(f"Streamed {len(records)} lines, {late} late")
+        except Exception:
+            log.error("Kspace stream failed", exc_info=True)
+            stop.set()
+        finally:
+            chunks.put(None)
+
+    def _send(
+        self,
+        record_id: str,
+        chunks: "queue.Queue[bytes | None]",
+        stop: threading.Event,
+        callback: Callable[[str, bool], None] | None,
+    ):
+        def body() -> Iterator[bytes]:
+            # A generator body is sent with chunked transfer encoding
+            while (chunk := chunks.get()) is not None:
+                yield chunk
+
+        url = self.url.format(record_id=record_id)
+        log.info(f"Streaming to {url}")
+        try:
+            response = self._session.post(
+                url, data=body(), headers={"Content-Type": "application/octet-stream"}, timeout=self.timeout
+            )
+            response.raise_for_status()
+            success = not stop.is_set()
+            log.info(f"Stream of record {record_id} finished: {response.text}")
+        except requests.RequestException:
+            log.error(f"Stream of record {record_id} failed", exc_info=True)
+            success = False
+            stop.set()
+        with self._lock:
+            # Stopped or replaced by a new stream of the record otherwise
+            current = self._stops.get(record_id) is stop
+            if current:
+                del self._stops[record_id]
+        if current and callback is not None:
+            callback(record_id, success)
@@ -12,6 +12,7 @@ from pathlib import Path
 from PySide6.QtGui import QFontDatabase, QIcon
 from PySide6.QtWidgets import QApplication
 
+from fftengine import get_fft_engine
 from simulationapp import SimulationApp
 
 # Logging setup
@@ -33,6 +34,7 @@ if sys.version_info >= (3, 8):  # importlib.metadata needs Python 3.8 or newer
     )
 else:
     log.info("Pillow: n/a, PySide6: n/a, numpy: n/a, pydicom: n/a")
+log.info(f"FFT: {get_fft_engine()}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,232 @@
+# Copyright (C) 2023, BRAIN-LINK UG (haftungsbeschränkt). All Rights Reserved.
+# SPDX-License-Identifier: GPL-3.0-only OR LicenseRef-ScanHub-Commercial
+
+"""Contains the definition of the MaskCache class."""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Callable
+
+import numpy as np
+import numpy.typing as npt
+
+EPI_SEGMENTS = 4  # Shots of the interleaved segmented EPI filling mode
+
+
+class MaskCache:
+    """Least recently used cache for kspace masks and windows.
+
+    Entries are keyed by (shape, kind, parameter) and are returned read-only,
+    because they are shared by every caller with the same key. The cache is
+    bounded by the number of entries and by the total memory of the arrays.
+    The most recently created entry is kept even if it exceeds max_bytes on
+    its own, so an oversized value is built once instead of on every call.
+    """
+
+    def __init__(self, max_entries: int = 32, max_bytes: int = 256 * 2**20):
+        """Initialise an empty cache.
+
+        Parameters
+        ----------
+            max_entries : int
+                maximum number of cached arrays
+            max_bytes : int
+                maximum total size of the cached arrays in bytes
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[Any, Any] = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self) -> int:
+        """Total size of the cached arrays in bytes."""
+        return self._nbytes
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def get(self, key: Any, factory: Callable[[], Any]) -> Any:
+        """Return the cached value for key, creating it with factory if missing.
+
+        Parameters
+        ----------
+            key : Any
+                hashable key, by convention (shape, kind, parameter)
+            factory : Callable
+                function without arguments returning an array or a tuple of arrays
+
+        Returns
+        -------
+            Any: the cached (read-only) value
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        value = factory()
+        arrays = value if isinstance(value, tuple) else (value,)
+        for array in arrays:
+            array.setflags(write=False)
+        size = sum(array.nbytes for array in arrays)
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = value
+                self._nbytes += size
+            while len(self._entries) > 1 and (len(self._entries) > self.max_entries or self._nbytes > self.max_bytes):
+                _, old = self._entries.popitem(last=False)
+                self._nbytes -= sum(a.nbytes for a in (old if isinstance(old, tuple) else (old,)))
+        return value
+
+    def radius_squared(self, shape: tuple[int, ...]) -> np.ndarray:
+        """Squared distance of every kspace sample from the kspace centre.
+
+        A radial mask of any radius is a single comparison with this map.
+
+        Parameters
+        ----------
+            shape : tuple
+                kspace shape (rows, columns)
+
+        Returns
+        -------
+            np.ndarray: int32 array of the given shape
+        """
+
+        def factory():
+            rows, cols = shape
+            a, b = rows // 2, cols // 2
+            y, x = np.ogrid[-a : rows - a, -b : cols - b]
+            return (x * x + y * y).astype(np.int32)
+
+        return self.get((tuple(shape), "radius_squared", None), factory)
+
+    def hamming(self, shape: tuple[int, ...], dtype: npt.DTypeLike = np.float32) -> np.ndarray:
+        """2D Hamming window.
+
+        Parameters
+        ----------
+            shape : tuple
+                kspace shape (rows, columns)
+            dtype : np.dtype
+                real dtype of the window, the working precision
+
+        Returns
+        -------
+            np.ndarray: window of the given shape
+        """
+        rows, cols = shape
+        return self.get(
+            (tuple(shape), "hamming", np.dtype(dtype)),
+            lambda: np.outer(np.hamming(rows), np.hamming(cols)).astype(dtype),
+        )
+
+    def undersample_rows(self, rows: int, factor: int) -> tuple[np.ndarray, np.ndarray]:
+        """Return the indices of the acquired and skipped lines for undersampling.
+
+        Every nth line is acquired, starting from the midline in both
+        directions.
+
+        Parameters
+        ----------
+            rows : int
+                number of kspace lines
+            factor : int
+                acceleration factor
+
+        Returns
+        -------
+            tuple: (acquired, skipped) line indices in ascending order
+        """
+
+        def factory():
+            acquired = np.zeros(rows, dtype=bool)
+            midline = rows // 2
+            acquired[midline::factor] = True
+            acquired[midline::-factor] = True
+            return np.flatnonzero(acquired), np.flatnonzero(~acquired)
+
+        return self.get((rows, "undersample", factor), factory)
+
+    def filling_order(self, shape: tuple[int, ...], mode: int) -> np.ndarray:
+        """Order in which the kspace samples are acquired by a filling mode.
+
+        Filling kspace up to a given progress zeroes the samples listed after
+        the cutoff, so a new ordering only needs a new table.
+
+        Parameters
+        ----------
+            shape : tuple
+                kspace shape (rows, columns)
+            mode : int
+                0: linear, 1: centric, 2: single shot blipped EPI,
+                4: interleaved segmented EPI (EPI_SEGMENTS shots)
+
+        Returns
+        -------
+            np.ndarray: flat sample index (row * columns + column) of every
+            acquisition step
+        """
+
+        def factory():
+            rows, cols = shape
+            if mode in (0, 2):
+                lines = np.arange(rows)
+                echoes = lines
+            elif mode == 1:
+                # Centre line first, then alternating one line above and one below
+                mid = rows // 2
+                lines = np.empty(rows, dtype=np.intp)
+                lines[0::2] = np.arange(mid, rows)
+                lines[1::2] = np.arange(mid - 1, -1, -1)
+                echoes = np.zeros(rows, dtype=np.intp)
+            elif mode == 4:
+                # Shot s acquires every EPI_SEGMENTS-th line, starting at line s
+                shots = [np.arange(s, rows, EPI_SEGMENTS) for s in range(EPI_SEGMENTS)]
+                lines = np.concatenate(shots)
+                echoes = np.concatenate([np.arange(len(shot)) for shot in shots])
+            else:
+                raise ValueError(f"Unknown filling mode: {mode}")
+
+            order = np.arange(rows * cols).reshape(rows, cols)[lines]
+            if mode in (2, 4):
+                # EPI reads every second echo of a shot backwards (zig-zag)
+                odd = echoes % 2 == 1
+                order[odd] = order[odd, ::-1]
+            return order.ravel()
+
+        return self.get((tuple(shape), "filling_order", mode), factory)
+
+    def centred_idft(self, n: int, dtype: np.dtype) -> np.ndarray:
+        """Matrix of the centred 1D inverse DFT, fftshift(ifft(ifftshift(x))).
+
+        Column k is the image domain contribution of kspace line k, so the
+        transform of a few lines is the product with those columns.
+
+        Parameters
+        ----------
+            n : int
+                transform length
+            dtype : np.dtype
+                complex dtype of the matrix
+
+        Returns
+        -------
+            np.ndarray: (n, n) matrix
+        """
+
+        def factory():
+            k = np.arange(n) - n // 2
+            return (np.exp(2j * np.pi * np.outer(k, k) / n) / n).astype(dtype)
+
+        return self.get((n, "centred_idft", np.dtype(dtype)), factory)
+
+
+# Cache shared by the ImageManipulators modifiers
+mask_cache = MaskCache()
@@ -0,0 +1,162 @@
+# Copyright (C) 2023, BRAIN-LINK UG (haftungsbeschränkt). All Rights Reserved.
+# SPDX-License-Identifier: GPL-3.0-only OR LicenseRef-ScanHub-Commercial
+
+"""Contains the definition of the NoiseEngine class."""
+
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+
+from maskcache import MaskCache
+
+log = logging.getLogger(__name__)
+
+BIT_GENERATORS = ("PCG64", "SFC64")
+
+
+class NoiseEngine:
+    """Reproducible complex Gaussian noise for kspace acquisitions.
+
+    The noise of an acquisition is defined by its seed: the same seed and
+    shape always give the same noise, bit for bit. The noise is generated
+    with unit power (each component has a standard deviation of 1/√2) and
+    cached, so a change of the signal-to-noise ratio only rescales it.
+    Noise for upcoming acquisitions can be generated in a background thread
+    with prefetch.
+    """
+
+    def __init__(self, bit_generator: str = "PCG64", max_entries: int = 4, max_bytes: int = 512 * 2**20):
+        """Initialise the engine with an empty noise cache.
+
+        Parameters
+        ----------
+            bit_generator : str
+                "PCG64" or "SFC64"
+            max_entries : int
+                maximum number of cached noise arrays
+            max_bytes : int
+                maximum total size of the cached noise arrays in bytes
+        """
+        if bit_generator not in BIT_GENERATORS:
+            raise ValueError(f"Unknown bit generator: {bit_generator}")
+        self.bit_generator = bit_generator
+        self._cache = MaskCache(max_entries, max_bytes)
+        self._lock = threading.Lock()
+        self._pending: dict[tuple, Future] = {}
+        self._executor: ThreadPoolExecutor | None = None
+
+    def __repr__(self) -> str:
+        """Return the bit generator, e.g. for the log file."""
+        return f"NoiseEngine(bit_generator={self.bit_generator!r})"
+
+    def generator(self, seed: int) -> np.random.Generator:
+        """Return a new random number generator for a seed.
+
+        Parameters
+        ----------
+            seed : int
+                seed of the acquisition
+
+        Returns
+        -------
+            np.random.Generator: the generator
+        """
+        return np.random.Generator(getattr(np.random, self.bit_generator)(seed))
+
+    def fill(self, out: np.ndarray, seed: int):
+        """Fill a complex array with unit power Gaussian noise.
+
+        The components are drawn directly into out (as a real view), so no
+        float64 temporaries are created.
+
+        Parameters
+        ----------
+            out : np.ndarray
+                C-contiguous complex64 or complex128 array
+            seed : int
+                seed of the acquisition
+        """
+        components = out.view(out.real.dtype)
+        self.generator(seed).standard_normal(out=components, dtype=components.dtype)
+        components *= np.sqrt(0.5)
+
+    def unit_noise(self, shape: tuple[int, ...], dtype: np.dtype, seed: int) -> np.ndarray:
+        """Return the cached unit power noise of an acquisition.
+
+        Parameters
+        ----------
+            shape : tuple
+                kspace shape
+            dtype : np.dtype
+                complex dtype of the kspace
+            seed : int
+                seed of the acquisition
+
+        Returns
+        -------
+            np.ndarray: read-only complex noise
+        """
+        key = (tuple(shape), "noise", (np.dtype(dtype), self.bit_generator, seed))
+        with self._lock:
+            pending = self._pending.get(key)
+        if pending is not None:
+            return pending.result()
+        return self._cache.get(key, lambda: self._generate(shape, dtype, seed))
+
+    def prefetch(self, shape: tuple[int, ...], dtype: np.dtype, seed: int):
+        """Generate the noise of an upcoming acquisition in the background.
+
+        Parameters
+        ----------
+            shape : tuple
+                kspace shape
+            dtype : np.dtype
+                complex dtype of the kspace
+            seed : int
+                seed of the acquisition
+        """
+        key = (tuple(shape), "noise", (np.dtype(dtype), self.bit_generator, seed))
+        with self._lock:
+            if key in self._pending:
+                return
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="NoiseEngine")
+
+            def generate():
+                try:
+                    return self._cache.get(key, lambda: self._generate(shape, dtype, seed))
+                finally:
+                    with self._lock:
+                        del self._pending[key]
+
+            self._pending[key] = self._executor.submit(generate)
+        log.debug(f"Prefetching noise: {key}")
+
+    def clear(self):
+        """Remove the cached noise, e.g. when the noise is switched off."""
+        self._cache.clear()
+
+    def _generate(self, shape: tuple[int, ...], dtype: np.dtype, seed: int) -> np.ndarray:
+        noise = np.empty(shape, dtype=dtype)
+        self.fill(noise, seed)
+        return noise
+
+
+_engine: NoiseEngine | None = None
+_engine_lock = threading.Lock()
+
+
+def get_noise_engine() -> NoiseEngine:
+    """Return the noise engine shared by the application.
+
+    Returns
+    -------
+        NoiseEngine: the shared engine, created on first use
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = NoiseEngine()
+        return _engine
@@ -0,0 +1,202 @@
+# Copyright (C) 2023, BRAIN-LINK UG (haftungsbeschränkt). All Rights Reserved.
+# SPDX-License-Identifier: GPL-3.0-only OR LicenseRef-ScanHub-Commercial
+
+"""Contains the definition of the SharedArrays class."""
+
+import os
+import threading
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import NamedTuple
+
+import numpy as np
+import numpy.typing as npt
+
+
+class ArrayDescriptor(NamedTuple):
+    """Identifies an array in a shared memory block, small enough to be sent to other processes."""
+
+    name: str  # name of the shared memory block
+    shape: tuple[int, ...]
+    dtype: str
+
+
+class SharedArrays:
+    """Allocates numpy arrays in shared memory blocks.
+
+    Every array gets its own block, owned by the process that created it.
+    Other processes attach to an array with the descriptor of it (see
+    attach), they see and modify the same memory without copying it. The
+    blocks are removed by close() or release(), attached processes should
+    detach first.
+    """
+
+    # Names of the blocks created by all allocators of this process, see attach
+    _owned: set[str] = set()
+    _owned_lock = threading.Lock()
+
+    def __init__(self):
+        """Initialise an allocator without blocks."""
+        self._blocks: dict[int, SharedMemory] = {}  # By the address of the array data
+        self._lock = threading.Lock()
+
+    def zeros(self, shape: tuple[int, ...], dtype: npt.DTypeLike) -> np.ndarray:
+        """Return a new zero filled array in a shared memory block.
+
+        Parameters
+        ----------
+            shape : tuple
+                shape of the array
+            dtype : np.dtype
+                dtype of the array
+
+        Returns
+        -------
+            np.ndarray: C-contiguous array
+        """
+        dtype = np.dtype(dtype)
+        block = SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+        array: np.ndarray = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        array[...] = 0  # Blocks are zero filled on POSIX, not necessarily on Windows
+        with self._lock:
+            self._blocks[array.ctypes.data] = block
+        with SharedArrays._owned_lock:
+            SharedArrays._owned.add(block.name)
+        return array
+
+    def array(self, data: np.ndarray, dtype: npt.DTypeLike) -> np.ndarray:
+        """Return a copy of data in a shared memory block.
+
+        Parameters
+        ----------
+            data : np.ndarray
+                data to be copied
+            dtype : np.dtype
+                dtype of the copy
+
+        Returns
+        -------
+            np.ndarray: C-contiguous copy
+        """
+        data = np.asarray(data)
+        array = self.zeros(data.shape, dtype)
+        array[...] = data
+        return array
+
+    def descriptor(self, array: np.ndarray) -> ArrayDescriptor:
+        """Return the descriptor of an array allocated by this instance.
+
+        Parameters
+        ----------
+            array : np.ndarray
+                array returned by zeros or array
+
+        Returns
+        -------
+            ArrayDescriptor: block name, shape and dtype
+        """
+        with self._lock:
+            block = self._blocks.get(array.ctypes.data)
+        if block is None:
+            raise ValueError("The array is not in a shared memory block of this allocator")
+        return ArrayDescriptor(block.name, array.shape, array.dtype.str)
+
+    def release(self, array: np.ndarray):
+        """Remove the block of an array, the array must not be used afterwards."""
+        with self._lock:
+            block = self._blocks.pop(array.ctypes.data, None)
+        if block is not None:
+            _remove(block)
+
+    def close(self):
+        """Remove all blocks, the arrays must not be used afterwards."""
+        with self._lock:
+            blocks = list(self._blocks.values())
+            self._blocks.clear()
+        for block in blocks:
+            _remove(block)
+
+    def __del__(self):
+        """Remove the blocks when the allocator is garbage collected."""
+        self.close()
+
+
+def _remove(block: SharedMemory):
+    with SharedArrays._owned_lock:
+        SharedArrays._owned.discard(block.name)
+    try:
+        block.close()
+    except BufferError:
+        pass  # Still referenced by an array, the mapping is freed with it
+    try:
+        block.unlink()
+    except FileNotFoundError:
+        pass
+
+
+# Blocks attached by this process, they must stay open while their arrays are used
+_attached: dict[str, SharedMemory] = {}
+_attached_lock = threading.Lock()
+
+
+def _own_tracker() -> bool:
+    """Return whether the resource tracker was started by this process.
+
+    Child processes of multiprocessing share the tracker of their parent if it
+    was running when they were started, otherwise they start their own. The
+    tracker of this process is a child process of it, a spawned child does not
+    know the pid of an inherited tracker. multiprocessing has no public API
+    for this, if the pid is not available the tracker is assumed to be owned,
+    so it cannot remove the blocks of other processes.
+    """
+    pid = getattr(getattr(resource_tracker, "_resource_tracker", None), "_pid", 0)
+    if pid is None:
+        return False
+    if not pid:
+        return True
+    try:
+        os.waitpid(pid, os.WNOHANG)
+    except ChildProcessError:
+        return False
+    return True
+
+
+def attach(descriptor: ArrayDescriptor) -> np.ndarray:
+    """Return an array of another process without copying it.
+
+    Parameters
+    ----------
+        descriptor : ArrayDescriptor
+            descriptor returned by SharedArrays.descriptor
+
+    Returns
+    -------
+        np.ndarray: the shared array
+    """
+    with _attached_lock:
+        block = _attached.get(descriptor.name)
+        if block is None:
+            # The owner removes the block, a resource tracker of this process must not
+            # remove it when the process exits. The tracker of the owner (this process
+            # or a shared one) keeps its registration, the owner unregisters it on unlink.
+            try:
+                block = SharedMemory(name=descriptor.name, track=False)  # type: ignore  # Python 3.13
+            except TypeError:
+                block = SharedMemory(name=descriptor.name)
+                with SharedArrays._owned_lock:
+                    owned = descriptor.name in SharedArrays._owned
+                if os.name == "posix" and not owned and _own_tracker():
+                    resource_tracker.unregister(block._name, "shared_memory")  # type: ignore
+            _attached[descriptor.name] = block
+    return np.ndarray(descriptor.shape, dtype=np.dtype(descriptor.dtype), buffer=block.buf)
+
+
+def detach(descriptor: ArrayDescriptor):
+    """Close a block attached by attach, its arrays must not be used afterwards."""
+    with _attached_lock:
+        block = _attached.pop(descriptor.name, None)
+    if block is not None:
+        try:
+            block.close()
+        except BufferError:
+            pass  # Still referenced by an array, the mapping is freed with it
@@ -6,25 +6,30 @@
 import logging
 import os
 import pathlib
+import random
 import sys
+import time
+from dataclasses import replace
 
 import numpy as np
 
 import logging.config
-from uuid import uuid4
 
-import PIL
-import pydicom
 from PIL import Image
-from pydicom import errors
 from PySide6 import QtQuick
 from PySide6.QtCore import QObject, Qt, Slot
 from PySide6.QtQml import QQmlApplicationEngine
 from PySide6.QtWidgets import QMessageBox
 
+import fileloaders
 from acquisitioncontrol import AcquisitionControl
+from computeworker import ComputeWorker, DisplayFrame
 from imagemanipulators import ImageManipulators
+from imageprefetcher import ImagePrefetcher
 from imageprovider import ImageProvider
+from kspacepipeline import KSpaceParameters, KSpacePipeline
+from noiseengine import get_noise_engine
+from thumbnailcache import ThumbnailCache
 
 log = logging.getLogger(__name__)
 
@@ -63,9 +68,10 @@ def qt_msgbox(text="", fatal=False):
 def open_file(path: str, dtype: np.dtype = np.float32) -> np.ndarray:  # type: ignore
     """Try to load image data into a NumPy ndarray.
 
-    The function first tries to use the PIL Image library to identify and load
-    the image. PIL will convert the image to 8-bit pixels, black and white.
-    If PIL fails pydicom is the next choice.
+    The format is detected from the file's signature or extension and the
+    file is opened by the matching loader of fileloaders.py. Images are
+    converted to 8-bit pixels, black and white, DICOM files are read with
+    pydicom and raw data (.npy) is memory mapped.
 
     Parameters
     ----------
@@ -79,35 +85,15 @@ def open_file(path: str, dtype: np.dtype = np.float32) -> np.ndarray:  # type: i
         np.ndarray: a floating point NumPy ndarray of the specified dtype
     """
     try:
-        log.info(f"Opening file: {path}")
-        with Image.open(path) as f:
-            img_file = f.convert("F")  # 'F' mode: 32-bit floating point pixels
-            img_pixel_array = np.array(img_file).astype(dtype)
-
-        log.info(f"Image loaded. Image size: {img_pixel_array.shape}")
-        return img_pixel_array
+        return fileloaders.load(path, dtype)
     except FileNotFoundError:
         log.error("File not found", exc_info=True)
         if "im" not in globals():  # Quit gracefully if first start fails
             qt_msgbox(f"File not found. ({path}).", fatal=True)
         raise FileNotFoundError(f"File not found. ({path}).")
-    except PIL.UnidentifiedImageError:
-        log.info("Filetype is not recognised by PIL. Trying pydicom.")
-        try:
-            with pydicom.dcmread(path) as dcm_file:
-                img_pixel_array = dcm_file.pixel_array.astype(dtype)
-            img_pixel_array.setflags(write=True)
-            log.info(f"DICOM loaded. Image size: {img_pixel_array.shape}")
-            return img_pixel_array
-        except errors.InvalidDicomError:
-            log.info("Cannot open with pydicom. Trying to open as raw data.")
-            try:
-                raw_data = np.load(path)
-                log.info(f"Raw data loaded. Data size: {raw_data.shape}")
-                return raw_data
-            except Exception as e:
-                log.error("Failed to open file", exc_info=True)
-                raise e
+    except Exception:
+        log.error("Failed to open file", exc_info=True)
+        raise
 
 
 class SimulationApp(QQmlApplicationEngine):
@@ -119,6 +105,35 @@ class SimulationApp(QQmlApplicationEngine):
     _default_image = "data/default.dcm"  # 'data/ca7cd7de-8639-415a-8556-06634041e4b2.dcm' # 'data/default.dcm'
     _app_path = pathlib.Path(__file__).parent.absolute()
     _default_image = str(_app_path.joinpath(_default_image))
+    # Working precision of the ImageManipulators, "single" or "double"
+    _precision = os.environ.get("SCANHUB_PRECISION", "single")
+    # Images before and after the current one that are opened in the background
+    _prefetch_radius = 2
+    # Stream the readout lines to ScanHub during the acquisition ("1") instead of uploading the kspace afterwards
+    _streaming = os.environ.get("SCANHUB_STREAMING", "0") == "1"
+    # Address of the HTTP server receiving the scan requests of ScanHub, "host:port"
+    _control_address = os.environ.get("SCANHUB_CONTROL_ADDRESS", "localhost:5000")
+
+    # QML controls, bound by their objectName in __init__
+    ui_image_display: QtQuick.QQuickItem
+    ui_kspace_display: QtQuick.QQuickItem
+    ui_noise_slider: QtQuick.QQuickItem
+    ui_compress: QtQuick.QQuickItem
+    ui_decrease_dc: QtQuick.QQuickItem
+    ui_partial_fourier_slider: QtQuick.QQuickItem
+    ui_undersample_kspace: QtQuick.QQuickItem
+    ui_high_pass_slider: QtQuick.QQuickItem
+    ui_low_pass_slider: QtQuick.QQuickItem
+    ui_ksp_const: QtQuick.QQuickItem
+    ui_filling: QtQuick.QQuickItem
+    ui_hamming: QtQuick.QQuickItem
+    ui_rdc_slider: QtQuick.QQuickItem
+    ui_zero_fill: QtQuick.QQuickItem
+    ui_droparea: QtQuick.QQuickItem
+    ui_filling_mode: QtQuick.QQuickItem
+    ui_thumbnails: QtQuick.QQuickItem
+    ui_play_btn: QtQuick.QQuickItem
+    ui_play_anim: QObject  # PropertyAnimation, not an item
 
     def __init__(self, parent=None):
         """Initialise the SimulationApp class."""
@@ -133,17 +148,33 @@ class SimulationApp(QQmlApplicationEngine):
         # TableEndpoint=http://127.0.0.1:10002/devstoreaccount1;'
 
         # Initialise member variables
+        host, _, port = self._control_address.rpartition(":")
         self._acquisition_control = AcquisitionControl(
             account_name="devstoreaccount1",
             account_key="Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw==",
             scanhub_id="#007",
             parent=parent,
+            streaming=self._streaming,
+            address=(host, int(port)),
         )
 
-        self._im = ImageManipulators(open_file(self._default_image), is_image=True)
+        self._pipeline = KSpacePipeline()
+        self._im = ImageManipulators(open_file(self._default_image), is_image=True, precision=self._precision)
 
         # Image manipulator and storage initialisation with default image
-        self.addImageProvider("imgs", ImageProvider(self._im))
+        self._im.prepare_textures()
+        self._thumbnails = ThumbnailCache()
+        self._provider = ImageProvider(self._im.image_texture.copy(), self._im.kspace_texture.copy(), self._thumbnails)
+        self._kspace_range = self._im.kspace_range.copy()
+        self.addImageProvider("imgs", self._provider)
+
+        # Kspace modifiers run in the background, results arrive as frames
+        self._worker = ComputeWorker(self._pipeline, self._thumbnails)
+        self._worker.resultReady.connect(self.show_frame)
+        self._prefetcher = ImagePrefetcher(self._precision)
+        if parent is not None:
+            parent.aboutToQuit.connect(self._worker.stop)
+            parent.aboutToQuit.connect(self._prefetcher.shutdown)
 
         # Expose the ... to the QML code
         # self.rootContext().setContextProperty("", self.)
@@ -199,6 +230,7 @@ class SimulationApp(QQmlApplicationEngine):
             "filling_mode",
             "thumbnails",
             "play_btn",
+            "play_anim",
         ]
 
         # Binding UI elements and controls
@@ -207,21 +239,60 @@ class SimulationApp(QQmlApplicationEngine):
 
         # Bind Acquisition Control to UI
         self._acquisition_control.signalStartMeasurement.connect(self.ui_play_btn.externalTriggerPlay)
+        self._acquisition_control.signalStartMeasurement.connect(self.acquisition_started)
+        self._acquisition_control.signalStopMeasurement.connect(self.acquisition_cancelled)
         self._acquisition_control.signalStart.emit()
 
         # Initialise an empty list of image paths that can later be filled
         self.url_list = []
         self.current_img = 0
-        self.file_data = []
         self.is_image = True
         self.channels = 1
-        self.img_instances = {}
+        self.channel = 0
+        self.noise_seed = random.getrandbits(32)
 
     @Slot(name="kspace_simulation_finished")
     def kspace_simulation_finished(self):
         """Call when the kspace simulation is finished."""
         print("kspace_simulation_finished")
-        self._acquisition_control.upload_data_to_blob(self._im.kspacedata, "raw-mri")
+        # Wait for the last filling step before uploading the kspace
+        self._worker.flush()
+        with self._worker.lock:
+            kspace = self._im.kspacedata.copy()
+        self._acquisition_control.upload_data_to_blob(kspace, "raw-mri")
+        self.new_acquisition()
+
+    @Slot()
+    def acquisition_started(self):
+        """Start streaming the acquisition when ScanHub started (or paused) the playback."""
+        if not self._streaming:
+            return
+        if not self.ui_play_anim.property("running"):
+            self._acquisition_control.stop_stream()
+            return
+        started = time.perf_counter()
+        params = replace(self.parameters(), filling=100)
+        im, pipeline = self._im, self._pipeline
+
+        def kspace() -> np.ndarray:
+            # The original kspace is read-only, so a copy with all lines acquired can be simulated in the background
+            return pipeline.run(im.orig_kspacedata, params, is_image=False, precision=im.precision)[0]
+
+        duration = self.ui_play_anim.property("duration") / 1000
+        progress = self.ui_filling.property("value")
+        self._acquisition_control.start_stream(kspace, params.filling_mode, duration, progress, started)
+
+    @Slot()
+    def acquisition_cancelled(self):
+        """Stop the playback of a scan cancelled by ScanHub, the next scan starts from the beginning."""
+        self.ui_play_anim.setProperty("running", False)
+        self.ui_filling.setProperty("value", 0)
+
+    def new_acquisition(self):
+        """Draw the noise seed of the next acquisition and generate its noise in the background if noise is on."""
+        self.noise_seed = random.getrandbits(32)
+        if self.ui_noise_slider.property("value") < 30:
+            get_noise_engine().prefetch(self._im.orig_kspacedata.shape, self._im.orig_kspacedata.dtype, self.noise_seed)
 
     def execute_load(self):
         """Replace the ImageManipulators class therefore changing the image.
@@ -233,25 +304,27 @@ class SimulationApp(QQmlApplicationEngine):
         try:
             path = self.url_list[self.current_img]
             log.info(f"Changing to image: {path}")
-            self.file_data = open_file(path)
-            self.is_image = False if len(self.file_data.shape) > 2 else True
+            # Usually opened and transformed in the background already
+            self._im = self._prefetcher.get(path)
         except (FileNotFoundError, ValueError, AttributeError):
+            log.error("Failed to open file", exc_info=True)
             # When the image is inaccessible at load time, the error
             qt_msgbox(f"Cannot load file ({self.url_list[self.current_img]})")
             del self.url_list[self.current_img]
             return
 
-        if self.is_image:
-            self.channels = 0
-            self.img_instances = {}
-            self._im = ImageManipulators(self.file_data, self.is_image)
-        else:
-            self.channels = self.file_data.shape[0]
-            for channel in range(self.channels):
-                # Extract 2D data slices from 3D array
-                file_data = self.file_data[channel, :, :]
-                self.img_instances[channel] = ImageManipulators(file_data, self.is_image)
-            self._im = self.img_instances[0]
+        # Open the neighbours in the list while this image is shown
+        count = len(self.url_list)
+        steps = [step for radius in range(1, self._prefetch_radius + 1) for step in (radius, -radius)]
+        neighbours = dict.fromkeys(self.url_list[(self.current_img + step) % count] for step in steps)
+        self._prefetcher.prefetch([neighbour for neighbour in neighbours if neighbour != path])
+
+        # 3D raw data is a stack of channels, processed together
+        self.is_image = self._im.img.ndim == 2
+        self.channels = 0 if self.is_image else self._im.img.shape[0]
+        self.channel = 0
+        self._thumbnails.clear()
+        self.new_acquisition()
 
         # Let the QML thumbnails list know about the number of channels
         self.ui_thumbnails.setProperty("model", self.channels)
@@ -308,15 +381,17 @@ class SimulationApp(QQmlApplicationEngine):
                 Index of the selected channel
 
         """
-        self._im = self.img_instances[int(channel)]
-        self.update_displays()
+        self.channel = int(channel)
+        self.refresh_displays()
 
     @Slot(str, name="save_img")
     def save_img(self, path):
         """Save the visible kspace and image to files.
 
-        Saves the 32 bit/pixel image if TIFF format is selected otherwise
-        the PNG file will have a depth of 8 bits.
+        Saves the 32 bit/pixel magnitude image if TIFF format is selected,
+        otherwise the PNG file holds the 8 bit display data. The display data
+        is rendered with the current window and kspace scaling (the shader
+        brightness, contrast and gamma are not applied).
 
         Parameters
         ----------
@@ -328,20 +403,31 @@ class SimulationApp(QQmlApplicationEngine):
         filename, ext = os.path.splitext(path[8:])  # Remove QUrl's "file:///"
         k_path = filename + "_k" + ext
         i_path = filename + "_i" + ext
-        if ext.lower() == ".tiff":
-            Image.fromarray(self._im.img).save(i_path)
-            Image.fromarray(self._im.kspace_display_data).save(k_path)
-        elif ext == ".png":
-            Image.fromarray(self._im.img).convert(mode="L").save(i_path)
-            Image.fromarray(self._im.kspace_display_data).convert(mode="L").save(k_path)
-        elif ext == ".npy":
-            np.save(i_path, self._im.img)
-            np.save(k_path, self._im.kspacedata)
+
+        # Save the visible channel of multi-channel data
+        def visible(data: np.ndarray) -> np.ndarray:
+            return data[self.channel] if data.ndim > 2 else data
+
+        # The worker must not modify the arrays while they are written
+        params = self.parameters()
+        with self._worker.lock:
+            win_val = {"ww": params.window_width, "wc": params.window_center}
+            self._im.prepare_displays(int(params.kspace_const), win_val)
+            if ext.lower() == ".tiff":
+                Image.fromarray(visible(self._im.img)).save(i_path)
+                Image.fromarray(visible(self._im.kspace_display_data)).save(k_path)
+            elif ext == ".png":
+                Image.fromarray(visible(self._im.image_display_data)).save(i_path)
+                Image.fromarray(visible(self._im.kspace_display_data)).save(k_path)
+            elif ext == ".npy":
+                np.save(i_path, visible(self._im.img))
+                np.save(k_path, visible(self._im.kspacedata))
 
     @Slot(float, float, name="add_spike")
     def add_spike(self, mouse_x, mouse_y):
         """Insert a spike at a location given by the UI.
 
+        Spikes are applied to all channels of multi-channel data.
         Values are saved in reverse order because NumPy's indexing conventions:
         array[row (== y), column (== x)]
 
@@ -358,6 +444,7 @@ class SimulationApp(QQmlApplicationEngine):
     def add_patch(self, mouse_x, mouse_y, radius):
         """Insert a patch at a location given by the UI.
 
+        Patches are applied to all channels of multi-channel data.
         Values are saved in reverse order because NumPy's indexing conventions:
         array[row (== y), column (== x)]
 
@@ -396,91 +483,96 @@ class SimulationApp(QQmlApplicationEngine):
 
     @Slot(name="update_displays")
     def update_displays(self):
-        """Trigger modifiers to kspace and updates the displays."""
-        self.image_change()
+        """Trigger modifiers to kspace and updates the displays.
 
-        # Replacing image source for QML Image elements - this will trigger
-        # requestPixmap. The image name must be different for Qt to display the
-        # new one, so a random string is appended to the end
-        self.ui_kspace_display.setProperty("source", "image://imgs/kspace_%s" % uuid4().hex)
-        self.ui_image_display.setProperty("source", "image://imgs/image_%s" % uuid4().hex)
+        The settings are read here, in the GUI thread, and computed by the
+        ComputeWorker. Requests that arrive while the worker is busy replace
+        each other, so only the newest one is computed.
+        """
+        params = self.parameters()
+        if params.signal_to_noise >= 30:
+            get_noise_engine().clear()  # Noise is off, the kspace sized noise is generated again when needed
+        self._worker.submit(self._im, params)
+
+    @Slot(object, name="show_frame")
+    def show_frame(self, frame: DisplayFrame):
+        """Display a frame finished by the ComputeWorker.
+
+        Parameters
+        ----------
+            frame : DisplayFrame
+                display data and the ImageManipulators it was computed from
+        """
+        if frame.im is not self._im:
+            # Computed before another image was loaded
+            return
+        self._provider.set_frame(frame.image, frame.kspace)
+        self._kspace_range = frame.kspace_range
+        changed = self._thumbnails.update(frame.thumbnails) if frame.thumbnails is not None else []
+        self.refresh_displays(changed)
+
+    def refresh_displays(self, thumbnails: list[int] | None = None):
+        """Reload the displays and thumbnails from the ImageProvider.
 
-        #  Iterate through thumbnails and set source image to trigger reload
+        Parameters
+        ----------
+            thumbnails : list
+                channels whose thumbnails are reloaded (none if None)
+        """
+        # The kspace shader normalises the log scaled magnitude to its range
+        kmin, kmax = self._kspace_range[self.channel] if self._kspace_range.ndim > 1 else self._kspace_range
+        self.ui_kspace_display.setProperty("kmin", float(kmin))
+        self.ui_kspace_display.setProperty("kmax", float(kmax))
+
+        # Replacing image source for QML Image elements - this will trigger
+        # requestImage. The image name contains the frame id and channel, so
+        # it changes with every frame and channel switch
+        frame_id = self._provider.frame_id
+        self.ui_kspace_display.setProperty("source", ImageProvider.source("kspace", frame_id, self.channel))
+        self.ui_image_display.setProperty("source", ImageProvider.source("image", frame_id, self.channel))
+
+        #  Iterate through thumbnails and set source image to trigger reload,
+        #  the image name contains the version of the channel's preview
+        changed = set(thumbnails or ())
+        if not changed:
+            return
         for item in self.ui_thumbnails.childItems()[0].childItems():
             try:
                 oname = item.childItems()[0].property("objectName")
-                source = "image://imgs/" + oname + "_%s" % uuid4().hex
-                item.childItems()[0].setProperty("source", source)
+                channel = int(oname[6:])
+                if channel in changed:
+                    source = ImageProvider.source("thumb", self._thumbnails.version(channel), channel)
+                    item.childItems()[0].setProperty("source", source)
             except IndexError:
                 # Highlight component of the ListView does not have childItems
                 pass
 
-    def image_change(self):
-        """Apply kspace modifiers to kspace and get resulting image."""
-        # Get a copy of the original k-space data to play with
-        self._im.resize_arrays(self._im.orig_kspacedata.shape)
-        self._im.kspacedata[:] = self._im.orig_kspacedata
-
-        # 01 - Noise
-        new_snr = self.ui_noise_slider.property("value")
-        generate_new = False
-        if new_snr != self._im.signal_to_noise:
-            generate_new = True
-            self._im.signal_to_noise = new_snr
-        self._im.add_noise(self._im.kspacedata, new_snr, self._im.noise_map, generate_new)
-
-        # 02 - Spikes
-        self._im.apply_spikes(self._im.kspacedata, self._im.spikes)
-
-        # 03 - Patches
-        self._im.apply_patches(self._im.kspacedata, self._im.patches)
-
-        # 04 - Reduced scan percentage
-        if self.ui_rdc_slider.property("enabled"):
-            v_ = self.ui_rdc_slider.property("value")
-            self._im.reduced_scan_percentage(self._im.kspacedata, v_)
-
-        # 05 - Partial fourier
-        if self.ui_partial_fourier_slider.property("enabled"):
-            v_ = self.ui_partial_fourier_slider.property("value")
-            zf = self.ui_zero_fill.property("checked")
-            self._im.partial_fourier(self._im.kspacedata, v_, zf)
-
-        # 06 - High pass filter
-        v_ = self.ui_high_pass_slider.property("value")
-        self._im.high_pass_filter(self._im.kspacedata, v_)
-
-        # 07 - Low pass filter
-        v_ = self.ui_low_pass_slider.property("value")
-        self._im.low_pass_filter(self._im.kspacedata, v_)
-
-        # 08 - Undersample k-space
-        v_ = self.ui_undersample_kspace.property("value")
-        if int(v_):
-            compress = self.ui_compress.property("checked")
-            self._im.undersample(self._im.kspacedata, int(v_), compress)
-
-        # 09 - DC signal decrease
-        v_ = self.ui_decrease_dc.property("value")
-        if int(v_) > 1:
-            self._im.decrease_dc(self._im.kspacedata, int(v_))
-
-        # 10 - Hamming filter
-        if self.ui_hamming.property("checked"):
-            self._im.hamming(self._im.kspacedata)
-
-        # 11 - Acquisition simulation progress
-        if self.ui_filling.property("value") < 100:
-            mode = self.ui_filling_mode.property("currentIndex")
-            self._im.filling(self._im.kspacedata, self.ui_filling.property("value"), mode)
-
-        # Get the resulting image
-        self._im.np_ifft(kspace=self._im.kspacedata, out=self._im.img)
-
-        # Get display properties
-        kspace_const = int(self.ui_ksp_const.property("value"))
-        # Window values
-        ww = self.ui_image_display.property("ww")
-        wc = self.ui_image_display.property("wc")
-        win_val = {"ww": ww, "wc": wc}
-        self._im.prepare_displays(kspace_const, win_val)
+    def parameters(self) -> KSpaceParameters:
+        """Read the modifier and display settings from the user interface.
+
+        Returns
+        -------
+            KSpaceParameters: the current settings
+        """
+        rdc_enabled = self.ui_rdc_slider.property("enabled")
+        pf_enabled = self.ui_partial_fourier_slider.property("enabled")
+        return KSpaceParameters(
+            signal_to_noise=self.ui_noise_slider.property("value"),
+            noise_seed=self.noise_seed,
+            spikes=tuple(self._im.spikes),
+            patches=tuple(self._im.patches),
+            scan_percentage=self.ui_rdc_slider.property("value") if rdc_enabled else 100,
+            partial_fourier=self.ui_partial_fourier_slider.property("value") if pf_enabled else 100,
+            zero_fill=self.ui_zero_fill.property("checked"),
+            high_pass=self.ui_high_pass_slider.property("value"),
+            low_pass=self.ui_low_pass_slider.property("value"),
+            undersample=int(self.ui_undersample_kspace.property("value")),
+            compress=self.ui_compress.property("checked"),
+            decrease_dc=int(self.ui_decrease_dc.property("value")),
+            hamming=self.ui_hamming.property("checked"),
+            filling=self.ui_filling.property("value"),
+            filling_mode=self.ui_filling_mode.property("currentValue"),
+            kspace_const=int(self.ui_ksp_const.property("value")),
+            window_width=self.ui_image_display.property("ww"),
+            window_center=self.ui_image_display.property("wc"),
+        )
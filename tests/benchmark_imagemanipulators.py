@@ -0,0 +1,257 @@
+# Copyright (C) 2023, BRAIN-LINK UG (haftungsbeschränkt). All Rights Reserved.
+# SPDX-License-Identifier: GPL-3.0-only OR LicenseRef-ScanHub-Commercial
+
+"""Micro-benchmarks of the ImageManipulators operations.
+
+Times the FFTs, every kspace modifier, all filling modes, a filling playback
+step of the pipeline and the display preparation for a sweep of matrix
+sizes, precisions and channel counts. The results are written as JSON and
+can be compared against a stored baseline:
+
+    python tests/benchmark_imagemanipulators.py --sizes 128 256 512 -o baseline.json
+    python tests/benchmark_imagemanipulators.py --sizes 128 256 512 -o new.json --baseline baseline.json
+
+The exit code is 1 if an operation got slower than the baseline by more than
+the threshold. There is no stored baseline, record one on the same machine
+first. The gridding operations (spiral and radial filling) are skipped above
+--gridding-max-size, their sparse operators take several GB at 2048².
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+import numpy as np
+
+# The benchmarks must not fill the kspace cache
+os.environ.setdefault("SCANHUB_KSPACE_CACHE", "off")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fftengine import get_fft_engine  # noqa: E402
+from imagemanipulators import ImageManipulators  # noqa: E402
+from kspacepipeline import KSpaceParameters, KSpacePipeline  # noqa: E402
+
+# An operation modifies the kspace (or other working arrays) of an instance in place
+Operation = Callable[[ImageManipulators, np.ndarray, int], None]
+
+
+def phantom(rows: int, cols: int, channels: int = 1) -> np.ndarray:
+    """Return a reproducible test image: ellipses with noise, a stack if channels > 1."""
+    y, x = np.mgrid[-1 : 1 : rows * 1j, -1 : 1 : cols * 1j]
+    image = 100.0 * ((x / 0.8) ** 2 + (y / 0.9) ** 2 < 1)
+    image += 50.0 * (((x - 0.2) / 0.3) ** 2 + (y / 0.4) ** 2 < 1)
+    image += np.random.default_rng(0).normal(0, 1, (rows, cols))
+    if channels > 1:
+        # Smooth coil sensitivities along x
+        weights = np.exp(-(((x[None] - np.linspace(-1, 1, channels)[:, None, None]) / 0.8) ** 2))
+        image = image[None] * weights
+    return image
+
+
+def pipeline_step(mode: int) -> Operation:
+    """Return a filling playback step of the pipeline (modifiers, filling and reconstruction)."""
+    pipeline = KSpacePipeline()
+
+    def step(im: ImageManipulators, kspace: np.ndarray, i: int):
+        # 0.5 % more kspace every repeat, like the playback animation
+        pipeline.apply(im, KSpaceParameters(filling=50 + 0.5 * (i % 90), filling_mode=mode), displays=True)
+
+    return step
+
+
+def trajectory_filling(trajectory: str, mode: int) -> Operation:
+    """Return the gridding of a complete trajectory from the original kspace."""
+
+    def fill(im: ImageManipulators, kspace: np.ndarray, i: int):
+        im._gridding_key = None  # Grid all samples
+        im.gridding_precompensation(im.kspacedata, trajectory)
+        im.trajectory_filling(im.kspacedata, 60, mode)
+
+    return fill
+
+
+# Operations that grid a spiral or radial trajectory
+GRIDDING_OPERATIONS = ("filling[spiral]", "filling[radial]", "playback step[spiral]")
+
+OPERATIONS: dict[str, Operation] = {
+    "np_fft": lambda im, k, i: im.np_fft(im.img, k),
+    "np_ifft": lambda im, k, i: im.np_ifft(k, im.img),
+    "np_ifft[hermitian]": lambda im, k, i: im.np_ifft(k, im.img, hermitian=True),
+    "apply_noise": lambda im, k, i: im.apply_noise(k, 10, 0),
+    "apply_noise[new seed]": lambda im, k, i: im.apply_noise(k, 10, i + 1),
+    "apply_spikes": lambda im, k, i: im.apply_spikes(k, [(10, 10), (20, 30), (40, 5)]),
+    "apply_patches": lambda im, k, i: im.apply_patches(k, [(10, 10, 3), (30, 20, 5)]),
+    "reduced_scan_percentage": lambda im, k, i: im.reduced_scan_percentage(k, 70),
+    "partial_fourier": lambda im, k, i: im.partial_fourier(k, 70, False),
+    "partial_fourier[zero fill]": lambda im, k, i: im.partial_fourier(k, 70, True),
+    "high_pass_filter": lambda im, k, i: im.high_pass_filter(k, 10),
+    "low_pass_filter": lambda im, k, i: im.low_pass_filter(k, 50),
+    "undersample": lambda im, k, i: im.undersample(k, 2, False),
+    "undersample[compress]": lambda im, k, i: im.undersample(k, 2, True),
+    "decrease_dc": lambda im, k, i: im.decrease_dc(k, 50),
+    "hamming": lambda im, k, i: im.hamming(k),
+    "filling[linear]": lambda im, k, i: im.filling(k, 60, 0),
+    "filling[centric]": lambda im, k, i: im.filling(k, 60, 1),
+    "filling[epi]": lambda im, k, i: im.filling(k, 60, 2),
+    "filling[segmented epi]": lambda im, k, i: im.filling(k, 60, 4),
+    "filling[spiral]": trajectory_filling("spiral", 3),
+    "filling[radial]": trajectory_filling("radial", 5),
+    "playback step[linear]": pipeline_step(0),
+    "playback step[epi]": pipeline_step(2),
+    "playback step[spiral]": pipeline_step(3),
+    "prepare_displays": lambda im, k, i: im.prepare_displays(-3, {"ww": 1, "wc": 0.5}),
+    "prepare_textures": lambda im, k, i: im.prepare_textures(),
+}
+
+
+def measure(operation: Operation, size: int, precision: str, channels: int, repeat: int, warmup: int) -> list[float]:
+    """Time an operation, the kspace is restored from the original one before every call (untimed).
+
+    Returns
+    -------
+        list: seconds of every timed call
+    """
+    im = ImageManipulators(phantom(size, size, channels), is_image=True, precision=precision)
+    times = []
+    for i in range(warmup + repeat):
+        im.resize_arrays(im.orig_kspacedata.shape)
+        im.kspacedata[:] = im.orig_kspacedata
+        start = time.perf_counter()
+        operation(im, im.kspacedata, i)
+        elapsed = time.perf_counter() - start
+        if i >= warmup:
+            times.append(elapsed)
+    return times
+
+
+def run(
+    operations: list[str],
+    sizes: list[int],
+    precisions: list[str],
+    channels: list[int],
+    repeat: int,
+    warmup: int,
+    gridding_max_size: int = 1024,
+) -> dict[str, Any]:
+    """Run the benchmark sweep, the gridding operations are skipped above gridding_max_size.
+
+    Returns
+    -------
+        dict: metadata of the environment and the results
+    """
+    results = []
+    for size in sizes:
+        for precision in precisions:
+            for count in channels:
+                for name in operations:
+                    if name in GRIDDING_OPERATIONS and size > gridding_max_size:
+                        continue
+                    times = measure(OPERATIONS[name], size, precision, count, repeat, warmup)
+                    result: dict[str, Any] = {
+                        "operation": name,
+                        "size": size,
+                        "precision": precision,
+                        "channels": count,
+                        "min": min(times),
+                        "median": statistics.median(times),
+                        "repeat": repeat,
+                    }
+                    results.append(result)
+                    print(f"{name:28} {size:5}² {precision:6} {count:2} ch  median {result['median'] * 1e3:10.3f} ms")
+    return {
+        "meta": {
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": sys.version.split()[0],
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "fft": repr(get_fft_engine()),
+        },
+        "results": results,
+    }
+
+
+def key(result: dict[str, Any]) -> tuple:
+    """Identify a result independent of its timings."""
+    return (result["operation"], result["size"], result["precision"], result["channels"])
+
+
+def compare(report: dict[str, Any], baseline: dict[str, Any], threshold: float) -> list[dict[str, Any]]:
+    """Compare the median times with a baseline.
+
+    Parameters
+    ----------
+        report : dict
+            results of run
+        baseline : dict
+            results of an earlier run
+        threshold : float
+            allowed slowdown, e.g. 0.25 for 25 %
+
+    Returns
+    -------
+        list: the regressions with the baseline median and the ratio
+    """
+    reference = {key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        old = reference.get(key(result))
+        if old is None or old["median"] <= 0:
+            continue
+        ratio = result["median"] / old["median"]
+        if ratio > 1 + threshold:
+            regressions.append({**result, "baseline": old["median"], "ratio": ratio})
+    return regressions
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Run the benchmarks with command line arguments.
+
+    Returns
+    -------
+        int: exit code, 1 if there are regressions
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the ImageManipulators operations.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[128, 256, 512, 1024, 2048], help="matrix sizes")
+    parser.add_argument("--precisions", nargs="+", choices=("single", "double"), default=["single", "double"])
+    parser.add_argument("--channels", type=int, nargs="+", default=[1], help="channel counts")
+    parser.add_argument("--operations", nargs="+", choices=list(OPERATIONS), default=list(OPERATIONS))
+    parser.add_argument(
+        "--gridding-max-size", type=int, default=1024, help="largest size of the spiral and radial filling"
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="timed calls per case")
+    parser.add_argument("--warmup", type=int, default=1, help="untimed calls per case")
+    parser.add_argument("-o", "--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown (default: 0.25 = 25 %%)")
+    args = parser.parse_args(argv)
+
+    report = run(
+        args.operations, args.sizes, args.precisions, args.channels, args.repeat, args.warmup, args.gridding_max_size
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as f:
+        regressions = compare(report, json.load(f), args.threshold)
+    for r in regressions:
+        print(
+            f"REGRESSION {r['operation']} {r['size']}² {r['precision']} {r['channels']} ch: "
+            f"{r['median'] * 1e3:.3f} ms, baseline {r['baseline'] * 1e3:.3f} ms ({r['ratio']:.2f}x)"
+        )
+    print(f"{len(regressions)} regressions (threshold {args.threshold:.0%})")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
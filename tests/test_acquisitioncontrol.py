@@ -0,0 +1,111 @@
+# Copyright (C) 2023, BRAIN-LINK UG (haftungsbeschränkt). All Rights Reserved.
+# SPDX-License-Identifier: GPL-3.0-only OR LicenseRef-ScanHub-Commercial
+
+"""Queue, query and cancel scans through the HTTP endpoints of the control server."""
+
+import json
+import sys
+from pathlib import Path
+from typing import Any, Iterator
+
+import pytest
+import requests
+
+pytest.importorskip("scanhub")
+QtCore = pytest.importorskip("PySide6.QtCore")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from acquisitioncontrol import AcquisitionControl, ScanState  # noqa: E402
+
+
+@pytest.fixture
+def control() -> Iterator[AcquisitionControl]:
+    """Return a control server on a free port that queues up to two scans."""
+    app = QtCore.QCoreApplication.instance() or QtCore.QCoreApplication([])
+    acquisition_control = AcquisitionControl("account", "key", "id", parent=app, address=("localhost", 0), max_jobs=2)
+    yield acquisition_control
+    acquisition_control.forceWorkerQuit()
+
+
+def url(control: AcquisitionControl, path: str) -> str:
+    """Return the URL of an endpoint of the control server."""
+    httpd = control._threaded_http_server.httpd
+    assert httpd is not None
+    return f"http://localhost:{httpd.server_address[1]}{path}"
+
+
+def start(control: AcquisitionControl, payload: Any) -> requests.Response:
+    """Request a scan."""
+    return requests.post(url(control, "/api/start-scan"), json=payload, timeout=10)
+
+
+def scan(record_id: Any) -> dict[str, Any]:
+    """Return a scan request."""
+    return {"record_id": record_id, "sequence": '{"name": "test_sequence", "version": 1}'}
+
+
+def test_queue(control: AcquisitionControl):
+    """Scans are acquired one after another, a full queue answers 429."""
+    response = start(control, scan("a"))
+    assert response.status_code == 200 and response.json()["status"] == "acquiring"
+    for record_id in "bc":
+        response = start(control, scan(record_id))
+        assert response.status_code == 200 and response.json()["status"] == "queued"
+    response = start(control, scan("d"))
+    assert response.status_code == 429 and "Retry-After" in response.headers
+    assert requests.get(url(control, "/api/scans/d"), timeout=10).status_code == 404
+
+
+@pytest.mark.parametrize("state, record_ids", [("acquiring", "a"), ("queued", "ab")])
+def test_duplicate(control: AcquisitionControl, state: str, record_ids: str):
+    """A record_id that is queued or running is rejected with 409 and keeps its state."""
+    for record_id in record_ids:
+        assert start(control, scan(record_id)).status_code == 200
+    response = start(control, scan(record_ids[-1]))
+    assert response.status_code == 409
+    assert response.json() == {"message": "Scan is queued or running", "record_id": record_ids[-1], "status": state}
+    assert control.scan_status(record_ids[-1]) == ScanState(state)
+    assert len(control._acquisition_queue) == len(record_ids) - 1
+
+
+@pytest.mark.parametrize(
+    "body",
+    [json.dumps(scan(123)), json.dumps(scan(None)), '{"record_id": "a"}', '{"sequence": "s"}', '["a"]', "not json"],
+)
+def test_invalid_request(control: AcquisitionControl, body: str):
+    """Invalid requests are answered with 400 and not queued."""
+    response = requests.post(url(control, "/api/start-scan"), data=body, timeout=10)
+    assert response.status_code == 400
+    assert control._current is None and not control._acquisition_queue
+    assert requests.post(url(control, "/api/unknown"), timeout=10).status_code == 404
+
+
+def test_cancel(control: AcquisitionControl):
+    """Queued and running scans are cancelled, unknown ones are not found."""
+    for record_id in "abc":
+        start(control, scan(record_id))
+    response = requests.post(url(control, "/api/scans/b/cancel"), timeout=10)
+    assert response.status_code == 200 and response.json()["status"] == "cancelled"
+    response = requests.delete(url(control, "/api/scans/a"), timeout=10)
+    assert response.status_code == 200 and response.json()["status"] == "cancelled"
+    # The next queued scan starts
+    response = requests.get(url(control, "/api/scans/c"), timeout=10)
+    assert response.json() == {"record_id": "c", "status": "acquiring"}
+
+    # Cancelling again is harmless
+    response = requests.delete(url(control, "/api/scans/a"), timeout=10)
+    assert response.status_code == 200 and response.json()["status"] == "cancelled"
+    assert requests.delete(url(control, "/api/scans/x"), timeout=10).status_code == 404
+    # A cancelled record can be requested again
+    response = start(control, scan("b"))
+    assert response.status_code == 200 and response.json()["status"] == "queued"
+
+
+def test_cancel_finished(control: AcquisitionControl):
+    """A finished scan is not cancelled and can be requested again."""
+    with control._lock:
+        control._set_state("a", ScanState.done)
+    response = requests.delete(url(control, "/api/scans/a"), timeout=10)
+    assert response.status_code == 409 and response.json()["status"] == "done"
+    assert start(control, scan("a")).status_code == 200
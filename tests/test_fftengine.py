@@ -0,0 +1,133 @@
+# Copyright (C) 2023, BRAIN-LINK UG (haftungsbeschränkt). All Rights Reserved.
+# SPDX-License-Identifier: GPL-3.0-only OR LicenseRef-ScanHub-Commercial
+
+"""Compare the FFTEngine backends with the explicitly shifted numpy transforms."""
+
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import numpy.typing as npt
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fftengine import FFTEngine  # noqa: E402
+
+BACKENDS = FFTEngine.available_backends()
+# Even and odd dimensions take different paths (checkerboard modulation or explicit shifts)
+SHAPES = [(64, 64), (48, 80), (63, 63), (64, 45), (3, 32, 32), (2, 33, 34)]
+# Relative tolerance per working precision
+PRECISIONS = [(np.float32, np.complex64, 1e-4), (np.float64, np.complex128, 1e-10)]
+
+
+def fft2c(data: np.ndarray) -> np.ndarray:
+    """Return the reference centred forward transform."""
+    return np.fft.fftshift(np.fft.fft2(np.fft.ifftshift(data, axes=(-2, -1))), axes=(-2, -1))
+
+
+def ifft2c(data: np.ndarray) -> np.ndarray:
+    """Return the reference centred inverse transform."""
+    return np.fft.fftshift(np.fft.ifft2(np.fft.ifftshift(data, axes=(-2, -1))), axes=(-2, -1))
+
+
+def image(shape: tuple[int, ...]) -> np.ndarray:
+    """Return a reproducible real test image."""
+    return np.random.default_rng(0).normal(size=shape) + 1
+
+
+def close(result: np.ndarray, expected: np.ndarray, rtol: float) -> bool:
+    """Compare relative to the largest magnitude, the transforms mix all samples."""
+    return bool(np.max(np.abs(result - expected)) <= rtol * np.max(np.abs(expected)))
+
+
+@pytest.fixture(params=BACKENDS)
+def engine(request) -> FFTEngine:
+    """Return an engine of every installed backend."""
+    return FFTEngine(request.param, threads=2, planner_effort="FFTW_ESTIMATE")
+
+
+@pytest.mark.parametrize("rtype, ctype, rtol", PRECISIONS)
+@pytest.mark.parametrize("shape", SHAPES)
+def test_fft2c_real(engine: FFTEngine, shape: tuple[int, ...], rtype: npt.DTypeLike, ctype: npt.DTypeLike, rtol: float):
+    """Real input uses rfft2 and conjugate symmetry for even shapes."""
+    data = image(shape).astype(rtype)
+    out = np.empty(shape, ctype)
+    engine.fft2c(data, out)
+    assert close(out, fft2c(data.astype(np.float64)), rtol)
+
+
+@pytest.mark.parametrize("rtype, ctype, rtol", PRECISIONS)
+@pytest.mark.parametrize("shape", SHAPES)
+def test_fft2c_complex(
+    engine: FFTEngine, shape: tuple[int, ...], rtype: npt.DTypeLike, ctype: npt.DTypeLike, rtol: float
+):
+    """Complex input uses the full transform."""
+    data = (image(shape) + 1j * image(shape)[..., ::-1, :]).astype(ctype)
+    out = np.empty(shape, ctype)
+    engine.fft2c(data, out)
+    assert close(out, fft2c(data.astype(np.complex128)), rtol)
+
+
+@pytest.mark.parametrize("rtype, ctype, rtol", PRECISIONS)
+@pytest.mark.parametrize("shape", SHAPES)
+def test_ifft2c(engine: FFTEngine, shape: tuple[int, ...], rtype: npt.DTypeLike, ctype: npt.DTypeLike, rtol: float):
+    """The inverse transform and its magnitude match the shifted numpy transform."""
+    kspace = fft2c(image(shape)).astype(ctype)
+    expected = ifft2c(kspace.astype(np.complex128))
+
+    out = np.empty(shape, ctype)
+    engine.ifft2c(kspace, out)
+    assert close(out, expected, rtol)
+
+    magnitude = np.empty(shape, rtype)
+    engine.ifft2c_abs(kspace, magnitude)
+    assert close(magnitude, np.abs(expected), rtol)
+
+
+@pytest.mark.parametrize("rtype, ctype, rtol", PRECISIONS)
+@pytest.mark.parametrize("shape", SHAPES)
+def test_ifft2c_abs_hermitian(
+    engine: FFTEngine, shape: tuple[int, ...], rtype: npt.DTypeLike, ctype: npt.DTypeLike, rtol: float
+):
+    """Conjugate symmetric kspace is reconstructed from its first half with irfft2."""
+    data = image(shape)
+    kspace = fft2c(data).astype(ctype)
+    magnitude = np.empty(shape, rtype)
+    engine.ifft2c_abs(kspace, magnitude, hermitian=True)
+    assert close(magnitude, np.abs(data), rtol)
+
+
+@pytest.mark.parametrize("shape", [(16, 64), (5, 63)])
+def test_ifft1c(engine: FFTEngine, shape: tuple[int, ...]):
+    """The line transform matches the shifted numpy transform over the last axis."""
+    lines = fft2c(image(shape)).astype(np.complex64)
+    expected = np.fft.fftshift(np.fft.ifft(np.fft.ifftshift(lines, axes=-1), axis=-1), axes=-1)
+    result = engine.ifft1c(lines)
+    assert result.dtype == np.complex64
+    assert close(result, expected, 1e-4)
+
+
+def test_repeated_calls(engine: FFTEngine):
+    """Reused scratch buffers and plans do not leak data between calls."""
+    out = np.empty((32, 32), np.complex64)
+    for seed in range(3):
+        data = np.random.default_rng(seed).normal(size=(32, 32)).astype(np.float32)
+        engine.fft2c(data, out)
+        assert close(out, fft2c(data.astype(np.float64)), 1e-4)
+
+
+def test_concurrent_threads(engine: FFTEngine):
+    """Threads transform different shapes at the same time with their own buffers and plans."""
+    shapes = [(64, 64), (48, 80), (3, 32, 32), (63, 63)]
+
+    def transform(shape: tuple[int, ...]) -> bool:
+        data = image(shape).astype(np.float32)
+        out = np.empty(shape, np.complex64)
+        for _ in range(10):
+            engine.fft2c(data, out)
+        return close(out, fft2c(data.astype(np.float64)), 1e-4)
+
+    with ThreadPoolExecutor(len(shapes)) as executor:
+        assert all(executor.map(transform, shapes))
@@ -0,0 +1,79 @@
+# Copyright (C) 2023, BRAIN-LINK UG (haftungsbeschränkt). All Rights Reserved.
+# SPDX-License-Identifier: GPL-3.0-only OR LicenseRef-ScanHub-Commercial
+
+"""Store, load and evict kspace in the KSpaceCache."""
+
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import kspacecache  # noqa: E402
+from imagemanipulators import ImageManipulators  # noqa: E402
+from kspacecache import KSpaceCache  # noqa: E402
+
+
+def image(seed: int = 0) -> np.ndarray:
+    """Return a reproducible C-contiguous test image."""
+    return np.random.default_rng(seed).normal(size=(32, 24)).astype(np.float32)
+
+
+def test_key():
+    """The key depends on the data, the image dtype and the kspace dtype."""
+    key = KSpaceCache.key(image(), np.complex64)
+    assert key == KSpaceCache.key(image(), np.dtype("complex64"))
+    assert key != KSpaceCache.key(image(1), np.complex64)
+    assert key != KSpaceCache.key(image(), np.complex128)
+    assert key != KSpaceCache.key(image().astype(np.float64), np.complex64)
+
+
+def test_store_load(tmp_path: Path):
+    """A stored kspace is memory mapped read-only, unknown keys are None."""
+    cache = KSpaceCache(tmp_path)
+    kspace = np.fft.fft2(image()).astype(np.complex64)
+    cache.store("a", kspace)
+    loaded = cache.load("a")
+    assert loaded is not None
+    assert isinstance(loaded, np.memmap) and not loaded.flags.writeable
+    assert np.array_equal(loaded, kspace)
+    assert cache.load("b") is None
+
+
+def test_evict(tmp_path: Path):
+    """The least recently used files are removed when the cache exceeds its size."""
+    kspace = np.zeros((32, 32), np.complex64)
+    cache = KSpaceCache(tmp_path, max_bytes=int(3.5 * kspace.nbytes))
+    for i, key in enumerate("abc"):
+        cache.store(key, kspace)
+        os.utime(tmp_path / f"{key}.npy", (i, i))
+    cache.load("a")  # Used last
+    cache.store("d", kspace)
+    assert sorted(path.stem for path in tmp_path.glob("*.npy")) == ["a", "c", "d"]
+
+
+def test_failed_store(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    """A write error is logged and leaves neither a cache file nor a partial temporary file."""
+
+    def fail(file, array):
+        file.write(b"partial")
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(kspacecache.np, "save", fail)
+    KSpaceCache(tmp_path).store("a", np.zeros(4, np.complex64))
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_image_manipulators(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    """The second instance of an image maps the cached kspace as its original kspace."""
+    monkeypatch.setattr(kspacecache, "_cache", KSpaceCache(tmp_path))
+    monkeypatch.setattr(kspacecache, "_cache_initialised", True)
+    first = ImageManipulators(image())
+    assert len(list(tmp_path.glob("*.npy"))) == 1
+    second = ImageManipulators(image())
+    assert isinstance(second.orig_kspacedata, np.memmap)
+    assert np.array_equal(second.orig_kspacedata, first.orig_kspacedata)
+    assert np.array_equal(second.kspacedata, first.kspacedata) and second.kspacedata.flags.writeable
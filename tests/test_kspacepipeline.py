@@ -0,0 +1,122 @@
+# Copyright (C) 2023, BRAIN-LINK UG (haftungsbeschränkt). All Rights Reserved.
+# SPDX-License-Identifier: GPL-3.0-only OR LicenseRef-ScanHub-Commercial
+
+"""Compare the cached and incremental pipeline steps with a full recompute."""
+
+import os
+import sys
+from dataclasses import replace
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+# The tests must not fill the kspace cache
+os.environ.setdefault("SCANHUB_KSPACE_CACHE", "off")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from gridding import gridding_operator  # noqa: E402
+from imagemanipulators import ImageManipulators  # noqa: E402
+from kspacepipeline import KSpaceParameters, KSpacePipeline  # noqa: E402
+
+
+def phantom(rows: int = 48, cols: int = 40, channels: int = 1) -> np.ndarray:
+    """Return a reproducible test image: an ellipse with noise, a stack if channels > 1."""
+    y, x = np.mgrid[-1 : 1 : rows * 1j, -1 : 1 : cols * 1j]
+    image = 100.0 * ((x / 0.8) ** 2 + (y / 0.6) ** 2 < 1) + np.random.default_rng(0).normal(0, 1, (rows, cols))
+    if channels > 1:
+        image = image[None] * np.linspace(0.5, 1, channels)[:, None, None]
+    return image
+
+
+def recompute(data: np.ndarray, params: KSpaceParameters) -> tuple[np.ndarray, np.ndarray]:
+    """Run the pipeline on a new instance, without cached stages or filling steps."""
+    return KSpacePipeline().run(data, params, precision="double")
+
+
+def close(result: np.ndarray, expected: np.ndarray, rtol: float = 1e-10) -> bool:
+    """Compare relative to the largest magnitude."""
+    return result.shape == expected.shape and bool(
+        np.max(np.abs(result - expected)) <= rtol * max(np.max(np.abs(expected)), 1)
+    )
+
+
+# Every transition reuses some cached stages of the previous parameters
+TRANSITIONS = [
+    KSpaceParameters(),
+    KSpaceParameters(signal_to_noise=10, noise_seed=3),
+    KSpaceParameters(signal_to_noise=10, noise_seed=3, spikes=((5, 7),), hamming=True),
+    KSpaceParameters(signal_to_noise=10, noise_seed=3, spikes=((5, 7),), hamming=True, filling=40),
+    KSpaceParameters(signal_to_noise=20, noise_seed=3, spikes=((5, 7),), hamming=True, filling=40),
+    KSpaceParameters(signal_to_noise=20, noise_seed=3, undersample=2, compress=True, low_pass=60),
+    KSpaceParameters(signal_to_noise=20, noise_seed=3, undersample=2, compress=True, low_pass=80),
+    KSpaceParameters(partial_fourier=70, zero_fill=True, patches=((10, 10, 2),)),
+    KSpaceParameters(partial_fourier=70, zero_fill=False, decrease_dc=50, scan_percentage=80),
+    KSpaceParameters(),
+]
+
+
+@pytest.mark.parametrize("channels", [1, 3])
+def test_stage_cache(channels: int):
+    """Reusing the cached stage outputs gives the kspace and image of a full recompute."""
+    data = phantom(channels=channels)
+    im = ImageManipulators(data, precision="double")
+    pipeline = KSpacePipeline()
+    for params in TRANSITIONS:
+        pipeline.apply(im, params, displays=False)
+        kspace, image = recompute(data, params)
+        assert close(im.kspacedata, kspace), params
+        assert close(im.img, image), params
+
+
+@pytest.mark.parametrize("mode", [0, 1, 2, 4])
+def test_incremental_filling(mode: int):
+    """A filling playback adds the new lines to the image of the previous step."""
+    data = phantom(channels=2)
+    params = KSpaceParameters(signal_to_noise=15, noise_seed=1, filling_mode=mode)
+    im = ImageManipulators(data, precision="double")
+    pipeline = KSpacePipeline()
+    # Small steps are incremental, the jump and the step backwards start over
+    for filling in [0, 1, 1.5, 2, 2.5, 3, 3.2, 5, 30, 31, 12, 12.5, 100]:
+        step = replace(params, filling=filling)
+        pipeline.apply(im, step, displays=False)
+        assert close(im.img, recompute(data, step)[1]), filling
+
+
+def test_filling_mode_change():
+    """Changing the filling mode during a playback does not reuse the image of the other mode."""
+    data = phantom()
+    im = ImageManipulators(data, precision="double")
+    pipeline = KSpacePipeline()
+    pipeline.apply(im, KSpaceParameters(filling=20, filling_mode=0), displays=False)
+    step = KSpaceParameters(filling=21, filling_mode=1)
+    pipeline.apply(im, step, displays=False)
+    assert close(im.img, recompute(data, step)[1])
+
+
+@pytest.mark.parametrize("mode, trajectory", [(3, "spiral"), (5, "radial")])
+def test_trajectory_filling(mode: int, trajectory: str):
+    """Gridding a complete trajectory reproduces the image, partial steps match a recompute."""
+    data = phantom(40, 40)
+    # The density compensation makes the gridded image close to the original (up to ringing at the edges)
+    image = recompute(data, KSpaceParameters(filling_mode=mode))[1]
+    error = np.linalg.norm(image - np.abs(data)) / np.linalg.norm(data)
+    assert error < 0.1, error
+
+    im = ImageManipulators(data, precision="double")
+    pipeline = KSpacePipeline()
+    for filling in [20, 25, 60, 40, 100]:
+        step = KSpaceParameters(filling=filling, filling_mode=mode)
+        pipeline.apply(im, step, displays=False)
+        kspace, image = recompute(data, step)
+        assert close(im.kspacedata, kspace), filling
+        assert close(im.img, image), filling
+
+
+def test_gridding_operator_cache():
+    """The operator of the last shape is built once."""
+    assert gridding_operator((40, 40), "radial") is gridding_operator((40, 40), "radial")
+    operator = gridding_operator((32, 48), "spiral")
+    assert operator.apodization.shape == (32, 48)
+    assert operator.indices.shape == operator.weights.shape == (operator.samples, 16)
+    assert np.all(operator.dcf > 0)
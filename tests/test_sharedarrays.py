@@ -0,0 +1,92 @@
+# Copyright (C) 2023, BRAIN-LINK UG (haftungsbeschränkt). All Rights Reserved.
+# SPDX-License-Identifier: GPL-3.0-only OR LicenseRef-ScanHub-Commercial
+
+"""Allocate, attach and remove the shared memory blocks of SharedArrays."""
+
+import multiprocessing
+import subprocess
+import sys
+import textwrap
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from sharedarrays import SharedArrays, attach, detach  # noqa: E402
+
+SHM = Path("/dev/shm")
+
+
+def run_script(source: str) -> subprocess.CompletedProcess:
+    """Run a script in a new interpreter, the resource tracker reports at its exit."""
+    script = f"import sys\nsys.path.insert(0, {str(ROOT)!r})\n" + textwrap.dedent(source)
+    return subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, timeout=60)
+
+
+def test_array_copies_data():
+    """The shared copy has the requested dtype and the data."""
+    shared = SharedArrays()
+    data = np.arange(12.0).reshape(3, 4)
+    array = shared.array(data, np.float32)
+    assert array.dtype == np.float32 and array.flags.c_contiguous
+    assert np.array_equal(array, data)
+    shared.close()
+
+
+def test_attach_same_process():
+    """The owner can attach its own block, the tracker does not lose its registration."""
+    result = run_script("""
+        import numpy as np
+        from sharedarrays import SharedArrays, attach, detach
+
+        shared = SharedArrays()
+        array = shared.array(np.arange(10.0), np.float64)
+        descriptor = shared.descriptor(array)
+        view = attach(descriptor)
+        view[0] = 42
+        assert array[0] == 42
+        del view
+        detach(descriptor)
+        del array
+        shared.close()
+        """)
+    assert result.returncode == 0, result.stderr
+    assert "KeyError" not in result.stderr
+    assert "leaked" not in result.stderr
+
+
+def test_attach_spawned_child():
+    """A spawned process sees the data without the tracker removing the block at its exit."""
+    shared = SharedArrays()
+    array = shared.array(np.arange(64.0).reshape(8, 8), np.float32)
+    descriptor = shared.descriptor(array)
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        copy = executor.submit(attach, descriptor).result()
+    assert np.array_equal(copy, array)
+    # The block outlives the child
+    view = attach(descriptor)
+    assert np.array_equal(view, array)
+    del view
+    detach(descriptor)
+    shared.close()
+
+
+@pytest.mark.skipif(not SHM.is_dir(), reason="POSIX shared memory is not listed in /dev/shm")
+def test_close_removes_blocks():
+    """close() and release() unlink the blocks."""
+    shared = SharedArrays()
+    first = shared.zeros((4, 4), np.complex64)
+    second = shared.zeros((4, 4), np.float32)
+    first_name, second_name = shared.descriptor(first).name, shared.descriptor(second).name
+    assert (SHM / first_name).exists() and (SHM / second_name).exists()
+
+    shared.release(first)
+    assert not (SHM / first_name).exists()
+    shared.close()
+    assert not (SHM / second_name).exists()
+    with pytest.raises(ValueError):
+        shared.descriptor(second)
@@ -0,0 +1,127 @@
+# Copyright (C) 2023, BRAIN-LINK UG (haftungsbeschränkt). All Rights Reserved.
+# SPDX-License-Identifier: GPL-3.0-only OR LicenseRef-ScanHub-Commercial
+
+"""Contains the definition of the ThumbnailCache class."""
+
+import threading
+
+import numpy as np
+
+THUMBNAIL_SIZE = 128  # Longest side of a channel preview in pixels
+
+
+def downsample(data: np.ndarray, width: int, height: int) -> np.ndarray:
+    """Average blocks of pixels until the data fits into width x height.
+
+    Works on the last two axes, so a whole stack is downsampled at once. A
+    width or height of 0 (or less) does not restrict the size. The block
+    size is an integer, so the result can be smaller than requested and the
+    last rows and columns may be cropped.
+
+    Parameters
+    ----------
+        data : np.ndarray
+            2D array or stack of 2D arrays
+        width : int
+            maximum number of columns
+        height : int
+            maximum number of rows
+
+    Returns
+    -------
+        np.ndarray: the downsampled data of the same dtype (data itself if it fits)
+    """
+    factors = [int(np.ceil(n / r)) for n, r in zip(data.shape[-2:], (height, width)) if r > 0]
+    factor = max(factors, default=1)
+    if factor <= 1:
+        return data
+    rows, cols = data.shape[-2] // factor, data.shape[-1] // factor
+    blocks = data[..., : rows * factor, : cols * factor].reshape(data.shape[:-2] + (rows, factor, cols, factor))
+    return blocks.mean(axis=(-3, -1), dtype=np.float32).astype(data.dtype, copy=False)
+
+
+class ThumbnailCache:
+    """Small 8 bit previews of the channels of a stack.
+
+    The previews are rendered from the image texture on the ComputeWorker
+    thread (render) and handed to the cache on the GUI thread (update).
+    Every channel has a version that only increases when its preview
+    changed, so the thumbnail strip reloads just the changed channels.
+    """
+
+    def __init__(self, size: int = THUMBNAIL_SIZE):
+        """Initialise an empty cache.
+
+        Parameters
+        ----------
+            size : int
+                longest side of the previews in pixels
+        """
+        self.size = size
+        self._previews = np.zeros((0, 1, 1), dtype=np.uint8)
+        self._versions: list[int] = []
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def render(self, image: np.ndarray) -> np.ndarray:
+        """Render the previews of an image stack.
+
+        Parameters
+        ----------
+            image : np.ndarray
+                uint16 image texture stack (channels, rows, columns)
+
+        Returns
+        -------
+            np.ndarray: uint8 previews (channels, rows, columns)
+        """
+        small = downsample(image, self.size, self.size)
+        previews = np.empty(small.shape, dtype=np.uint8)
+        np.right_shift(small, 8, out=previews, casting="unsafe")
+        return previews
+
+    def clear(self):
+        """Remove all previews, e.g. when another image is loaded."""
+        with self._lock:
+            self._previews = np.zeros((0, 1, 1), dtype=np.uint8)
+            self._versions = []
+
+    def update(self, previews: np.ndarray) -> list[int]:
+        """Store new previews and return the channels whose preview changed.
+
+        Parameters
+        ----------
+            previews : np.ndarray
+                uint8 previews created by render
+
+        Returns
+        -------
+            list: indices of the changed channels
+        """
+        with self._lock:
+            self._version += 1
+            if previews.shape != self._previews.shape:
+                changed = list(range(len(previews)))
+                self._versions = [self._version] * len(previews)
+            else:
+                changed = np.flatnonzero(np.any(previews != self._previews, axis=(-2, -1))).tolist()
+                for channel in changed:
+                    self._versions[channel] = self._version
+            self._previews = previews
+            return changed
+
+    def version(self, channel: int) -> int:
+        """Return the version of the preview of a channel (0 before the first update)."""
+        with self._lock:
+            return self._versions[channel] if channel < len(self._versions) else 0
+
+    def preview(self, channel: int) -> np.ndarray:
+        """Return the uint8 preview of a channel.
+
+        Until the first previews of a stack arrive, a single black pixel is
+        returned.
+        """
+        with self._lock:
+            if channel < len(self._previews):
+                return self._previews[channel]
+            return np.zeros((1, 1), dtype=np.uint8)
@@ -0,0 +1,156 @@
+# Copyright (C) 2023, BRAIN-LINK UG (haftungsbeschränkt). All Rights Reserved.
+# SPDX-License-Identifier: GPL-3.0-only OR LicenseRef-ScanHub-Commercial
+
+"""Contains the definition of the Uploader class."""
+
+import io
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from enum import Enum
+from typing import Callable
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+log = logging.getLogger(__name__)
+
+UPLOAD_URL = "http://localhost:8080/api/v1/workflow/upload/{record_id}"
+
+
+class UploadState(str, Enum):
+    """State of the upload of a record."""
+
+    queued = "queued"
+    uploading = "uploading"
+    done = "done"
+    failed = "failed"
+
+
+class Uploader:
+    """Uploads the kspace of finished acquisitions to the ScanHub workflow manager.
+
+    Uploads run on a pool of background threads, so the caller (usually
+    the GUI thread) only hands over the data. The arrays are serialised in
+    memory as .npy, every upload has its own buffer. The threads share a
+    requests.Session, which keeps the connections to the server open
+    between uploads. Connection errors and temporary server errors
+    (429, 502, 503, 504) are retried with exponential backoff, the state of
+    every record can be looked up with status().
+    """
+
+    # Records whose state can still be requested
+    _history = 1000
+
+    def __init__(
+        self,
+        url: str = UPLOAD_URL,
+        workers: int = 2,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: tuple[float, float] = (5.0, 300.0),
+    ):
+        """Initialise the session and the worker pool.
+
+        Parameters
+        ----------
+            url : str
+                upload endpoint, {record_id} is replaced by the record id
+            workers : int
+                number of uploads running at the same time
+            retries : int
+                maximum number of retries of an upload
+            backoff : float
+                backoff factor in seconds, the n-th retry waits backoff * 2^(n-1)
+            timeout : tuple
+                connect and read timeout of a request in seconds
+        """
+        self.url = url
+        self.timeout = timeout
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 502, 503, 504),
+            allowed_methods=frozenset({"POST"}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers, max_retries=retry)
+        self._session = requests.Session()
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._states: OrderedDict[str, UploadState] = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Uploader")
+
+    def submit(
+        self, record_id: str, array: np.ndarray, callback: Callable[[str, UploadState], None] | None = None
+    ) -> Future:
+        """Queue the upload of an array.
+
+        Parameters
+        ----------
+            record_id : str
+                id of the ScanHub record the data belongs to
+            array : np.ndarray
+                data to be uploaded, must not be modified afterwards
+            callback : callable
+                called with the record id and the final state on the upload thread
+
+        Returns
+        -------
+            Future: resolves to the final UploadState of the record
+        """
+        self._set_state(record_id, UploadState.queued)
+        return self._executor.submit(self._upload, record_id, array, callback)
+
+    def status(self, record_id: str) -> UploadState | None:
+        """Return the state of the upload of a record, None if it is unknown."""
+        with self._lock:
+            return self._states.get(record_id)
+
+    def shutdown(self, wait: bool = False):
+        """Cancel the queued uploads and stop the worker pool.
+
+        Parameters
+        ----------
+            wait : bool
+                wait for the running uploads to finish
+        """
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+        if wait:
+            self._session.close()
+
+    def _set_state(self, record_id: str, state: UploadState):
+        with self._lock:
+            self._states[record_id] = state
+            self._states.move_to_end(record_id)
+            while len(self._states) > self._history:
+                self._states.popitem(last=False)
+
+    def _upload(
+        self, record_id: str, array: np.ndarray, callback: Callable[[str, UploadState], None] | None
+    ) -> UploadState:
+        self._set_state(record_id, UploadState.uploading)
+        url = self.url.format(record_id=record_id)
+        try:
+            buffer = io.BytesIO()
+            np.save(buffer, array, allow_pickle=False)
+            buffer.seek(0)
+            log.info(f"Uploading {buffer.getbuffer().nbytes} bytes to {url}")
+            response = self._session.post(
+                url, files={"file": ("data.npy", buffer, "application/octet-stream")}, timeout=self.timeout
+            )
+            response.raise_for_status()
+            log.info(f"Upload of record {record_id} finished: {response.text}")
+            state = UploadState.done
+        except Exception:
+            # Also serialisation errors, e.g. MemoryError, the state must become final
+            log.error(f"Upload of record {record_id} failed", exc_info=True)
+            state = UploadState.failed
+        self._set_state(record_id, state)
+        if callback is not None:
+            callback(record_id, state)
+        return state
@@ -8,6 +8,7 @@ Item {
 
     property alias btnSpikeEnabed : btnSpike.enabled
     property alias btnPatchEnabled : btnPatch.enabled
+    property alias kspaceConstant : ksp_const.value
 
     RowLayout {
         spacing: 0
@@ -419,7 +420,7 @@ Item {
                     to: 10
                     stepSize: 1
                     value: -3
-                    onValueChanged: py_SimulationApp.update_displays()
+                    // Applied by the kspace shader in view.qml
                     Label {
                         leftPadding: 5
                         anchors.left: parent.left
@@ -10,17 +10,23 @@ layout(std140, binding = 0) uniform buf {
     float qt_Opacity;
     float brightness;
     float contrast;
+    // Window width and center as fractions of the image maximum
+    float ww;
+    float wc;
 };
 
+// Magnitude image divided by its maximum (16 bit texture)
 layout(binding = 1) uniform sampler2D source;
 
 void main()
 {
-    vec4 pixelColor = texture(source, qt_TexCoord0);
-    pixelColor.rgb /= max(1.0/256.0, pixelColor.a);
+    float value = texture(source, qt_TexCoord0).r;
+    // A zero window width is a threshold at the window center
+    float windowed = ww > 0.0 ? clamp((value - wc) / ww + 0.5, 0.0, 1.0) : float(value > wc);
+    vec3 pixelColor = vec3(windowed);
     float c = 1.0 + contrast;
     float contrastGainFactor = 1.0 + c * c * c * c * step(0.0, contrast);
-    pixelColor.rgb = ((pixelColor.rgb - 0.5) * (contrastGainFactor * contrast + 1.0)) + 0.5;
-    pixelColor.rgb = mix(pixelColor.rgb, vec3(step(0.0, brightness)), abs(brightness));
-    fragColor = vec4(pixelColor.rgb * pixelColor.a, pixelColor.a) * qt_Opacity;
+    pixelColor = ((pixelColor - 0.5) * (contrastGainFactor * contrast + 1.0)) + 0.5;
+    pixelColor = mix(pixelColor, vec3(step(0.0, brightness)), abs(brightness));
+    fragColor = vec4(pixelColor, 1.0) * qt_Opacity;
 }
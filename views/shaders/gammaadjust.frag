@@ -9,14 +9,33 @@ layout(std140, binding = 0) uniform buf {
     mat4 qt_Matrix;
     float qt_Opacity;
     float gamma;
+    // Scaling constant times the kspace maximum
+    float factor;
+    // Kspace minimum divided by the maximum
+    float minimum;
 };
 
+// log10 of the kspace magnitude divided by its maximum, mapped from
+// -DECADES..0 to 0..1 (16 bit texture, see ImageManipulators.prepare_textures)
 layout(binding = 1) uniform sampler2D source;
 
+const float DECADES = 16.0;
+
+// log(1 + x) that keeps its precision for small x
+float log1p(float x)
+{
+    return x < 1e-4 ? x * (1.0 - 0.5 * x) : log(1.0 + x);
+}
+
 void main()
 {
-    vec4 originalColor = texture(source, qt_TexCoord0.st);
-    originalColor.rgb = originalColor.rgb / max(1.0/256.0, originalColor.a);
-    vec3 adjustedColor = pow(originalColor.rgb, vec3(gamma));
-    fragColor = vec4(adjustedColor * originalColor.a, originalColor.a) * qt_Opacity;
+    // K-space scaling: https://homepages.inf.ed.ac.uk/rbf/HIPR2/pixlog.htm
+    // normalised to the range of the scaled kspace
+    float encoded = texture(source, qt_TexCoord0.st).r;
+    float value = encoded > 0.0 ? pow(10.0, (encoded - 1.0) * DECADES) : 0.0;
+    float low = log1p(factor * minimum);
+    float high = log1p(factor);
+    float scaled = high > low ? clamp((log1p(factor * value) - low) / (high - low), 0.0, 1.0) : 0.0;
+    vec3 adjustedColor = pow(vec3(scaled), vec3(gamma));
+    fragColor = vec4(adjustedColor, 1.0) * qt_Opacity;
 }
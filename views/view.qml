@@ -231,6 +231,7 @@ ApplicationWindow {
                     property int len: 10000
                     property bool notify_enabled: false
                     id: play_anim
+                    objectName: "play_anim"
                     target: filling
                     property: "value"
                     to: 100
@@ -248,11 +249,15 @@ ApplicationWindow {
                 Layout.fillWidth: true
                 Layout.maximumWidth: 200
                 textRole: "text"
+                valueRole: "mode"
                 model: ListModel {
                     id: filling_modes
                     ListElement { mode: 0; text: "Linear"}
                     ListElement { mode: 1; text: "Centric"}
                     ListElement { mode: 2; text: "Single-Shot EPI (blipped)"}
+                    ListElement { mode: 4; text: "Segmented EPI (4 shots)"}
+                    ListElement { mode: 3; text: "Spiral (Archimedean)"}
+                    ListElement { mode: 5; text: "Radial (golden angle)"}
                 }
             }
         }
@@ -331,9 +336,11 @@ ApplicationWindow {
                     Image {
                         objectName: "thumb_" + parent.itemIndex
                         fillMode: Image.PreserveAspectFit
-                        source: "image://imgs/" + objectName + "_"
+                        source: "image://imgs/thumb_0_" + parent.itemIndex
                         height: parent.height - 3
+                        sourceSize.height: height
                         smooth: false
+                        cache: false
                         MouseArea {
                             anchors.fill: parent
                             onClicked: {
@@ -423,13 +430,13 @@ ApplicationWindow {
                     Image {
                         id: image
                         objectName: "image_display"
-                        source: "image://imgs/image"
-                        sourceSize.width: 100
-                        sourceSize.height: 100
+                        source: "image://imgs/image_0_0"
                         smooth: false
+                        cache: false
                         fillMode: Image.PreserveAspectFit
                         anchors.fill: parent
-                        visible: true
+                        visible: false
+                        // Window width and center as fractions of the image maximum
                         property real ww: 1
                         property real wc: 0.5
                     }
@@ -447,7 +454,6 @@ ApplicationWindow {
                             } else if (image_mouse.pressedButtons == Qt.MiddleButton) {
                                 image.ww = mouseX / parent.width;
                                 image.wc = mouseY / parent.height;
-                                py_SimulationApp.update_displays()
                             }
                         }
 
@@ -456,7 +462,6 @@ ApplicationWindow {
                             image_gamma.brightness = 0
                             image.ww = 1
                             image.wc = 0.5
-                            py_SimulationApp.update_displays()
                             kspace_item.visible = !kspace_item.visible
                         }
 
@@ -468,33 +473,27 @@ ApplicationWindow {
                         }
                     }
 
-                    // PySide6 BrightnessContrast replacement
+                    // Window and PySide6 BrightnessContrast replacement, the shader
+                    // samples the 16 bit texture of the image directly
                     Item {
                         z: 1
                         id: image_gamma
                         anchors.fill: image
                         property real brightness: 0.0
                         property real contrast: 0.0
-                        property bool cached: false
-
-                        ShaderEffectSource {
-                            id: imageSource
-                            anchors.fill: parent
-                            visible: image_gamma.cached
-                            smooth: true
-                            sourceItem: image
-                            live: true
-                            hideSource: visible
-                        }
 
                         ShaderEffect {
                             id: shaderItem
-                            property variant source: imageSource
+                            property variant source: image
                             property real brightness: image_gamma.brightness
                             property real contrast: image_gamma.contrast
+                            property real ww: image.ww
+                            property real wc: image.wc
 
-                            anchors.fill: parent
-                            blending: !image_gamma.cached
+                            anchors.centerIn: parent
+                            width: image.paintedWidth
+                            height: image.paintedHeight
+                            blending: false
 
                             fragmentShader: "shaders/brightnesscontrast.frag.qsb"
                         }
@@ -524,11 +523,15 @@ ApplicationWindow {
                     Image {
                         id: kspace
                         objectName: "kspace_display"
-                        source: "image://imgs/kspace"
+                        source: "image://imgs/kspace_0_0"
                         smooth: false
+                        cache: false
                         fillMode: Image.PreserveAspectFit
                         anchors.fill: parent
                         visible: false
+                        // Kspace magnitude range, set with every new frame
+                        property real kmin: 0
+                        property real kmax: 1
                     }
 
                     MouseArea {
@@ -567,22 +570,23 @@ ApplicationWindow {
                         }
                     }
 
-                    // PySide6 GammaAdjust replacement
+                    // Kspace log scaling and PySide6 GammaAdjust replacement, the
+                    // shader samples the 16 bit texture of the kspace directly
                     Item {
                         z: 1
                         id: kspace_gamma
                         anchors.fill: kspace
                         property real gamma: 1.0
 
-                        ShaderEffectSource {
-                            id: kspaceSource
-                            sourceItem: kspace
-                        }
-
                         ShaderEffect {
-                            anchors.fill: parent
-                            property variant source: kspaceSource
+                            anchors.centerIn: parent
+                            width: kspace.paintedWidth
+                            height: kspace.paintedHeight
+                            blending: false
+                            property variant source: kspace
                             property real gamma: 1.0 / Math.max(kspace_gamma.gamma, 0.0001)
+                            property real factor: Math.pow(10, kspaceParameterTab.kspaceConstant) * kspace.kmax
+                            property real minimum: kspace.kmax > 0 ? kspace.kmin / kspace.kmax : 0
                             fragmentShader: "shaders/gammaadjust.frag.qsb"
 
                         }